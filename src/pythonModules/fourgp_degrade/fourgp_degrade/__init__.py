@@ -8,7 +8,7 @@ from warnings import simplefilter
 from .convolve import SpectrumConvolver
 from .interpolate import SpectrumInterpolator
 from .gaussian_noise import GaussianNoise
-from .resample import SpectrumResampler
+from .resample import SpectrumResampler, ResamplingPlan
 from .redden import SpectrumReddener
 from .snr_conversion import SNRConverter, SNRValue
 from .spectrum_properties import SpectrumProperties
@@ -1,37 +1,187 @@
 # -*- coding: utf-8 -*-
 
+import numpy as np
 from scipy.ndimage.filters import gaussian_filter1d
+from scipy.fft import next_fast_len
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray
+
+
+def gaussian_kernel(sigma, truncate=4.0):
+    """
+    Produce a normalised Gaussian kernel, truncated at <truncate> standard deviations from its centre. This is the
+    same kernel as is used by <scipy.ndimage.gaussian_filter1d>.
+
+    :param sigma:
+        Standard deviation of the Gaussian in pixels.
+
+    :param truncate:
+        Number of standard deviations at which to truncate the kernel.
+
+    :return:
+        1D array of length 2 * radius + 1
+    """
+
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 * (x / float(sigma)) ** 2)
+    return kernel / kernel.sum()
+
+
+def fft_gaussian_filter(values, sigmas, truncate=4.0):
+    """
+    Convolve the rows of a 2D array with Gaussian kernels using fast Fourier transforms. The cost of this does not
+    depend on the width of the kernels, so it is much faster than <gaussian_filter1d> for wide kernels. The ends of
+    each row are reflected, as they are by <gaussian_filter1d>, so the results are the same to within rounding errors.
+
+    :param values:
+        2D array whose rows are to be convolved.
+
+    :type values:
+        np.ndarray
+
+    :param sigmas:
+        List of the standard deviations of the Gaussian kernels, in pixels. If there is only one, it is applied to
+        every row. If <values> has only one row, it is convolved with each kernel in turn. Otherwise, there must be
+        one kernel for each row.
+
+    :param truncate:
+        Number of standard deviations at which to truncate the kernels.
+
+    :return:
+        2D array of convolved rows
+    """
+
+    kernels = [gaussian_kernel(sigma=sigma, truncate=truncate) for sigma in sigmas]
+    radius = max(len(kernel) // 2 for kernel in kernels)
+    pixel_count = values.shape[1]
+
+    # Pad each row with its reflection, so that the edges match <gaussian_filter1d>. The padding is wide enough that
+    # the circular convolution never wraps data from one end of a row to the other.
+    padded = np.pad(values, ((0, 0), (radius, radius)), mode='symmetric')
+    fft_length = next_fast_len(padded.shape[1])
+
+    # Place each kernel centred on pixel zero, wrapping its left half onto the end of the array
+    kernel_array = np.zeros((len(kernels), fft_length))
+    for index, kernel in enumerate(kernels):
+        kernel_radius = len(kernel) // 2
+        kernel_array[index, :kernel_radius + 1] = kernel[kernel_radius:]
+        if kernel_radius > 0:
+            kernel_array[index, -kernel_radius:] = kernel[:kernel_radius]
+
+    output = np.fft.irfft(np.fft.rfft(padded, n=fft_length, axis=1) * np.fft.rfft(kernel_array, axis=1),
+                          n=fft_length, axis=1)
+    return output[:, radius:radius + pixel_count]
 
 
 class SpectrumConvolver(object):
     """
-    A class containing utility functions for convolving Spectrum objects with point spread functions
+    A class containing utility functions for convolving Spectrum objects with point spread functions. It can also
+    convolve every spectrum in a SpectrumArray in a single operation.
+
+    :ivar fft_sigma_threshold:
+        When convolving with the <auto> method, Gaussians wider than this number of pixels are convolved using FFTs.
     """
 
+    fft_sigma_threshold = 8
+
     def __init__(self, input_spectrum):
-        assert isinstance(input_spectrum, Spectrum), "The SpectrumConvolver class can only operate on Spectrum objects."
+        assert isinstance(input_spectrum, (Spectrum, SpectrumArray)), \
+            "The SpectrumConvolver class can only operate on Spectrum or SpectrumArray objects."
         self._input = input_spectrum
 
-    def gaussian_convolve(self, sigma):
+    def _use_fft(self, sigma, method):
+        """
+        Decide whether to convolve with a Gaussian using FFTs, or directly.
+
+        :param sigma:
+            Standard deviation of point spread function in pixels.
+
+        :param method:
+            Either <direct>, <fft> or <auto>.
+
+        :return:
+            bool
         """
-        Convolve this spectrum with a Gaussian PSF.
+
+        assert method in ("auto", "direct", "fft"), "Unknown convolution method <{}>".format(method)
+        if method == "auto":
+            return sigma > self.fft_sigma_threshold
+        return method == "fft"
+
+    def gaussian_convolve(self, sigma, method="auto"):
+        """
+        Convolve this spectrum with a Gaussian PSF. If the input is a SpectrumArray, every spectrum within it is
+        convolved in a single operation.
 
         :param sigma:
             Standard deviation of point spread function in pixels.
 
+        :param method:
+            Either <direct> to use <gaussian_filter1d>, <fft> to use fast Fourier transforms, or <auto> to use FFTs
+            only for PSFs wider than <fft_sigma_threshold> pixels.
+
         :return:
-            New Spectrum object.
+            New Spectrum object, or a new SpectrumArray object if the input is a SpectrumArray.
         """
 
-        new_values = gaussian_filter1d(input=self._input.values, sigma=sigma)
+        values = self._input.values
+
+        if self._use_fft(sigma=sigma, method=method):
+            new_values = fft_gaussian_filter(values=values.reshape(-1, values.shape[-1]),
+                                             sigmas=[sigma]).reshape(values.shape)
+        else:
+            new_values = gaussian_filter1d(input=values, sigma=sigma, axis=-1)
+
+        if isinstance(self._input, SpectrumArray):
+            output = SpectrumArray(wavelengths=self._input.wavelengths,
+                                   values=new_values,
+                                   value_errors=self._input.value_errors,
+                                   metadata_list=[item.copy() for item in self._input.metadata_list]
+                                   )
+        else:
+            output = Spectrum(wavelengths=self._input.wavelengths,
+                              values=new_values,
+                              value_errors=self._input.value_errors,
+                              metadata=self._input.metadata.copy()
+                              )
+
+        if self._input.mask_set:
+            output.copy_mask_from(self._input)
+
+        return output
+
+    def gaussian_convolve_many(self, sigmas, method="auto"):
+        """
+        Convolve this spectrum with Gaussian PSFs of several different widths. Using FFTs, the spectrum is only
+        transformed once, and all of the PSFs are applied in a single operation.
+
+        :param sigmas:
+            List of the standard deviations of the point spread functions, in pixels.
+
+        :param method:
+            Either <direct>, <fft> or <auto>, as for <gaussian_convolve>. The <auto> method uses FFTs if any of the
+            PSFs is wider than <fft_sigma_threshold> pixels.
+
+        :return:
+            New SpectrumArray object, containing the spectrum convolved with each PSF in turn. Each row has a copy of
+            the value errors of the input spectrum.
+        """
+
+        assert isinstance(self._input, Spectrum), \
+            "Can only convolve a single Spectrum with many PSFs, not a SpectrumArray."
+        assert len(sigmas) > 0, "Must supply at least one PSF width."
+
+        if self._use_fft(sigma=max(sigmas), method=method):
+            new_values = fft_gaussian_filter(values=self._input.values[np.newaxis, :], sigmas=sigmas)
+        else:
+            new_values = np.array([gaussian_filter1d(input=self._input.values, sigma=sigma) for sigma in sigmas])
 
-        output = Spectrum(wavelengths=self._input.wavelengths,
-                          values=new_values,
-                          value_errors=self._input.value_errors,
-                          metadata=self._input.metadata.copy()
-                          )
+        output = SpectrumArray(wavelengths=self._input.wavelengths,
+                               values=new_values,
+                               value_errors=np.repeat(self._input.value_errors[np.newaxis, :], len(sigmas), axis=0),
+                               metadata_list=[self._input.metadata.copy() for sigma in sigmas]
+                               )
 
         if self._input.mask_set:
             output.copy_mask_from(self._input)
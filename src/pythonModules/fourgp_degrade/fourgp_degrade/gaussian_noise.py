@@ -10,7 +10,7 @@ and we treat each arm separately.
 import numpy as np
 import logging
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray
 from .convolve import SpectrumConvolver
 from .resample import SpectrumResampler
 from .spectrum_properties import SpectrumProperties
@@ -92,16 +92,17 @@ class GaussianNoise:
         for spectrum in spectra_list:
 
             # Convolve and resample onto new wavelength raster.
-            # Each wavelength arm is separately convolved by mean pixel spacing.
-            resampled_spectrum = []  # resampled_spectrum[ 0=full spectrum ; 1=continuum normalised ][ wavelength_arm ]
-            for index, item in enumerate(spectrum):
-                resampled_spectrum.append([])
-                for (raster, pixel_spacing) in self.wavelength_arms:
-                    convolver = SpectrumConvolver(item)
-                    convolved = convolver.gaussian_convolve(pixel_spacing)
-                    resampler = SpectrumResampler(convolved)
-                    resampled = resampler.onto_raster(raster)
-                    resampled_spectrum[-1].append(resampled.values)
+            # Each wavelength arm is separately convolved by mean pixel spacing. The full and continuum-normalised
+            # spectra are convolved and resampled together in a single operation.
+            spectrum_array = SpectrumArray.from_spectra(list(spectrum))
+            resampled_spectrum = [[] for item in spectrum]  # [ 0=full spectrum ; 1=continuum normalised ][ arm ]
+            for (raster, pixel_spacing) in self.wavelength_arms:
+                convolver = SpectrumConvolver(spectrum_array)
+                convolved = convolver.gaussian_convolve(pixel_spacing)
+                resampler = SpectrumResampler(convolved)
+                resampled = resampler.onto_raster(raster)
+                for index in range(len(spectrum)):
+                    resampled_spectrum[index].append(resampled.values[index])
 
             # Calculate continuum spectrum by dividing the flux normalised spectrum by continuum normalised spectrum
             continuum_per_arm = []
@@ -1,19 +1,177 @@
 # -*- coding: utf-8 -*-
 
+import threading
+from collections import OrderedDict
 import numpy as np
+import scipy.sparse
 
-from fourgp_speclib import Spectrum
+from fourgp_speclib import Spectrum, SpectrumArray, hash_raster
+
+
+class ResamplingPlan(object):
+    """
+    A sparse matrix which resamples spectra from one wavelength raster onto another. The flux in each output pixel is
+    the mean of the flux in the input spectrum across the span of that pixel. This is a linear function of the input
+    pixels, so once the matrix has been built, any number of spectra can be resampled between the same pair of rasters
+    by a single sparse matrix multiplication.
+
+    :ivar matrix:
+        Sparse matrix of shape [output pixel count, input pixel count].
+    """
+
+    def __init__(self, input_raster, output_raster):
+        """
+        Build a plan for resampling spectra from <input_raster> onto <output_raster>. Both rasters must be in
+        increasing order of wavelength.
+
+        :param input_raster:
+            The existing raster of wavelengths
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The new raster of wavelengths
+
+        :type output_raster:
+            np.ndarray
+        """
+
+        x_in = np.asarray(input_raster)
+        x_new = np.asarray(output_raster)
+
+        # Make sure that input data is sensible
+        assert x_in.ndim == 1, \
+            "Input x array should have exactly one dimension. Passed array has {} dimensions".format(x_in.ndim)
+        assert x_in.shape[0] > 3, \
+            "Input spectrum must have at least three pixels for resampling to produce sensible output"
+        assert x_new.ndim == 1, \
+            "New x array should have exactly one dimension. Passed array has {} dimensions".format(x_new.ndim)
+
+        # Make an array of the left edge of each pixel in the input raster. The final entry is the right-edge of the
+        # last pixel, so if we have N input pixels, we output N+1 left edges (length N+1)
+        x_in_pixel_left_edges = SpectrumResampler._pixel_left_edges(x_in)
+        x_in_pixel_width = SpectrumResampler._pixel_widths(x_in_pixel_left_edges)
+
+        # Do the same for the output raster
+        x_new_pixel_left_edges = SpectrumResampler._pixel_left_edges(x_new)
+        x_new_pixel_width = SpectrumResampler._pixel_widths(x_new_pixel_left_edges)
+
+        # The integrated flux leftwards of wavelength x is the sum of the flux in all the input pixels to the left of
+        # the input pixel k which contains x, plus a fraction t of the flux in pixel k. Wavelengths beyond the ends of
+        # the input raster include none or all of the input flux.
+        input_count = x_in.shape[0]
+        k = np.clip(np.searchsorted(x_in_pixel_left_edges, x_new_pixel_left_edges, side='right') - 1, 0, input_count)
+        t = np.zeros(x_new_pixel_left_edges.shape[0])
+        inside = k < input_count
+        t[inside] = np.clip((x_new_pixel_left_edges[inside] - x_in_pixel_left_edges[k[inside]]) /
+                            x_in_pixel_width[k[inside]], 0, 1)
+
+        # Output pixel i therefore contains the whole of input pixels k_left to k_right - 1, minus a fraction t_left of
+        # input pixel k_left, plus a fraction t_right of input pixel k_right
+        k_left, k_right = k[:-1], k[1:]
+        t_left, t_right = t[:-1], t[1:]
+        assert np.all(k_right >= k_left), "Output raster must be in increasing order of wavelength"
+
+        counts = k_right - k_left + 1
+        starts = np.cumsum(counts) - counts
+        rows = np.repeat(np.arange(x_new.shape[0]), counts)
+        columns = np.repeat(k_left, counts) + np.arange(rows.shape[0]) - np.repeat(starts, counts)
+
+        weights = np.ones(rows.shape[0])
+        weights[starts + counts - 1] = 0
+        weights[starts] -= t_left
+        weights[starts + counts - 1] += t_right
+
+        # Drop references to the right-hand edge of the last input pixel, and convert fractions of each input pixel's
+        # integrated flux into contributions to the mean flux density within each output pixel
+        valid = columns < input_count
+        rows, columns, weights = rows[valid], columns[valid], weights[valid]
+        weights *= x_in_pixel_width[columns] / x_new_pixel_width[rows]
+
+        self.matrix = scipy.sparse.csr_matrix((weights, (rows, columns)), shape=(x_new.shape[0], input_count))
+
+    def apply(self, values):
+        """
+        Resample a spectrum, or an array of spectra, using this plan.
+
+        :param values:
+            Either a 1D array containing a single spectrum, or a 2D array with one spectrum in each row.
+
+        :type values:
+            np.ndarray
+
+        :return:
+            A numpy array containing the resampled spectrum or spectra on the new raster
+        """
+
+        values = np.asarray(values)
+        assert values.shape[-1] == self.matrix.shape[1], \
+            "Input x and y vectors have different lengths"
+
+        if values.ndim == 1:
+            return self.matrix.dot(values)
+        return np.ascontiguousarray(self.matrix.dot(values.T).T)
 
 
 class SpectrumResampler(object):
     """
-    A class containing utility functions for resampling spectra onto different wavelength rasters
+    A class containing utility functions for resampling spectra onto different wavelength rasters. It can also
+    resample every spectrum in a SpectrumArray in a single operation.
+
+    The resampling plans for recently used pairs of rasters are cached, so that spectra which are repeatedly resampled
+    onto the same raster only pay the cost of working out the resampling once.
     """
 
+    # Resampling plans which have been used recently, indexed by the hashes of their input and output rasters
+    _plans = OrderedDict()
+    _plans_lock = threading.Lock()
+    plan_cache_size = 32
+
     def __init__(self, input_spectrum):
-        assert isinstance(input_spectrum, Spectrum), "The SpectrumResampler class can only operate on Spectrum objects."
+        assert isinstance(input_spectrum, (Spectrum, SpectrumArray)), \
+            "The SpectrumResampler class can only operate on Spectrum or SpectrumArray objects."
         self._input = input_spectrum
 
+    @classmethod
+    def plan(cls, input_raster, output_raster):
+        """
+        Fetch a plan for resampling spectra from one raster onto another, building it if it is not already cached.
+
+        :param input_raster:
+            The existing raster of wavelengths
+
+        :type input_raster:
+            np.ndarray
+
+        :param output_raster:
+            The new raster of wavelengths
+
+        :type output_raster:
+            np.ndarray
+
+        :return:
+            ResamplingPlan object
+        """
+
+        input_raster = np.asarray(input_raster)
+        output_raster = np.asarray(output_raster)
+        key = (hash_raster(input_raster), hash_raster(output_raster))
+
+        with cls._plans_lock:
+            plan = cls._plans.get(key)
+            if plan is not None:
+                cls._plans.move_to_end(key)
+                return plan
+
+        plan = ResamplingPlan(input_raster=input_raster, output_raster=output_raster)
+
+        with cls._plans_lock:
+            cls._plans[key] = plan
+            while len(cls._plans) > cls.plan_cache_size:
+                cls._plans.popitem(last=False)
+        return plan
+
     @staticmethod
     def _pixel_left_edges(raster):
         """
@@ -90,52 +248,16 @@ class SpectrumResampler(object):
             A numpy array containing the resampled spectrum on the new raster
         """
 
-        # Make sure that input arrays are numpy objects
-        x_in = np.asarray(x_in)
         y_in = np.asarray(y_in)
-        x_new = np.asarray(x_new)
-
-        # Make sure that input data is sensible
-        assert x_in.ndim == 1, \
-            "Input x array should have exactly one dimension. Passed array has {} dimensions".format(x_in.ndim)
         assert y_in.ndim == 1, \
             "Input y array should have exactly one dimension. Passed array has {} dimensions".format(y_in.ndim)
-        assert x_in.shape[0] > 3, \
-            "Input spectrum must have at least three pixels for resampling to produce sensible output"
-        assert x_in.shape == y_in.shape, \
-            "Input x and y vectors have different lengths"
-        assert x_new.ndim == 1, \
-            "New x array should have exactly one dimension. Passed array has {} dimensions".format(x_new.ndim)
-
-        # Make an array of the left edge of each pixel in the input raster. The final entry is the right-edge of the
-        # last pixel, so if we have N input pixels, we output N+1 left edges (length N+1)
-        x_in_pixel_left_edges = SpectrumResampler._pixel_left_edges(x_in)
 
-        # Compute the width of each pixel in the input raster (length N)
-        x_in_pixel_width = SpectrumResampler._pixel_widths(x_in_pixel_left_edges)
-
-        # Do the same for the output raster
-        x_new_pixel_left_edges = SpectrumResampler._pixel_left_edges(x_new)
-        x_new_pixel_width = SpectrumResampler._pixel_widths(x_new_pixel_left_edges)
-
-        # Create an array of the integrated flux per A leftwards of wavelength i in <x_in_pixel_left_edges> (length N+1)
-        x_in_integrated = np.cumsum(np.insert(y_in * x_in_pixel_width, 0, 0))
-
-        # Create an array of the integrated flux within each pixel of the output array, divided by the pixel's width
-        y_new = (np.interp(xp=x_in_pixel_left_edges,
-                           fp=x_in_integrated,
-                           x=x_new_pixel_left_edges[1:]) -
-                 np.interp(xp=x_in_pixel_left_edges,
-                           fp=x_in_integrated,
-                           x=x_new_pixel_left_edges[:-1])
-                 ) / x_new_pixel_width
-
-        # Return output
-        return y_new
+        return SpectrumResampler.plan(input_raster=x_in, output_raster=x_new).apply(y_in)
 
     def onto_raster(self, output_raster, resample_errors=True, resample_mask=True):
         """
-        Resample this spectrum onto a user-specified wavelength raster.
+        Resample this spectrum onto a user-specified wavelength raster. If the input is a SpectrumArray, all of its
+        spectra are resampled in a single operation.
 
         :param output_raster:
             The raster we should resample this Spectrum onto.
@@ -149,30 +271,33 @@ class SpectrumResampler(object):
             the function will return 30% quicker.
 
         :return:
-            New Spectrum object.
+            New Spectrum object, or a new SpectrumArray object if the input is a SpectrumArray.
         """
 
-        new_values = self._resample(x_new=output_raster,
-                                    x_in=self._input.wavelengths,
-                                    y_in=self._input.values)
+        plan = self.plan(input_raster=self._input.wavelengths, output_raster=output_raster)
+
+        new_values = plan.apply(self._input.values)
 
         if resample_errors:
-            new_value_errors = self._resample(x_new=output_raster,
-                                              x_in=self._input.wavelengths,
-                                              y_in=self._input.value_errors)
+            new_value_errors = plan.apply(self._input.value_errors)
         else:
             new_value_errors = np.zeros_like(new_values)
 
-        output = Spectrum(wavelengths=output_raster,
-                          values=new_values,
-                          value_errors=new_value_errors,
-                          metadata=self._input.metadata.copy()
-                          )
+        if isinstance(self._input, SpectrumArray):
+            output = SpectrumArray(wavelengths=output_raster,
+                                   values=new_values,
+                                   value_errors=new_value_errors,
+                                   metadata_list=[item.copy() for item in self._input.metadata_list]
+                                   )
+        else:
+            output = Spectrum(wavelengths=output_raster,
+                              values=new_values,
+                              value_errors=new_value_errors,
+                              metadata=self._input.metadata.copy()
+                              )
 
         if resample_mask and self._input.mask_set:
-            output.mask = self._resample(x_new=output_raster,
-                                         x_in=self._input.wavelengths,
-                                         y_in=self._input.mask) > 0.5
+            output.mask = plan.apply(self._input.mask.astype(np.float64)) > 0.5
             output.mask_set = not np.all(output.mask)
 
         return output
@@ -182,7 +307,7 @@ class SpectrumResampler(object):
         Resample this spectrum onto the wavelength raster of another Spectrum object.
 
         :param other:
-            The other Spectrum object whose raster we should resample this Spectrum onto.
+            The other Spectrum (or SpectrumArray) object whose raster we should resample this Spectrum onto.
 
         :param resample_errors:
             Should we bother resampling the errors as well as the data itself? If not, the errors will be meaningless
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the SpectrumConvolver class
+"""
+
+import unittest
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+import fourgp_speclib
+from fourgp_degrade import SpectrumConvolver
+from fourgp_degrade.convolve import fft_gaussian_filter
+
+
+class TestSpectrumConvolver(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a Spectrum object to convolve.
+        """
+
+        self._size = 400
+        self._spectrum = fourgp_speclib.Spectrum(wavelengths=np.linspace(5000, 5100, self._size),
+                                                 values=np.random.random(self._size) + 1,
+                                                 value_errors=np.random.random(self._size),
+                                                 metadata={"origin": "unit-test"})
+
+    def test_fft_matches_direct_filter(self):
+        """
+        Check that convolving using FFTs gives the same results as <gaussian_filter1d>, including at the ends of the
+        spectrum.
+        """
+
+        sigmas = [0.5, 3, 12, 40]
+        values = fft_gaussian_filter(values=self._spectrum.values[np.newaxis, :], sigmas=sigmas)
+        for sigma, row in zip(sigmas, values):
+            self.assertTrue(np.allclose(row, gaussian_filter1d(self._spectrum.values, sigma=sigma), atol=1e-12))
+
+        for method in ("direct", "fft"):
+            output = SpectrumConvolver(self._spectrum).gaussian_convolve(sigma=12, method=method)
+            self.assertTrue(np.allclose(output.values, values[2], atol=1e-12))
+
+    def test_convolve_many(self):
+        """
+        Check that convolving with many PSFs at once matches convolving with each in turn, and returns an array which
+        can be modified in place.
+        """
+
+        sigmas = [2, 5, 20]
+        for method in ("direct", "fft"):
+            output = SpectrumConvolver(self._spectrum).gaussian_convolve_many(sigmas=sigmas, method=method)
+            for sigma, row in zip(sigmas, output.values):
+                self.assertTrue(np.allclose(row, gaussian_filter1d(self._spectrum.values, sigma=sigma), atol=1e-12))
+
+            self.assertTrue(output.value_errors.flags.writeable)
+            output *= self._spectrum
+            self.assertTrue(np.allclose(output.values[0], np.asarray(gaussian_filter1d(self._spectrum.values, sigma=2))
+                                        * self._spectrum.values))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the SpectrumResampler class
+"""
+
+import unittest
+import numpy as np
+import fourgp_speclib
+from fourgp_degrade import SpectrumResampler, ResamplingPlan
+
+
+class TestSpectrumResampler(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a SpectrumArray object to resample.
+        """
+
+        self._size = 300
+        self._count = 3
+        raster = np.cumsum(np.random.random(self._size) + 0.5) + 5000
+        self._array = fourgp_speclib.SpectrumArray(wavelengths=raster,
+                                                   values=np.random.random((self._count, self._size)) + 1,
+                                                   value_errors=np.random.random((self._count, self._size)),
+                                                   metadata_list=[{"index": i} for i in range(self._count)])
+
+    def test_plan_matches_direct_resampling(self):
+        """
+        Check that resampling with a sparse matrix gives the same results as integrating each spectrum directly,
+        for output rasters which are finer, coarser, and which extend beyond the ends of the input raster.
+        """
+
+        raster = self._array.wavelengths
+        for output_raster in (np.linspace(raster[0], raster[-1], 3 * self._size),
+                              np.linspace(raster[10], raster[-10], self._size // 7),
+                              np.linspace(raster[0] - 50, raster[-1] + 50, self._size)):
+            plan = ResamplingPlan(input_raster=raster, output_raster=output_raster)
+            resampled = plan.apply(self._array.values)
+            for i in range(self._count):
+                expected = SpectrumResampler._resample(x_new=output_raster, x_in=raster, y_in=self._array.values[i])
+                self.assertTrue(np.allclose(resampled[i], expected, rtol=0, atol=1e-10))
+                self.assertTrue(np.allclose(plan.apply(self._array.values[i]), expected, rtol=0, atol=1e-10))
+
+    def test_resample_array(self):
+        """
+        Check that resampling a SpectrumArray matches resampling each of its spectra in turn, and that plans are
+        reused between calls.
+        """
+
+        output_raster = np.linspace(self._array.wavelengths[5], self._array.wavelengths[-5], 200)
+        output = SpectrumResampler(self._array).onto_raster(output_raster)
+        for i in range(self._count):
+            expected = SpectrumResampler(self._array.extract_item(i)).onto_raster(output_raster)
+            self.assertTrue(np.allclose(output.values[i], expected.values))
+            self.assertTrue(np.allclose(output.value_errors[i], expected.value_errors))
+
+        self.assertIs(SpectrumResampler.plan(self._array.wavelengths, output_raster),
+                      SpectrumResampler.plan(self._array.wavelengths, output_raster))
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
@@ -226,11 +226,12 @@ class RvInstanceBrani(object):
         template_resampled = interpolator.match_to_other_spectrum(other=observed_spectrum,
                                                                   interpolate_errors=False, interpolate_mask=False)
 
-        # Multiply the template spectrum by the observed spectrum's continuum
+        # Multiply the template spectrum by the observed spectrum's continuum. The resampled template is a temporary
+        # spectrum, so we overwrite it rather than allocating new arrays.
         template_continuum = fourgp_speclib.SpectrumPolynomial(wavelengths=template_resampled.wavelengths,
                                                                terms=3,
                                                                coefficients=(c0, c1, c2))
-        template_with_continuum = template_continuum * template_resampled
+        template_with_continuum = template_continuum.multiply(template_resampled, out=template_resampled)
 
         # Mask out bad data
         mask = (observed_spectrum.mask * np.isfinite(observed_spectrum.values) * (observed_spectrum.value_errors > 0) *
@@ -11,9 +11,10 @@ from warnings import simplefilter
 
 from .spectrum_library_sqlite import SpectrumLibrarySqlite
 from .spectrum_library import SpectrumLibrary
-from .spectrum_array import SpectrumArray
-from .spectrum import Spectrum, spectrum_splice, hash_numpy_array
+from .spectrum_array import SpectrumArray, LazySpectrumArray
+from .spectrum import Spectrum, spectrum_splice, hash_numpy_array, hash_raster, forget_raster_hash, same_raster
 from .spectrum_smooth import SpectrumSmoothFactory, SpectrumSmooth, SpectrumPolynomial
+from .connection_pool import ConnectionPool, ConnectionPoolTimeout
 
 # Allow MySQL binding to silently fail if system doesn't have MySQLdb package installed
 try:
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Check the integrity of a spectrum library, remove files left behind by interrupted imports, and compact its database.
+"""
+
+import argparse
+import json
+import logging
+from os import path as os_path
+
+from .spectrum_library_sqlite import SpectrumLibrarySqlite
+
+
+def command_line_interface():
+    """
+    A simple command-line interface for running the spectrum library compaction tool.
+
+    We use the python argparse module to build the interface, and return the inputs supplied by the user.
+
+    :return:
+        An object containing the arguments supplied by the user.
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--library', required=True, nargs='+', dest='libraries',
+                        help="Name of the spectrum library (or libraries) to compact.")
+    parser.add_argument('--workspace', dest='workspace', default="",
+                        help="Directory where we expect to find spectrum libraries.")
+    parser.add_argument('--orphans', choices=("keep", "remove", "reattach"), default="remove", dest='orphans',
+                        help="What to do with files which the library's database does not refer to.")
+    parser.add_argument('--remove-missing', action='store_true', dest='remove_missing',
+                        help="Remove spectra whose files are missing from the library's database.")
+    parser.add_argument('--no-optimise', action='store_false', dest='optimise',
+                        help="Do not rebuild the database's indices, or release its unused space.")
+    parser.add_argument('--workers', type=int, default=None, dest='workers',
+                        help="Number of files to inspect concurrently.")
+    parser.add_argument('--dry-run', action='store_true', dest='dry_run',
+                        help="Report problems without changing anything.")
+    parser.add_argument('--db-user', dest='db_user', default="fourgp",
+                        help="Username for the MySQL server, used for libraries stored in MySQL.")
+    parser.add_argument('--db-passwd', dest='db_passwd', default="fourgp",
+                        help="Password for the MySQL server, used for libraries stored in MySQL.")
+    parser.add_argument('--db-name', dest='db_name', default="fourgp",
+                        help="Name of the MySQL database, used for libraries stored in MySQL.")
+    parser.add_argument('--db-host', dest='db_host', default="localhost",
+                        help="Hostname of the MySQL server, used for libraries stored in MySQL.")
+    return parser.parse_args()
+
+
+def open_library(library_path, args):
+    """
+    Open a spectrum library, using whichever SQL implementation it was created with.
+
+    :param library_path:
+        The path of the spectrum library.
+
+    :type library_path:
+        str
+
+    :param args:
+        The arguments supplied on the command line, which give the connection details for MySQL libraries.
+
+    :return:
+        SpectrumLibrarySql
+    """
+
+    with open(os_path.join(library_path, "library_props")) as f:
+        library_type = json.loads(f.read())['type_id']
+
+    if library_type == "SpectrumLibraryMySql":
+        # Only import MySQL support if it is needed, since the MySQLdb package is optional
+        from .spectrum_library_mysql import SpectrumLibraryMySql
+        return SpectrumLibraryMySql(path=library_path, db_user=args.db_user, db_passwd=args.db_passwd,
+                                    db_name=args.db_name, db_host=args.db_host)
+
+    assert library_type == "SpectrumLibrarySqlite", \
+        "Spectrum library <{}> uses unknown implementation <{}>.".format(library_path, library_type)
+    return SpectrumLibrarySqlite(path=library_path)
+
+
+def main():
+    """
+    Compact each of the spectrum libraries named on the command line, and print a report about each one.
+
+    :return:
+        None
+    """
+    logging.basicConfig(level=logging.INFO, format='[%(asctime)s] %(levelname)s:%(filename)s:%(message)s',
+                        datefmt='%d/%m/%Y %H:%M:%S')
+    logger = logging.getLogger(__name__)
+    args = command_line_interface()
+
+    for library_name in args.libraries:
+        library_path = os_path.join(args.workspace, library_name)
+        logger.info("Compacting spectrum library <{}>".format(library_path))
+        library = open_library(library_path=library_path, args=args)
+        report = library.compact(orphans=args.orphans, remove_missing=args.remove_missing, optimise=args.optimise,
+                                 workers=args.workers, dry_run=args.dry_run)
+        library.close()
+        print(json.dumps({"library": library_name, "report": report}, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
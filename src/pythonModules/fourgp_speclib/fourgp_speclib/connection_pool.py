@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+
+class ConnectionPoolTimeout(RuntimeError):
+    """
+    Exception raised when no connection is returned to a full pool before a timeout expires.
+    """
+    pass
+
+
+class ConnectionPool(object):
+    """
+    A pool of open database connections, which spectrum libraries borrow from rather than connecting to the database
+    server afresh each time a library is opened. Pools are shared by all the spectrum libraries in a process which
+    connect to the same database, and can be looked up with <ConnectionPool.get>.
+
+    :cvar dict _pools:
+        All of the pools which have been created in this process, indexed by (process id, key)
+
+    :cvar _pools_lock:
+        Lock which must be held while looking up pools in <_pools>
+
+    :ivar _connect:
+        Function which opens a new database connection
+
+    :ivar _health_check:
+        Function which tests whether a connection is still usable, either by returning False or raising an exception
+        if it is not, or None to skip health checks
+
+    :ivar int _max_size:
+        The maximum number of connections which may be open at once, including both idle and borrowed connections
+
+    :ivar list _idle:
+        Connections which are open, but not currently borrowed
+
+    :ivar int _size:
+        The number of connections which are currently open
+
+    :ivar _condition:
+        Condition variable used to wait for a connection to be returned to the pool
+    """
+
+    _pools = {}
+
+    _pools_lock = threading.Lock()
+
+    def __init__(self, connect, health_check=None, max_size=8):
+        """
+        Create a new pool of database connections.
+
+        :param connect:
+            Function which takes no arguments and returns a new database connection.
+
+        :type connect:
+            callable
+
+        :param health_check:
+            Function which takes a connection, and returns False or raises an exception if it is no longer usable
+            (for example, because the server has closed it). Set to None to skip health checks.
+
+        :type health_check:
+            callable or None
+
+        :param max_size:
+            The maximum number of connections which may be open at once.
+
+        :type max_size:
+            int
+        """
+
+        assert max_size > 0, "A connection pool must allow at least one connection."
+
+        self._connect = connect
+        self._health_check = health_check
+        self._max_size = max_size
+        self._idle = []
+        self._size = 0
+        self._condition = threading.Condition()
+
+    @classmethod
+    def get(cls, key, connect, health_check=None, max_size=8):
+        """
+        Look up the pool of connections to a particular database, creating it if it doesn't already exist. Pools are
+        not shared with child processes, since database connections cannot safely be shared between processes.
+
+        :param key:
+            A hashable description of the database, for example a tuple of (host, user, database name).
+
+        :param connect:
+            Function which takes no arguments and returns a new database connection, used if the pool is created.
+
+        :type connect:
+            callable
+
+        :param health_check:
+            Function used to test whether connections are still usable, used if the pool is created.
+
+        :type health_check:
+            callable or None
+
+        :param max_size:
+            The maximum number of connections which may be open at once, used if the pool is created.
+
+        :type max_size:
+            int
+
+        :return:
+            ConnectionPool
+        """
+
+        with cls._pools_lock:
+            pool_key = (os.getpid(), key)
+            if pool_key not in cls._pools:
+                cls._pools[pool_key] = cls(connect=connect, health_check=health_check, max_size=max_size)
+            return cls._pools[pool_key]
+
+    @classmethod
+    def close_all_pools(cls):
+        """
+        Close all of the idle connections in all of the pools in this process.
+
+        :return:
+            None
+        """
+
+        with cls._pools_lock:
+            pools = [pool for key, pool in cls._pools.items() if key[0] == os.getpid()]
+        for pool in pools:
+            pool.close_idle()
+
+    def __len__(self):
+        """
+        Return the number of connections which are currently open, including idle connections.
+
+        :return:
+            int
+        """
+
+        return self._size
+
+    @property
+    def idle_count(self):
+        """
+        The number of open connections which are waiting in the pool to be borrowed.
+
+        :return:
+            int
+        """
+
+        return len(self._idle)
+
+    def _is_healthy(self, connection):
+        """
+        Test whether an idle connection is still usable.
+
+        :param connection:
+            The connection to test.
+
+        :return:
+            bool
+        """
+
+        if self._health_check is None:
+            return True
+        try:
+            return self._health_check(connection) is not False
+        except Exception as error:
+            logger.info("Discarding database connection which failed health check: {}".format(error))
+            return False
+
+    @staticmethod
+    def _close_connection(connection):
+        """
+        Close a connection, ignoring any errors if it is already broken.
+
+        :param connection:
+            The connection to close.
+
+        :return:
+            None
+        """
+
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self, timeout=None):
+        """
+        Borrow a connection from the pool. If the pool already has <max_size> connections open, wait for one to be
+        returned.
+
+        :param timeout:
+            The maximum number of seconds to wait for a connection, or None to wait indefinitely. If this expires,
+            <ConnectionPoolTimeout> is raised.
+
+        :type timeout:
+            float or None
+
+        :return:
+            A database connection, which should be returned with <release> when it is no longer needed.
+        """
+
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._condition:
+            while True:
+                # Reuse an idle connection if we have one which still works
+                while self._idle:
+                    connection = self._idle.pop()
+                    if self._is_healthy(connection):
+                        return connection
+                    self._close_connection(connection)
+                    self._size -= 1
+
+                # Open a new connection if we are allowed to
+                if self._size < self._max_size:
+                    self._size += 1
+                    break
+
+                # Otherwise wait for a connection to be returned
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    raise ConnectionPoolTimeout("Timed out waiting for a database connection. All {:d} connections in "
+                                                "the pool are in use.".format(self._max_size))
+                self._condition.wait(remaining)
+
+        # Connect outside the lock, since it may be slow
+        try:
+            return self._connect()
+        except Exception:
+            with self._condition:
+                self._size -= 1
+                self._condition.notify()
+            raise
+
+    def release(self, connection):
+        """
+        Return a borrowed connection to the pool. Any uncommitted changes are rolled back.
+
+        :param connection:
+            The connection to return.
+
+        :return:
+            None
+        """
+
+        try:
+            connection.rollback()
+        except Exception:
+            self.discard(connection)
+            return
+
+        with self._condition:
+            self._idle.append(connection)
+            self._condition.notify()
+
+    def discard(self, connection):
+        """
+        Close a borrowed connection rather than returning it to the pool, for example because it is broken.
+
+        :param connection:
+            The connection to close.
+
+        :return:
+            None
+        """
+
+        self._close_connection(connection)
+        with self._condition:
+            self._size -= 1
+            self._condition.notify()
+
+    def close_idle(self):
+        """
+        Close all of the idle connections in the pool. Borrowed connections are unaffected.
+
+        :return:
+            None
+        """
+
+        with self._condition:
+            idle = self._idle
+            self._idle = []
+            self._size -= len(idle)
+            self._condition.notify_all()
+        for connection in idle:
+            self._close_connection(connection)
@@ -6,13 +6,29 @@ import numpy as np
 import scipy.integrate
 import hashlib
 import logging
+import threading
+import weakref
+
+from .spectrum_codec import read_compressed_spectrum, write_compressed_spectrum
 
 logger = logging.getLogger(__name__)
 
+# Hashes of the wavelength rasters we have seen, indexed by the id() of each numpy array. Each entry holds a weak
+# reference to the array, so that a new array which reuses the id of one which has been garbage collected is not
+# mistaken for it.
+_raster_hashes = {}
+
+# Scratch memory used by <propagate_product>, which is reused by later calls from the same thread
+_scratch = threading.local()
+
+# The largest scratch array, in bytes, which each thread keeps for reuse. This comfortably holds a single spectrum.
+_scratch_buffer_max_bytes = 16 * 1024 * 1024
+
 
 def hash_numpy_array(item):
     """
-    Efficiently produce a string hash of a numpy array, for quick checking of whether arrays match.
+    Efficiently produce a string hash of a numpy array, for quick checking of whether arrays match. The array is only
+    copied if it is not already contiguous in memory.
     
     :param item:
         Any numpy array
@@ -23,10 +39,150 @@ def hash_numpy_array(item):
     :return:
         String hash
     """
-    raw = item.copy().view(np.uint8)
+    raw = np.ascontiguousarray(item).view(np.uint8)
     return hashlib.sha1(raw).hexdigest()
 
 
+def hash_raster(wavelengths):
+    """
+    Return the string hash of a wavelength raster, as produced by <hash_numpy_array>. The hash of each numpy array is
+    cached, so that spectra which share the same raster array only hash it once. Rasters must therefore not be
+    modified in place after they have been hashed, unless <forget_raster_hash> is called afterwards.
+
+    :param wavelengths:
+        The wavelength raster to hash.
+
+    :type wavelengths:
+        np.ndarray
+
+    :return:
+        String hash
+    """
+
+    key = id(wavelengths)
+    entry = _raster_hashes.get(key)
+    if entry is not None and entry[0]() is wavelengths:
+        return entry[1]
+
+    output = hash_numpy_array(wavelengths)
+
+    def discard(reference):
+        if _raster_hashes.get(key, (None,))[0] is reference:
+            _raster_hashes.pop(key, None)
+
+    _raster_hashes[key] = (weakref.ref(wavelengths, discard), output)
+    return output
+
+
+def forget_raster_hash(wavelengths):
+    """
+    Discard the cached hash of a wavelength raster, for example because it has been modified in place.
+
+    :param wavelengths:
+        The wavelength raster whose hash should be discarded.
+
+    :type wavelengths:
+        np.ndarray
+
+    :return:
+        None
+    """
+    _raster_hashes.pop(id(wavelengths), None)
+
+
+def _scratch_buffer(shape, dtype):
+    """
+    Return a temporary array of the requested shape and type, reusing memory allocated by earlier calls from the same
+    thread where possible. Only arrays of up to <_scratch_buffer_max_bytes> are kept for reuse; larger arrays are
+    allocated afresh each time, so that they are released as soon as the caller is finished with them.
+
+    :param shape:
+        The shape of the array.
+
+    :param dtype:
+        The data type of the array.
+
+    :return:
+        np.ndarray
+    """
+
+    dtype = np.dtype(dtype)
+    size = int(np.prod(shape))
+    if size * dtype.itemsize > _scratch_buffer_max_bytes:
+        return np.empty(shape, dtype=dtype)
+
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.dtype != dtype or buffer.size < size:
+        buffer = np.empty(size, dtype=dtype)
+        _scratch.buffer = buffer
+    return buffer[:size].reshape(shape)
+
+
+def propagate_product(operation, values_a, errors_a, values_b, errors_b, out=None):
+    """
+    Multiply or divide two sets of values, and propagate their standard errors, without allocating any temporary
+    arrays. The fractional errors in the result are the fractional errors in the inputs, added in quadrature.
+
+    :param operation:
+        Either np.multiply or np.divide.
+
+    :param values_a:
+        The values on the left-hand side of the operation.
+
+    :param errors_a:
+        The standard errors in <values_a>.
+
+    :param values_b:
+        The values on the right-hand side of the operation, which may be broadcast against <values_a>.
+
+    :param errors_b:
+        The standard errors in <values_b>.
+
+    :param out:
+        Tuple of arrays (values, errors) to write the result into, which may be any of the input arrays. If None, new
+        arrays are allocated.
+
+    :type out:
+        tuple or None
+
+    :return:
+        Tuple of arrays (values, errors)
+    """
+
+    if out is None:
+        dtype = np.result_type(values_a, errors_a, values_b, errors_b, np.float32)
+        shape = np.broadcast(values_a, values_b).shape
+        out = (np.empty(shape, dtype=dtype), np.empty(shape, dtype=dtype))
+    out_values, out_errors = out
+
+    # Each input array is read before any output array which might share its memory is overwritten
+    scratch = _scratch_buffer(out_errors.shape, out_errors.dtype)
+    np.divide(errors_b, values_b, out=scratch)
+    np.divide(errors_a, values_a, out=out_errors)
+    np.hypot(out_errors, scratch, out=out_errors)
+    operation(values_a, values_b, out=out_values)
+    np.multiply(out_errors, out_values, out=out_errors)
+    np.abs(out_errors, out=out_errors)
+    return out
+
+
+def same_raster(a, b):
+    """
+    Test whether two spectra (or SpectrumArrays) are sampled on the same wavelength raster. Spectra which share the
+    same raster array are recognised without hashing it.
+
+    :param a:
+        The first spectrum.
+
+    :param b:
+        The second spectrum.
+
+    :return:
+        bool
+    """
+    return a.wavelengths is b.wavelengths or a.raster_hash == b.raster_hash
+
+
 def requires_common_raster(method):
     """
     A decorator for spectrum methods that require that another spectrum as an input and require it to be sampled on the
@@ -38,7 +194,7 @@ def requires_common_raster(method):
 
     def wrapper(spectrum, other, *args, **kwargs):
         assert isinstance(other, Spectrum), "Can only copy mask from another Spectrum object."
-        assert spectrum.raster_hash == other.raster_hash, \
+        assert same_raster(spectrum, other), \
             "Cannot do arithmetic on spectra sampled on a different wavelength rasters"
         return method(spectrum, other=other, *args, **kwargs)
 
@@ -89,9 +245,10 @@ class Spectrum(object):
         
     :ivar str raster_hash:
         A string hash of the wavelength raster, used to quickly check whether spectra are sampled on a common raster.
+        This is only computed when it is first needed.
     """
 
-    def __init__(self, wavelengths, values, value_errors, metadata=None):
+    def __init__(self, wavelengths, values, value_errors, metadata=None, raster_hash=None):
         """
         Instantiate a new Spectrum object.
         
@@ -118,7 +275,13 @@ class Spectrum(object):
             
         :type metadata:
             dict
-        
+
+        :param raster_hash:
+            The string hash of the wavelength raster, if it is already known, or None to compute it when it is first
+            needed.
+
+        :type raster_hash:
+            str or None
         """
 
         if metadata is None:
@@ -132,10 +295,11 @@ class Spectrum(object):
         self.metadata = metadata
 
         self._validate_data_dimensions()
-        self._update_raster_hash()
+        self._raster_hash = raster_hash
+        self._raster_source = wavelengths if raster_hash is not None else None
 
     @classmethod
-    def from_file(cls, filename, binary=True, columns=None, *args, **kwargs):
+    def from_file(cls, filename, binary=True, columns=None, compressed=False, *args, **kwargs):
         """
         Factory method to read a spectrum in from a text file.
         
@@ -157,6 +321,13 @@ class Spectrum(object):
 
         :type columns:
             list or tuple
+
+        :param compressed:
+            Boolean specifying whether the file is a compressed binary file written by <to_file> with a <codec> set. If
+            set, <binary> is ignored.
+
+        :type compressed:
+            bool
             
         :return:
             Spectrum object
@@ -164,8 +335,12 @@ class Spectrum(object):
 
         assert os_path.exists(filename), "File <{}> does not exist.".format(filename)
 
+        # Extract spectrum from a compressed binary file
+        if compressed:
+            wavelengths, values, value_errors = read_compressed_spectrum(filename)
+
         # Extract spectrum from a text file
-        if not binary:
+        elif not binary:
             # Work out which columns we are reading data from
             if columns is None:
                 columns = (0, 1, 2)
@@ -196,9 +371,11 @@ class Spectrum(object):
 
         return cls(wavelengths=wavelengths, values=values, value_errors=value_errors, *args, **kwargs)
 
-    def to_file(self, filename, binary=True, overwrite=False):
+    def to_file(self, filename, binary=True, overwrite=False, include_wavelengths=True, codec=None, dtype=None):
         """
         Dump a spectrum object to a text file, with three columns containing wavelengths, data values, and errors.
+
+        Spectrum libraries which store the wavelength raster separately can omit the first column.
         
         :param filename:
             Filename of text file to write.
@@ -217,6 +394,26 @@ class Spectrum(object):
 
         :type overwrite:
             bool
+
+        :param include_wavelengths:
+            Boolean specifying whether to include the wavelength raster in the file.
+
+        :type include_wavelengths:
+            bool
+
+        :param codec:
+            If set, store the spectrum in a compressed binary file using this codec (see <spectrum_codec>), rather
+            than in the format selected by <binary>.
+
+        :type codec:
+            str or None
+
+        :param dtype:
+            The floating-point type to store the data in binary files, or None to store it as it is held in memory.
+            Single precision is best avoided for files which include the wavelength raster.
+
+        :type dtype:
+            np.dtype or str or None
             
         :return:
             bool: Success
@@ -227,10 +424,16 @@ class Spectrum(object):
                 filename))
             return False
 
-        if not binary:
-            np.savetxt(filename, np.transpose([self.wavelengths, self.values, self.value_errors]))
+        columns = [self.wavelengths, self.values, self.value_errors]
+        if not include_wavelengths:
+            columns = columns[1:]
+
+        if codec is not None:
+            write_compressed_spectrum(filename=filename, rows=columns, codec=codec, dtype=dtype)
+        elif not binary:
+            np.savetxt(filename, np.transpose(columns))
         else:
-            np.save(filename, np.asarray([self.wavelengths, self.values, self.value_errors]))
+            np.save(filename, np.asarray(columns, dtype=dtype))
         return True
 
     def __str__(self):
@@ -264,9 +467,23 @@ class Spectrum(object):
             assert len(i.shape) == 1, "Input argument to Spectrum class was not a 1D numpy array"
             assert i.shape[0] == self.wavelengths.shape[0], "Input argument to Spectrum class were of differing lengths"
 
+    @property
+    def raster_hash(self):
+        # The hash is recomputed (or fetched from the cache) whenever a new raster array is assigned to <wavelengths>
+        if self._raster_source is not self.wavelengths:
+            self._raster_hash = hash_raster(self.wavelengths)
+            self._raster_source = self.wavelengths
+        return self._raster_hash
+
+    @raster_hash.setter
+    def raster_hash(self, value):
+        self._raster_hash = value
+        self._raster_source = self.wavelengths
+
     def _update_raster_hash(self):
         """
-        Update the internal string hash of the wavelength raster that this spectrum array is sampled on.
+        Update the internal string hash of the wavelength raster that this spectrum array is sampled on. This must be
+        called if the raster is modified in place.
         
         This hash is used to quickly check whether two spectra are sampled on the same raster before doing arithmetic
         operations on them.
@@ -274,7 +491,8 @@ class Spectrum(object):
         :return:
             None
         """
-        self.raster_hash = hash_numpy_array(self.wavelengths)
+        forget_raster_hash(self.wavelengths)
+        self._raster_source = None
 
     def copy(self):
         """
@@ -288,7 +506,7 @@ class Spectrum(object):
         new_values = self.values.copy()
         new_value_errors = self.value_errors.copy()
         output = Spectrum(wavelengths=new_wavelengths, values=new_values, value_errors=new_value_errors,
-                          metadata=self.metadata.copy())
+                          metadata=self.metadata.copy(), raster_hash=self.raster_hash)
 
         if self.mask_set:
             output.copy_mask_from(self)
@@ -604,9 +822,8 @@ class Spectrum(object):
             Spectrum object containing the sum of the two spectra.
         """
 
-        new_values = self.values * other.values
-        new_value_errors = np.hypot(self.value_errors / self.values, other.value_errors / other.values) * \
-                           np.abs(new_values)
+        new_values, new_value_errors = propagate_product(np.multiply, self.values, self.value_errors,
+                                                         other.values, other.value_errors)
 
         output = Spectrum(wavelengths=self.wavelengths, values=new_values, value_errors=new_value_errors)
         if self.mask_set or other.mask_set:
@@ -629,9 +846,8 @@ class Spectrum(object):
             Spectrum object containing the quotient of the two spectra.
         """
 
-        new_values = self.values / other.values
-        new_value_errors = np.hypot(self.value_errors / self.values, other.value_errors / other.values) * \
-                           np.abs(new_values)
+        new_values, new_value_errors = propagate_product(np.divide, self.values, self.value_errors,
+                                                         other.values, other.value_errors)
 
         output = Spectrum(wavelengths=self.wavelengths, values=new_values, value_errors=new_value_errors)
         if self.mask_set or other.mask_set:
@@ -654,10 +870,10 @@ class Spectrum(object):
             self
         """
 
-        new_values = self.values * other.values
-        self.value_errors = np.hypot(self.value_errors / self.values, other.value_errors / other.values) * \
-                            np.abs(new_values)
-        self.values = new_values
+        # The result is written into new arrays, so that any other spectra sharing our arrays are unaffected. Use
+        # <multiply> with <out> set to this spectrum to overwrite our arrays instead.
+        self.values, self.value_errors = propagate_product(np.multiply, self.values, self.value_errors,
+                                                           other.values, other.value_errors)
 
         if other.mask_set:
             self.mask *= other.mask  # Logical AND
@@ -680,13 +896,90 @@ class Spectrum(object):
             self
         """
 
-        new_values = self.values / other.values
-        self.value_errors = np.hypot(self.value_errors / self.values, other.value_errors / other.values) * \
-                            np.abs(new_values)
-        self.values = new_values
+        # The result is written into new arrays, so that any other spectra sharing our arrays are unaffected. Use
+        # <divide> with <out> set to this spectrum to overwrite our arrays instead.
+        self.values, self.value_errors = propagate_product(np.divide, self.values, self.value_errors,
+                                                           other.values, other.value_errors)
 
         if other.mask_set:
             self.mask *= other.mask  # Logical AND
             self.mask_set = True
 
         return self
+
+    def _product_into(self, operation, other, out):
+        """
+        Multiply or divide the values in this spectrum by the values in another, writing the result into the arrays of
+        the Spectrum <out>.
+
+        :return:
+            out
+        """
+
+        assert isinstance(out, Spectrum) and same_raster(out, self), \
+            "Can only write the result of arithmetic into a Spectrum sampled on the same wavelength raster."
+
+        propagate_product(operation, self.values, self.value_errors, other.values, other.value_errors,
+                          out=(out.values, out.value_errors))
+
+        if self.mask_set or other.mask_set:
+            out.mask = self.mask * other.mask  # Logical AND
+            out.mask_set = True
+        elif out.mask_set:
+            out.mask = np.ones_like(out.wavelengths, dtype=bool)
+            out.mask_set = False
+        return out
+
+    @requires_common_raster
+    def multiply(self, other, out=None):
+        """
+        Multiply the values in this spectrum by the values in another. If <out> is set, the result is written into
+        the arrays of an existing Spectrum -- which may be this spectrum or <other> -- so that no new arrays are
+        allocated. Any other spectra which share these arrays, for example other views of a SpectrumArray, also see
+        the result.
+
+        :param other:
+            The Spectrum object to multiply this one by.
+
+        :type other:
+            Spectrum
+
+        :param out:
+            The Spectrum to write the result into, or None to return a new Spectrum object.
+
+        :type out:
+            Spectrum or None
+
+        :return:
+            Spectrum object containing the product of the two spectra.
+        """
+
+        if out is None:
+            return self * other
+        return self._product_into(operation=np.multiply, other=other, out=out)
+
+    @requires_common_raster
+    def divide(self, other, out=None):
+        """
+        Divide the values in this spectrum by the values in another. If <out> is set, the result is written into the
+        arrays of an existing Spectrum, as with <multiply>.
+
+        :param other:
+            The Spectrum object to divide this one by.
+
+        :type other:
+            Spectrum
+
+        :param out:
+            The Spectrum to write the result into, or None to return a new Spectrum object.
+
+        :type out:
+            Spectrum or None
+
+        :return:
+            Spectrum object containing the quotient of the two spectra.
+        """
+
+        if out is None:
+            return self / other
+        return self._product_into(operation=np.divide, other=other, out=out)
@@ -3,14 +3,89 @@
 from os import path as os_path
 import numpy as np
 import logging
-from ctypes import c_double
+from ctypes import c_double, c_float
 from multiprocessing.sharedctypes import RawArray
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 
-from .spectrum import hash_numpy_array, Spectrum
+from .spectrum import hash_raster, forget_raster_hash, same_raster, propagate_product, Spectrum
+from .spectrum_codec import read_compressed_spectrum
 
 logger = logging.getLogger(__name__)
 
 
+def _read_spectrum_file(filename, binary, compressed=False, pixels=None):
+    """
+    Read the contents of a file containing a single spectrum. This is a module-level function so that it can be
+    dispatched to a pool of worker processes.
+
+    :param filename:
+        The filename of the file to read.
+
+    :type filename:
+        str
+
+    :param binary:
+        Boolean specifying whether the file is in binary format or plain text.
+
+    :type binary:
+        bool
+
+    :param compressed:
+        Boolean specifying whether the file is a compressed binary file written by <write_compressed_spectrum>. If
+        set, <binary> is ignored.
+
+    :type compressed:
+        bool
+
+    :param pixels:
+        The range of pixels to return, or None to return the whole spectrum. Only this range is read from uncompressed
+        binary files; other formats must be read in full.
+
+    :type pixels:
+        slice or None
+
+    :return:
+        2D numpy array, whose rows are the columns of data in the file.
+    """
+
+    assert os_path.exists(filename), "File <{}> does not exist.".format(filename)
+
+    if compressed:
+        data = np.asarray(read_compressed_spectrum(str(filename)))
+    elif not binary:
+        data = np.loadtxt(str(filename)).T
+    elif pixels is not None:
+        return np.array(np.load(str(filename), mmap_mode='r')[:, pixels])
+    else:
+        return np.load(str(filename))
+
+    if pixels is not None:
+        data = data[:, pixels]
+    return data
+
+
+def requires_common_raster_array(method):
+    """
+    A decorator for SpectrumArray methods that require another Spectrum or SpectrumArray as an input, and require it
+    to be sampled on the same wavelength raster as us. A SpectrumArray must also contain the same number of spectra as
+    us; a single Spectrum is applied to every spectrum in the array.
+
+    :param method:
+        A method belonging to SpectrumArray.
+    """
+
+    def wrapper(spectra, other, *args, **kwargs):
+        assert isinstance(other, (Spectrum, SpectrumArray)), \
+            "Can only do arithmetic with another Spectrum or SpectrumArray object."
+        assert same_raster(spectra, other), \
+            "Cannot do arithmetic on spectra sampled on a different wavelength rasters"
+        if isinstance(other, SpectrumArray):
+            assert len(spectra) == len(other), "Cannot do arithmetic on SpectrumArrays of different lengths."
+        return method(spectra, other=other, *args, **kwargs)
+
+    return wrapper
+
+
 class SpectrumArray(object):
     """
     An object representing an array of spectra.
@@ -26,6 +101,13 @@ class SpectrumArray(object):
         
     :ivar str raster_hash:
         A string hash of the wavelength raster, used to quickly check whether spectra are sampled on a common raster.
+        This is only computed when it is first needed.
+
+    :ivar np.ndarray mask:
+        A 1D array listing which wavelength samples we've currently selected to use, shared by all of the spectra.
+
+    :ivar bool mask_set:
+        Boolean selecting whether any wavelengths are currently masked out.
         
     :ivar list[dict] metadata_list:
         A list of dictionaries of metadata about each of the spectra in this SpectrumArray
@@ -34,7 +116,7 @@ class SpectrumArray(object):
         Boolean flag indicating whether this SpectrumArray uses multiprocessing shared memory.
     """
 
-    def __init__(self, wavelengths, values, value_errors, metadata_list, shared_memory=False):
+    def __init__(self, wavelengths, values, value_errors, metadata_list, shared_memory=False, raster_hash=None):
         """
         Instantiate new SpectrumArray object.
         
@@ -55,6 +137,13 @@ class SpectrumArray(object):
             
         :type shared_memory:
             bool
+
+        :param raster_hash:
+            The string hash of the wavelength raster, if it is already known, or None to compute it when it is first
+            needed.
+
+        :type raster_hash:
+            str or None
         """
 
         # Sanity check inputs
@@ -69,7 +158,10 @@ class SpectrumArray(object):
         self.value_errors = value_errors
         self.metadata_list = metadata_list
         self.shared_memory = shared_memory
-        self._update_raster_hash()
+        self.mask = np.ones_like(self.wavelengths, dtype=bool)
+        self.mask_set = False
+        self._raster_hash = raster_hash
+        self._raster_source = wavelengths if raster_hash is not None else None
 
     def __len__(self):
         """
@@ -81,15 +173,19 @@ class SpectrumArray(object):
         return self.values.shape[0]
 
     @staticmethod
-    def _allocate_memory(wavelengths, item_count, shared_memory):
+    def _allocate_memory(wavelengths, item_count, shared_memory, dtype=np.float64):
+
+        dtype = np.dtype(dtype)
+        assert dtype in (np.float64, np.float32), "SpectrumArrays must use either float64 or float32, not <{}>.".format(
+            dtype)
 
         # Allocate numpy array to store this SpectrumArray into
         if not shared_memory:
 
             # If we're not using shared memory (which the multiprocessing module can share between threads),
             # we allocate a simple numpy array
-            values = np.empty([item_count, len(wavelengths)])
-            value_errors = np.empty([item_count, len(wavelengths)])
+            values = np.empty([item_count, len(wavelengths)], dtype=dtype)
+            value_errors = np.empty([item_count, len(wavelengths)], dtype=dtype)
         else:
 
             # If we need to shared this array between threads (read only!), then we allocate the memory as a
@@ -99,18 +195,20 @@ class SpectrumArray(object):
             wavelengths_shared[:] = wavelengths[:]
             wavelengths = wavelengths_shared
 
-            values_shared_base = RawArray(c_double, wavelengths.size * item_count)
-            values = np.frombuffer(values_shared_base)
+            c_type = c_float if dtype == np.float32 else c_double
+
+            values_shared_base = RawArray(c_type, wavelengths.size * item_count)
+            values = np.frombuffer(values_shared_base, dtype=dtype)
             values = values.reshape([item_count, len(wavelengths)])
 
-            value_errors_shared_base = RawArray(c_double, wavelengths.size * item_count)
-            value_errors = np.frombuffer(value_errors_shared_base)
+            value_errors_shared_base = RawArray(c_type, wavelengths.size * item_count)
+            value_errors = np.frombuffer(value_errors_shared_base, dtype=dtype)
             value_errors = value_errors.reshape([item_count, len(wavelengths)])
 
         return wavelengths, values, value_errors
 
     @classmethod
-    def from_spectra(cls, spectra, shared_memory=False):
+    def from_spectra(cls, spectra, shared_memory=False, dtype=np.float64):
         """
         Instantiate new SpectrumArray object, using data in a list of existing Spectrum objects.
 
@@ -123,6 +221,14 @@ class SpectrumArray(object):
         :type shared_memory:
             bool
 
+        :param dtype:
+            The floating-point type used to hold the values and value errors in memory, either float64 or float32.
+            Single precision halves the memory needed, and the cost of operating on the spectra. The wavelength
+            raster is unaffected.
+
+        :type dtype:
+            np.dtype or str
+
         :return:
             SpectrumArray object
         """
@@ -135,17 +241,18 @@ class SpectrumArray(object):
                                                    "Got object of type <{}>".format(type(spectrum))
 
         # Inspect first spectrum to work out what wavelength raster we're using
-        raster_hash = spectra[0].raster_hash
-        wavelengths = spectra[0].wavelengths
+        first = spectra[0]
+        wavelengths = first.wavelengths
 
         # Allocate numpy array to store this SpectrumArray into
         wavelengths, values, value_errors = SpectrumArray._allocate_memory(wavelengths=wavelengths,
                                                                            item_count=len(spectra),
-                                                                           shared_memory=shared_memory)
+                                                                           shared_memory=shared_memory,
+                                                                           dtype=dtype)
 
         # Copy spectra into new array one by one
         for i, item in enumerate(spectra):
-            assert item.raster_hash == raster_hash, \
+            assert same_raster(item, first), \
                 "Item <{}> has a different wavelength raster from preceding spectra in SpectrumArray.".format(i)
             values[i, :] = item.values
             value_errors[i, :] = item.value_errors
@@ -158,9 +265,22 @@ class SpectrumArray(object):
                    shared_memory=shared_memory)
 
     @classmethod
-    def from_files(cls, filenames, metadata_list, path="", binary=True, shared_memory=False):
+    def from_files(cls, filenames, metadata_list, path="", binary=True, wavelengths=None, shared_memory=False,
+                   workers=None, use_processes=False, compressed=False, dtype=np.float64, lambda_min=None,
+                   lambda_max=None):
         """
         Instantiate new SpectrumArray object, using data in a list of text files.
+
+        If the wavelength raster that the spectra are sampled on is already known, it can be passed in as
+        <wavelengths>. This is required if the files contain only the values and value errors of each spectrum.
+        Otherwise, the raster stored in each file is checked against the raster in the first file.
+
+        Files can be read concurrently by a pool of <workers> threads, which write directly into the newly allocated
+        arrays. This helps when reading from network filesystems. When parsing text files is the bottleneck, set
+        <use_processes> to parse the files in a pool of worker processes instead.
+
+        If <lambda_min> or <lambda_max> are set, the SpectrumArray only contains the pixels within this wavelength
+        window. Only these pixels are read from uncompressed binary files.
         
         :param filenames: 
             List of the filenames of the text files from which to import spectra. Each file should have three columns:
@@ -183,12 +303,57 @@ class SpectrumArray(object):
 
         :type binary:
             bool
+
+        :param wavelengths:
+            The wavelength raster that all of the spectra are sampled on, or None to read it from the files.
+
+        :type wavelengths:
+            np.ndarray or None
             
         :param shared_memory:
             Boolean flag indicating whether this SpectrumArray should use multiprocessing shared memory.
             
         :type shared_memory:
             bool
+
+        :param workers:
+            The number of files to read concurrently, or None to read them one at a time.
+
+        :type workers:
+            int or None
+
+        :param use_processes:
+            Boolean specifying whether to read files using a pool of processes, rather than a pool of threads.
+
+        :type use_processes:
+            bool
+
+        :param compressed:
+            Boolean specifying whether the files are compressed binary files written by <write_compressed_spectrum>.
+            These are decoded directly into the newly allocated arrays. If set, <binary> is ignored.
+
+        :type compressed:
+            bool
+
+        :param lambda_min:
+            The shortest wavelength to include in the SpectrumArray, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include in the SpectrumArray, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :param dtype:
+            The floating-point type used to hold the values and value errors in memory, either float64 or float32.
+            Single precision halves the memory needed, and the cost of operating on the spectra. The wavelength
+            raster is unaffected.
+
+        :type dtype:
+            np.dtype or str
          
         :return:
             SpectrumArray object
@@ -198,32 +363,191 @@ class SpectrumArray(object):
         assert len(filenames) > 0, "Cannot open a SpectrumArray with no members: there is no wavelength raster"
 
         # Load first spectrum to work out what wavelength raster we're using
-        if not binary:
-            wavelengths, item_values, item_value_errors = np.loadtxt(str(os_path.join(path, filenames[0]))).T
-        else:
-            wavelengths, item_values, item_value_errors = np.load(str(os_path.join(path, filenames[0])))
-        raster_hash = hash_numpy_array(wavelengths)
+        check_raster = wavelengths is None
+        if check_raster:
+            wavelengths = _read_spectrum_file(os_path.join(path, filenames[0]), binary, compressed)[0]
+
+        # Work out which pixels we need to read
+        pixels = None
+        if lambda_min is not None or lambda_max is not None:
+            pixels = cls._pixel_window(wavelengths, lambda_min=lambda_min, lambda_max=lambda_max)
+            wavelengths = wavelengths[pixels]
+        raster = wavelengths
 
         # Allocate numpy array to store this SpectrumArray into
         wavelengths, values, value_errors = SpectrumArray._allocate_memory(wavelengths=wavelengths,
                                                                            item_count=len(filenames),
-                                                                           shared_memory=shared_memory)
+                                                                           shared_memory=shared_memory,
+                                                                           dtype=dtype)
+
+        filenames = [os_path.join(path, filename) for filename in filenames]
+
+        def store_item(i, item_data):
+            # The values and value errors are always the last two rows, whether or not the file contains a raster
+            if check_raster:
+                assert np.array_equal(item_data[0], raster), \
+                    "Item <{}> has a different wavelength raster from preceding spectra in SpectrumArray.".format(
+                        filenames[i])
+            values[i, :] = item_data[-2]
+            value_errors[i, :] = item_data[-1]
+
+        def read_item(i):
+            # Compressed files are decoded straight into the output arrays, without an intermediate copy
+            if compressed and pixels is None:
+                assert os_path.exists(filenames[i]), "File <{}> does not exist.".format(filenames[i])
+                item_data = read_compressed_spectrum(str(filenames[i]), out=[values[i], value_errors[i]])
+                if check_raster:
+                    assert np.array_equal(item_data[0], raster), \
+                        "Item <{}> has a different wavelength raster from preceding spectra in SpectrumArray.".format(
+                            filenames[i])
+                return
+            store_item(i, _read_spectrum_file(filenames[i], binary, compressed, pixels))
 
         # Load spectra one by one
-        for i, filename in enumerate(filenames):
-            filename = os_path.join(path, filename)
+        if workers is None or workers <= 1:
+            for i in range(len(filenames)):
+                read_item(i)
+
+        # Load spectra in a pool of threads, each of which writes directly into the output arrays
+        elif not use_processes:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                list(executor.map(read_item, range(len(filenames))))
+
+        # Parse spectra in a pool of processes, and copy the results into the output arrays as they arrive
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for i, item_data in enumerate(executor.map(_read_spectrum_file, filenames, [binary] * len(filenames),
+                                                           [compressed] * len(filenames),
+                                                           [pixels] * len(filenames),
+                                                           chunksize=max(1, len(filenames) // (4 * workers)))):
+                    store_item(i, item_data)
+
+        # Instantiate a SpectrumArray object
+        return cls(wavelengths=wavelengths,
+                   values=values,
+                   value_errors=value_errors,
+                   metadata_list=metadata_list,
+                   shared_memory=shared_memory)
+
+    @classmethod
+    def from_slabs(cls, slab_rows, wavelengths, metadata_list, path="", shared_memory=False, mmap=False,
+                   dtype=np.float64, lambda_min=None, lambda_max=None):
+        """
+        Instantiate new SpectrumArray object, using data packed into slab files. Each slab file contains a numpy array
+        of shape [2, spectrum count, pixel count], containing the values and value errors of many spectra sampled on a
+        common wavelength raster.
+
+        If <mmap> is set, the requested spectra must be a consecutive run of rows within a single slab. The
+        SpectrumArray then contains read-only views of the slab file on disk, which are not copied into memory.
+
+        If <lambda_min> or <lambda_max> are set, only the pixels within this wavelength window are read.
+
+        :param slab_rows:
+            List of tuples of the form (slab filename, row number), indicating where each spectrum is stored.
+
+        :type slab_rows:
+            List[tuple]
+
+        :param wavelengths:
+            The wavelength raster that all of the slabs are sampled on.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param metadata_list:
+            A list of dictionaries of metadata about each of the spectra in this SpectrumArray
+
+        :param path:
+            The file path from which to load the slab files.
+
+        :type path:
+            str
+
+        :param shared_memory:
+            Boolean flag indicating whether this SpectrumArray should use multiprocessing shared memory.
+
+        :type shared_memory:
+            bool
+
+        :param mmap:
+            Boolean flag indicating whether this SpectrumArray should memory-map the slab file, rather than copying
+            the spectra into memory.
+
+        :type mmap:
+            bool
+
+        :param dtype:
+            The floating-point type used to hold the values and value errors in memory, either float64 or float32.
+            Single precision halves the memory needed, and the cost of operating on the spectra. The wavelength
+            raster is unaffected. Memory-mapped spectra use whatever type the slab is stored in.
+
+        :type dtype:
+            np.dtype or str
+
+        :param lambda_min:
+            The shortest wavelength to include in the SpectrumArray, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include in the SpectrumArray, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :return:
+            SpectrumArray object
+        """
+
+        assert isinstance(slab_rows, (list, tuple)), "Argument <slab_rows> must be a list or tuple of spectra."
+        assert len(slab_rows) > 0, "Cannot open a SpectrumArray with no members: there is no wavelength raster"
+        assert not (mmap and shared_memory), "Memory-mapped SpectrumArrays cannot also use shared memory."
+
+        # Work out which pixels we need to read
+        raster_length = wavelengths.shape[0]
+        pixels = cls._pixel_window(wavelengths, lambda_min=lambda_min, lambda_max=lambda_max)
+        wavelengths = wavelengths[pixels]
+
+        # Memory-map a consecutive run of rows from a single slab
+        if mmap:
+            slab_filename, first_row = slab_rows[0]
+            assert all(item == (slab_filename, first_row + i) for i, item in enumerate(slab_rows)), \
+                "Memory-mapped spectra must be a consecutive run of rows within a single slab."
+
+            slab = np.load(str(os_path.join(path, slab_filename)), mmap_mode='r')
+            return cls(wavelengths=wavelengths,
+                       values=slab[0, first_row:first_row + len(slab_rows), pixels],
+                       value_errors=slab[1, first_row:first_row + len(slab_rows), pixels],
+                       metadata_list=metadata_list)
+
+        # Allocate numpy array to store this SpectrumArray into
+        wavelengths, values, value_errors = SpectrumArray._allocate_memory(wavelengths=wavelengths,
+                                                                           item_count=len(slab_rows),
+                                                                           shared_memory=shared_memory,
+                                                                           dtype=dtype)
+
+        # Group the requested spectra by the slab they are stored in, so that we only open each slab once
+        slabs = {}
+        for i, (slab_filename, row) in enumerate(slab_rows):
+            slabs.setdefault(slab_filename, []).append((row, i))
+
+        # Read the rows we need from each slab in the order they are stored on disk
+        for slab_filename, items in slabs.items():
+            filename = os_path.join(path, slab_filename)
             assert os_path.exists(filename), "File <{}> does not exist.".format(filename)
 
-            if not binary:
-                item_wavelengths, item_values, item_value_errors = np.loadtxt(str(filename)).T
-            else:
-                item_wavelengths, item_values, item_value_errors = np.load(str(filename))
+            items.sort()
+            rows = [item[0] for item in items]
+            indices = [item[1] for item in items]
 
-            assert hash_numpy_array(item_wavelengths) == raster_hash, \
-                "Item <{}> has a different wavelength raster from preceding spectra in SpectrumArray.".format(
+            slab = np.load(str(filename), mmap_mode='r')
+            assert slab.shape[2] == raster_length, \
+                "Slab <{}> has a different wavelength raster from preceding spectra in SpectrumArray.".format(
                     filename)
-            values[i, :] = item_values
-            value_errors[i, :] = item_value_errors
+            values[indices, :] = slab[0, rows, pixels]
+            value_errors[indices, :] = slab[1, rows, pixels]
+            del slab
 
         # Instantiate a SpectrumArray object
         return cls(wavelengths=wavelengths,
@@ -232,6 +556,90 @@ class SpectrumArray(object):
                    metadata_list=metadata_list,
                    shared_memory=shared_memory)
 
+    @classmethod
+    def from_packed_file(cls, filename, metadata_list, mmap=False):
+        """
+        Instantiate new SpectrumArray object, from a binary file written by <to_packed_file>.
+
+        :param filename:
+            The filename of the binary file to read.
+
+        :type filename:
+            str
+
+        :param metadata_list:
+            A list of dictionaries of metadata about each of the spectra in this SpectrumArray
+
+        :param mmap:
+            Boolean flag indicating whether this SpectrumArray should memory-map the file, rather than copying the
+            spectra into memory. Many processes can then share a single copy of the spectra in the page cache, and
+            the Spectrum objects returned by <extract_item> are read-only views of the file on disk.
+
+        :type mmap:
+            bool
+
+        :return:
+            SpectrumArray object
+        """
+
+        assert os_path.exists(filename), "File <{}> does not exist.".format(filename)
+
+        data = np.load(str(filename), mmap_mode='r' if mmap else None)
+        raster_rows = cls._packed_raster_rows(data.dtype)
+        item_count = (data.shape[0] - raster_rows) // 2
+
+        return cls(wavelengths=np.ascontiguousarray(data[:raster_rows]).reshape(-1).view(np.float64),
+                   values=data[raster_rows:item_count + raster_rows],
+                   value_errors=data[item_count + raster_rows:],
+                   metadata_list=metadata_list)
+
+    @staticmethod
+    def _packed_raster_rows(dtype):
+        """
+        Return the number of rows which the wavelength raster occupies in a file written by <to_packed_file>. The
+        raster is always stored in double precision, so in single-precision files it spans two rows.
+
+        :param dtype:
+            The floating-point type of the file.
+
+        :type dtype:
+            np.dtype
+
+        :return:
+            int
+        """
+
+        return np.dtype(np.float64).itemsize // np.dtype(dtype).itemsize
+
+    def to_packed_file(self, filename):
+        """
+        Write the wavelengths, values and value errors of this SpectrumArray into a single binary file, which can be
+        memory-mapped by <from_packed_file>. The file contains a 2D array, of the same floating-point type as this
+        SpectrumArray, whose first row is the wavelength raster, followed by the values of each spectrum, followed by
+        the value errors of each spectrum. In single-precision files, the raster is stored in double precision across
+        the first two rows, so that it is not rounded.
+
+        :param filename:
+            The filename of the binary file to write.
+
+        :type filename:
+            str
+
+        :return:
+            None
+        """
+
+        item_count = len(self)
+        raster_rows = self._packed_raster_rows(self.values.dtype)
+        data = np.lib.format.open_memmap(filename, mode='w+', dtype=self.values.dtype,
+                                         shape=(2 * item_count + raster_rows, self.wavelengths.shape[0]))
+        data[:raster_rows] = np.asarray(self.wavelengths, dtype=np.float64).view(self.values.dtype).reshape(
+            raster_rows, -1)
+        data[raster_rows:item_count + raster_rows] = self.values
+        data[item_count + raster_rows:] = self.value_errors
+        data.flush()
+        del data
+
     def __str__(self):
         return "<{module}.{name} instance".format(module=self.__module__,
                                                   name=type(self).__name__)
@@ -240,9 +648,23 @@ class SpectrumArray(object):
         return "<{0}.{1} object at {2}>".format(self.__module__,
                                                 type(self).__name__, hex(id(self)))
 
+    @property
+    def raster_hash(self):
+        # The hash is recomputed (or fetched from the cache) whenever a new raster array is assigned to <wavelengths>
+        if self._raster_source is not self.wavelengths:
+            self._raster_hash = hash_raster(self.wavelengths)
+            self._raster_source = self.wavelengths
+        return self._raster_hash
+
+    @raster_hash.setter
+    def raster_hash(self, value):
+        self._raster_hash = value
+        self._raster_source = self.wavelengths
+
     def _update_raster_hash(self):
         """
-        Update the internal string hash of the wavelength raster that this spectrum array is sampled on.
+        Update the internal string hash of the wavelength raster that this spectrum array is sampled on. This must be
+        called if the raster is modified in place.
         
         This hash is used to quickly check whether two spectra are sampled on the same raster before doing arithmetic
         operations on them.
@@ -250,7 +672,8 @@ class SpectrumArray(object):
         :return:
             None
         """
-        self.raster_hash = hash_numpy_array(self.wavelengths)
+        forget_raster_hash(self.wavelengths)
+        self._raster_source = None
 
     def get_metadata(self, index):
         """
@@ -286,7 +709,705 @@ class SpectrumArray(object):
         assert 0 <= index < len(self), "Index of SpectrumArray out of range."
         index = int(index)
 
-        return Spectrum(wavelengths=self.wavelengths,
-                        values=self.values[index, :],
-                        value_errors=self.value_errors[index, :],
-                        metadata=self.metadata_list[index])
+        output = Spectrum(wavelengths=self.wavelengths,
+                          values=self.values[index, :],
+                          value_errors=self.value_errors[index, :],
+                          metadata=self.metadata_list[index],
+                          raster_hash=self._raster_hash if self._raster_source is self.wavelengths else None)
+
+        if self.mask_set:
+            output.mask = self.mask.copy()
+            output.mask_set = True
+
+        return output
+
+    @staticmethod
+    def _pixel_window(wavelengths, lambda_min=None, lambda_max=None):
+        """
+        Work out which pixels of a wavelength raster fall within a wavelength window. The raster must be sorted into
+        increasing order of wavelength.
+
+        :param wavelengths:
+            The wavelength raster.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param lambda_min:
+            The shortest wavelength to include, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :return:
+            slice
+        """
+
+        start = 0 if lambda_min is None else int(np.searchsorted(wavelengths, lambda_min, side='left'))
+        end = len(wavelengths) if lambda_max is None else int(np.searchsorted(wavelengths, lambda_max, side='right'))
+        assert end > start, "Wavelength window <{}> to <{}> contains no pixels.".format(lambda_min, lambda_max)
+        return slice(start, end)
+
+    def window(self, lambda_min=None, lambda_max=None):
+        """
+        Return a SpectrumArray containing only the pixels of these spectra within a wavelength window. This creates
+        numpy views of the spectra, without copying the data.
+
+        :param lambda_min:
+            The shortest wavelength to include, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :return:
+            SpectrumArray object
+        """
+
+        pixels = self._pixel_window(self.wavelengths, lambda_min=lambda_min, lambda_max=lambda_max)
+        output = SpectrumArray(wavelengths=self.wavelengths[pixels],
+                               values=self.values[:, pixels],
+                               value_errors=self.value_errors[:, pixels],
+                               metadata_list=self.metadata_list,
+                               shared_memory=self.shared_memory)
+
+        if self.mask_set:
+            output.mask = self.mask[pixels].copy()
+            output.mask_set = not np.all(output.mask)
+
+        return output
+
+    def copy(self):
+        """
+        Duplicate a SpectrumArray, allocating new memory to hold a new copy of the data within it.
+
+        :return:
+            A new SpectrumArray object
+        """
+
+        output = SpectrumArray(wavelengths=self.wavelengths.copy(),
+                               values=self.values.copy(),
+                               value_errors=self.value_errors.copy(),
+                               metadata_list=[item.copy() for item in self.metadata_list],
+                               raster_hash=self.raster_hash)
+
+        if self.mask_set:
+            output.copy_mask_from(self)
+
+        return output
+
+    def _interpolate_rows(self, positions):
+        """
+        Linearly interpolate each spectrum in this SpectrumArray at its own set of wavelengths. All of the spectra are
+        interpolated in a single set of 2D numpy operations. Wavelengths beyond the ends of our raster take the value
+        of the pixel at that end, as with <np.interp>. The value errors are interpolated in the same way as the values.
+
+        :param positions:
+            A 2D array, with one row per spectrum, listing the wavelengths at which to sample each spectrum.
+
+        :type positions:
+            np.ndarray
+
+        :return:
+            Tuple of 2D arrays (values, value_errors)
+        """
+
+        raster = self.wavelengths
+        upper = np.clip(np.searchsorted(raster, positions), 1, raster.shape[0] - 1)
+        lower = upper - 1
+        weights = np.clip((positions - raster[lower]) / (raster[upper] - raster[lower]), 0, 1)
+
+        rows = np.arange(len(self))[:, np.newaxis]
+        output = []
+        for data in (self.values, self.value_errors):
+            output.append(data[rows, lower] * (1 - weights) + data[rows, upper] * weights)
+        return tuple(output)
+
+    def apply_redshift(self, z):
+        """
+        Apply a redshift of z to the spectra in this SpectrumArray, and return a new SpectrumArray object.
+
+        If z is a single number, every spectrum is redshifted by the same amount, and the new SpectrumArray is sampled
+        on a redshifted wavelength raster, as with <Spectrum.apply_redshift>. If z is an array with one redshift per
+        spectrum, each redshifted spectrum is linearly interpolated back onto our own wavelength raster, so that the
+        spectra still share a common raster.
+
+        :param z:
+            The redshift to apply, or a 1D array of the redshift to apply to each spectrum.
+
+        :type z:
+            float or np.ndarray
+
+        :return:
+            SpectrumArray object containing the redshifted spectra.
+        """
+
+        z = np.asarray(z, dtype=np.float64)
+
+        if z.ndim == 0:
+            output = SpectrumArray(wavelengths=self.wavelengths * (1 + z),
+                                   values=self.values.copy(),
+                                   value_errors=self.value_errors.copy(),
+                                   metadata_list=[item.copy() for item in self.metadata_list])
+        else:
+            assert z.shape == (len(self),), "Must supply one redshift for each spectrum in the SpectrumArray."
+
+            # Pixel j of redshifted spectrum i contains the light emitted at wavelength lambda_j / (1 + z_i)
+            positions = self.wavelengths[np.newaxis, :] / (1 + z[:, np.newaxis])
+            new_values, new_value_errors = self._interpolate_rows(positions)
+            output = SpectrumArray(wavelengths=self.wavelengths,
+                                   values=new_values,
+                                   value_errors=new_value_errors,
+                                   metadata_list=[item.copy() for item in self.metadata_list])
+
+        if self.mask_set:
+            output.mask = self.mask.copy()
+            output.mask_set = True
+
+        return output
+
+    def apply_radial_velocity(self, v):
+        """
+        Apply a radial velocity of v to the spectra in this SpectrumArray, and return a new SpectrumArray object. A
+        positive radial velocity means that the object is receding from the observer. See <apply_redshift> for how
+        arrays of velocities are handled.
+
+        :param v:
+            The radial velocity to apply (units m/s), or a 1D array of the radial velocity to apply to each spectrum.
+
+        :type v:
+            float or np.ndarray
+
+        :return:
+            SpectrumArray object containing the redshifted (receding) spectra
+        """
+        # https://ned.ipac.caltech.edu/level5/Hogg/Hogg3.html
+        c = 299792458.0
+        v = np.asarray(v, dtype=np.float64)
+        return self.apply_redshift(np.sqrt((1 + v / c) / (1 - v / c)) - 1)
+
+    def remove_redshift(self, z):
+        """
+        Undo a redshift of z from the spectra in this SpectrumArray, and return a new SpectrumArray object.
+
+        :param z:
+            The redshift to undo, or a 1D array of the redshift to undo from each spectrum.
+
+        :type z:
+            float or np.ndarray
+
+        :return:
+            SpectrumArray object containing the object-rest-frame spectra
+        """
+        return self.apply_redshift(-np.asarray(z, dtype=np.float64))
+
+    def correct_radial_velocity(self, v):
+        """
+        Undo a radial velocity of v from the spectra in this SpectrumArray, and return a new SpectrumArray object.
+
+        :param v:
+            The radial velocity to undo (units m/s), or a 1D array of the radial velocity to undo from each spectrum.
+
+        :type v:
+            float or np.ndarray
+
+        :return:
+            SpectrumArray object containing the object-rest-frame spectra
+        """
+        return self.apply_radial_velocity(-np.asarray(v, dtype=np.float64))
+
+    @requires_common_raster_array
+    def copy_mask_from(self, other):
+        """
+        Duplicate the wavelength mask set up on another Spectrum or SpectrumArray, and apply it to this one.
+
+        :param other:
+            The spectrum or spectra to copy the mask from
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            None
+        """
+        self.mask = other.mask.copy()
+        self.mask_set = other.mask_set
+
+    def mask_include(self, wavelength_min=0, wavelength_max=np.inf):
+        """
+        Update the wavelength mask of all the spectra to include wavelengths in the specified range.
+
+        :param wavelength_min:
+            The shortest wavelength in the range to be added into the mask.
+
+        :type wavelength_min:
+            float
+
+        :param wavelength_max:
+            The longest wavelength in the range to be added into the mask.
+
+        :type wavelength_max:
+            float
+
+        :return:
+            None
+        """
+
+        window = (self.wavelengths >= wavelength_min) * (self.wavelengths <= wavelength_max)
+        self.mask[window] = True
+        self.mask_set = not np.all(self.mask)
+
+    def mask_exclude(self, wavelength_min=0, wavelength_max=np.inf):
+        """
+        Update the wavelength mask of all the spectra to exclude wavelengths in the specified range.
+
+        :param wavelength_min:
+            The shortest wavelength in the range to be removed from the mask.
+
+        :type wavelength_min:
+            float
+
+        :param wavelength_max:
+            The longest wavelength in the range to be removed from the mask.
+
+        :type wavelength_max:
+            float
+
+        :return:
+            None
+        """
+
+        window = (self.wavelengths >= wavelength_min) * (self.wavelengths <= wavelength_max)
+        self.mask[window] = False
+        self.mask_set = not np.all(self.mask)
+
+    def truncate_to_mask(self):
+        """
+        Return a new SpectrumArray object which contains only the data values within the masked region of these
+        spectra.
+
+        :return:
+            A new SpectrumArray object
+        """
+
+        return SpectrumArray(wavelengths=self.wavelengths[self.mask],
+                             values=self.values[:, self.mask],
+                             value_errors=self.value_errors[:, self.mask],
+                             metadata_list=[item.copy() for item in self.metadata_list])
+
+    def _arithmetic_result(self, other, values, value_errors):
+        """
+        Wrap the result of an arithmetic operation between these spectra and another Spectrum or SpectrumArray in a
+        new SpectrumArray object, combining the masks of the two inputs.
+
+        :return:
+            SpectrumArray object
+        """
+
+        output = SpectrumArray(wavelengths=self.wavelengths, values=values, value_errors=value_errors,
+                               metadata_list=[item.copy() for item in self.metadata_list])
+        if self.mask_set or other.mask_set:
+            output.mask = self.mask * other.mask  # Logical AND
+            output.mask_set = True
+        return output
+
+    def _combine_masks(self, other):
+        """
+        Combine the mask of another Spectrum or SpectrumArray into our own, after an in-place arithmetic operation.
+
+        :return:
+            None
+        """
+
+        if other.mask_set:
+            self.mask = self.mask * other.mask  # Logical AND
+            self.mask_set = True
+
+    @requires_common_raster_array
+    def __add__(self, other):
+        """
+        Add the values in another Spectrum or SpectrumArray to the values in these spectra, and return a new
+        SpectrumArray object.
+
+        :param other:
+            The spectrum or spectra to add to these.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            SpectrumArray object containing the sums.
+        """
+
+        new_value_errors = np.hypot(self.value_errors, other.value_errors)
+        new_values = self.values + other.values
+        return self._arithmetic_result(other=other, values=new_values, value_errors=new_value_errors)
+
+    @requires_common_raster_array
+    def __sub__(self, other):
+        """
+        Subtract the values in another Spectrum or SpectrumArray from the values in these spectra, and return a new
+        SpectrumArray object.
+
+        :param other:
+            The spectrum or spectra to subtract from these.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            SpectrumArray object containing the differences.
+        """
+
+        new_value_errors = np.hypot(self.value_errors, other.value_errors)
+        new_values = self.values - other.values
+        return self._arithmetic_result(other=other, values=new_values, value_errors=new_value_errors)
+
+    @requires_common_raster_array
+    def __mul__(self, other):
+        """
+        Multiply the values in these spectra by the values in another Spectrum or SpectrumArray, and return a new
+        SpectrumArray object.
+
+        :param other:
+            The spectrum or spectra to multiply these by.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            SpectrumArray object containing the products.
+        """
+
+        new_values, new_value_errors = propagate_product(np.multiply, self.values, self.value_errors,
+                                                         other.values, other.value_errors)
+        return self._arithmetic_result(other=other, values=new_values, value_errors=new_value_errors)
+
+    @requires_common_raster_array
+    def __truediv__(self, other):
+        """
+        Divide the values in these spectra by the values in another Spectrum or SpectrumArray, and return a new
+        SpectrumArray object.
+
+        :param other:
+            The spectrum or spectra to divide these by.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            SpectrumArray object containing the quotients.
+        """
+
+        new_values, new_value_errors = propagate_product(np.divide, self.values, self.value_errors,
+                                                         other.values, other.value_errors)
+        return self._arithmetic_result(other=other, values=new_values, value_errors=new_value_errors)
+
+    @requires_common_raster_array
+    def __iadd__(self, other):
+        """
+        Add the values in another Spectrum or SpectrumArray to the values in these spectra. The result is written into
+        our existing arrays, so SpectrumArrays in shared memory stay there.
+
+        :param other:
+            The spectrum or spectra to add to these.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            self
+        """
+
+        np.hypot(self.value_errors, other.value_errors, out=self.value_errors)
+        np.add(self.values, other.values, out=self.values)
+        self._combine_masks(other)
+        return self
+
+    @requires_common_raster_array
+    def __isub__(self, other):
+        """
+        Subtract the values in another Spectrum or SpectrumArray from the values in these spectra. The result is written
+        into our existing arrays, so SpectrumArrays in shared memory stay there.
+
+        :param other:
+            The spectrum or spectra to subtract from these.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            self
+        """
+
+        np.hypot(self.value_errors, other.value_errors, out=self.value_errors)
+        np.subtract(self.values, other.values, out=self.values)
+        self._combine_masks(other)
+        return self
+
+    @requires_common_raster_array
+    def __imul__(self, other):
+        """
+        Multiply the values in these spectra by the values in another Spectrum or SpectrumArray. The result is written
+        into our existing arrays, so SpectrumArrays in shared memory stay there.
+
+        :param other:
+            The spectrum or spectra to multiply these by.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            self
+        """
+
+        propagate_product(np.multiply, self.values, self.value_errors, other.values, other.value_errors,
+                          out=(self.values, self.value_errors))
+        self._combine_masks(other)
+        return self
+
+    @requires_common_raster_array
+    def __itruediv__(self, other):
+        """
+        Divide the values in these spectra by the values in another Spectrum or SpectrumArray. The result is written
+        into our existing arrays, so SpectrumArrays in shared memory stay there.
+
+        :param other:
+            The spectrum or spectra to divide these by.
+
+        :type other:
+            Spectrum or SpectrumArray
+
+        :return:
+            self
+        """
+
+        propagate_product(np.divide, self.values, self.value_errors, other.values, other.value_errors,
+                          out=(self.values, self.value_errors))
+        self._combine_masks(other)
+        return self
+
+
+class LazySpectrumArray(SpectrumArray):
+    """
+    A SpectrumArray whose spectra are not read from disk until their values or value errors are first used. Scripts
+    which open many spectra but only look at their metadata never read the spectra at all. Extracting a single
+    spectrum, or a wavelength window, before the whole array has been read only reads the data which is needed.
+
+    :ivar _loader:
+        Function which reads spectra from disk. It takes the arguments <indices> (a list of the indices of the spectra
+        to read, or None to read them all), <lambda_min> and <lambda_max>, and returns a SpectrumArray.
+
+    :ivar _loaded:
+        The SpectrumArray containing all of the spectra, once it has been read, or None.
+
+    :ivar _lambda_min:
+        The shortest wavelength the loader is asked to read, or None to start at the beginning of the raster.
+
+    :ivar _lambda_max:
+        The longest wavelength the loader is asked to read, or None to continue to the end of the raster.
+    """
+
+    def __init__(self, loader, metadata_list, wavelengths=None, shared_memory=False, lambda_min=None,
+                 lambda_max=None):
+        """
+        Instantiate new LazySpectrumArray object.
+
+        :param loader:
+            Function which reads spectra from disk, as described above.
+
+        :type loader:
+            callable
+
+        :param metadata_list:
+            A list of dictionaries of metadata about each of the spectra in this SpectrumArray
+
+        :param wavelengths:
+            The wavelength raster the spectra are sampled on, if it is known without reading the spectra, or None.
+
+        :type wavelengths:
+            np.ndarray or None
+
+        :param shared_memory:
+            Boolean flag indicating whether the loader returns SpectrumArrays in multiprocessing shared memory.
+
+        :type shared_memory:
+            bool
+
+        :param lambda_min:
+            The shortest wavelength to read from disk, or None to start at the beginning of the raster. If
+            <wavelengths> is given, it must already be truncated to this window.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to read from disk, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+        """
+
+        self._loader = loader
+        self._loaded = None
+        self._lambda_min = lambda_min
+        self._lambda_max = lambda_max
+        self._wavelengths = wavelengths
+        self._raster_hash = None
+        self._raster_source = None
+        self._mask = None
+        self.mask_set = False
+        self.metadata_list = metadata_list
+        self.shared_memory = shared_memory
+
+    def __len__(self):
+        return len(self.metadata_list)
+
+    @property
+    def loaded(self):
+        """
+        Boolean flag indicating whether the spectra have been read from disk yet.
+        """
+        return self._loaded is not None
+
+    def _loader_window(self, lambda_min=None, lambda_max=None):
+        """
+        Narrow a wavelength window to lie within the window that this array reads from disk.
+
+        :param lambda_min:
+            The shortest wavelength requested, or None.
+
+        :param lambda_max:
+            The longest wavelength requested, or None.
+
+        :return:
+            Tuple of (lambda_min, lambda_max) to pass to the loader, either of which may be None.
+        """
+
+        lambda_mins = [item for item in (lambda_min, self._lambda_min) if item is not None]
+        lambda_maxs = [item for item in (lambda_max, self._lambda_max) if item is not None]
+        return (max(lambda_mins) if lambda_mins else None,
+                min(lambda_maxs) if lambda_maxs else None)
+
+    def load(self):
+        """
+        Read all of the spectra from disk, if they have not been read already.
+
+        :return:
+            SpectrumArray containing the spectra.
+        """
+
+        if self._loaded is None:
+            self._loaded = self._loader(indices=None, lambda_min=self._lambda_min, lambda_max=self._lambda_max)
+            self._wavelengths = self._loaded.wavelengths
+        return self._loaded
+
+    @property
+    def wavelengths(self):
+        if self._wavelengths is None:
+            self.load()
+        return self._wavelengths
+
+    @wavelengths.setter
+    def wavelengths(self, value):
+        self.load().wavelengths = value
+        self._wavelengths = value
+
+    @property
+    def values(self):
+        return self.load().values
+
+    @values.setter
+    def values(self, value):
+        self.load().values = value
+
+    @property
+    def value_errors(self):
+        return self.load().value_errors
+
+    @value_errors.setter
+    def value_errors(self, value):
+        self.load().value_errors = value
+
+    @property
+    def mask(self):
+        if self._mask is None:
+            self._mask = np.ones_like(self.wavelengths, dtype=bool)
+        return self._mask
+
+    @mask.setter
+    def mask(self, value):
+        self._mask = value
+
+    def extract_item(self, index):
+        """
+        Extract a single spectrum from a SpectrumArray. If the spectra have not been read from disk yet, only this
+        spectrum is read.
+
+        :param index:
+            Index of the spectrum to extract
+
+        :type index:
+            int
+
+        :return:
+            Spectrum object
+        """
+
+        if self._loaded is not None:
+            return super(LazySpectrumArray, self).extract_item(index)
+
+        assert 0 <= index < len(self), "Index of SpectrumArray out of range."
+        output = self._loader(indices=[int(index)], lambda_min=self._lambda_min,
+                              lambda_max=self._lambda_max).extract_item(0)
+
+        if self.mask_set:
+            output.mask = self.mask.copy()
+            output.mask_set = True
+
+        return output
+
+    def window(self, lambda_min=None, lambda_max=None):
+        """
+        Return a SpectrumArray containing only the pixels of these spectra within a wavelength window. If the spectra
+        have not been read from disk yet, only this window is read.
+
+        :param lambda_min:
+            The shortest wavelength to include, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :return:
+            SpectrumArray object
+        """
+
+        if self._loaded is not None:
+            return super(LazySpectrumArray, self).window(lambda_min=lambda_min, lambda_max=lambda_max)
+
+        window_min, window_max = self._loader_window(lambda_min=lambda_min, lambda_max=lambda_max)
+        output = self._loader(indices=None, lambda_min=window_min, lambda_max=window_max)
+
+        if self.mask_set:
+            pixels = self._pixel_window(self.wavelengths, lambda_min=lambda_min, lambda_max=lambda_max)
+            output.mask = self.mask[pixels].copy()
+            output.mask_set = not np.all(output.mask)
+
+        return output
@@ -0,0 +1,238 @@
+# -*- coding: utf-8 -*-
+
+"""
+Functions for storing spectra in compressed binary files. Each file contains a short header, followed by the rows of
+the spectrum (e.g. wavelengths, values and errors) as a single compressed block.
+
+Before compression, the bytes of the floating-point numbers are shuffled, so that the first byte of every number is
+stored first, followed by the second byte of every number, and so on. Neighbouring pixels in a spectrum have similar
+exponents, so this places long runs of similar bytes next to each other, which compress far better than the raw
+numbers. The <zlib> codec is always available; <zstd> and <lz4> are faster, but require the optional python packages
+<zstandard> and <lz4>.
+"""
+
+import zlib
+import struct
+import numpy as np
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+# Header of each compressed spectrum file: magic string, format version, codec id, item size in bytes, row count,
+# pixel count
+_header = struct.Struct("<4sBBBxII")
+_magic = b"4GPS"
+_version = 1
+
+# Numerical ids used to record the codec in the header of each file
+_codec_ids = {"zlib": 1, "zstd": 2, "lz4": 3}
+
+# Data types which may be stored, indexed by item size
+_dtypes = {4: np.dtype("<f4"), 8: np.dtype("<f8")}
+
+
+def available_codecs():
+    """
+    List the compression codecs which can be used in this python environment.
+
+    :return:
+        List of str
+    """
+
+    output = ["zlib"]
+    if zstandard is not None:
+        output.append("zstd")
+    if lz4 is not None:
+        output.append("lz4")
+    return output
+
+
+def _check_codec(codec):
+    """
+    Check that a compression codec is recognised and available, raising an exception if not.
+
+    :param codec:
+        The name of the codec.
+
+    :type codec:
+        str
+
+    :return:
+        None
+    """
+
+    if codec not in _codec_ids:
+        raise ValueError("Unknown compression codec <{}>".format(codec))
+    if codec not in available_codecs():
+        raise ImportError("Compression codec <{}> requires the python package <{}>, which is not installed.".format(
+            codec, {"zstd": "zstandard", "lz4": "lz4"}[codec]))
+
+
+def _compress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdCompressor(level=3).compress(data)
+    if codec == "lz4":
+        return lz4.frame.compress(data)
+    return zlib.compress(data, 6)
+
+
+def _decompress(codec, data):
+    if codec == "zstd":
+        return zstandard.ZstdDecompressor().decompress(data)
+    if codec == "lz4":
+        return lz4.frame.decompress(data)
+    return zlib.decompress(data)
+
+
+def encode_spectrum(rows, codec="zlib", dtype=None):
+    """
+    Compress the rows of data describing a spectrum into a block of bytes.
+
+    :param rows:
+        A list of 1D arrays of equal length, for example [wavelengths, values, value_errors].
+
+    :type rows:
+        List[np.ndarray]
+
+    :param codec:
+        The name of the compression codec to use: <zlib>, <zstd> or <lz4>.
+
+    :type codec:
+        str
+
+    :param dtype:
+        The floating-point type to store the data as, or None to store single-precision data as float32, and
+        anything else as float64.
+
+    :return:
+        bytes
+    """
+
+    _check_codec(codec)
+    if dtype is None:
+        dtype = np.result_type(*rows)
+        if dtype != np.float32:
+            dtype = np.float64
+    dtype = np.dtype(dtype).newbyteorder("<")
+    assert dtype in _dtypes.values(), "Cannot store spectra with data type <{}>".format(dtype)
+
+    data = np.ascontiguousarray(np.asarray(rows, dtype=dtype))
+    assert data.ndim == 2, "Spectrum rows must be 1D arrays of equal length."
+
+    # Shuffle the bytes of each number into planes before compressing
+    shuffled = np.ascontiguousarray(data.reshape(-1).view(np.uint8).reshape(-1, dtype.itemsize).T)
+    return _header.pack(_magic, _version, _codec_ids[codec], dtype.itemsize, data.shape[0], data.shape[1]) + \
+        _compress(codec, shuffled.tobytes())
+
+
+def decode_spectrum(data, out=None):
+    """
+    Decompress a block of bytes written by <encode_spectrum>.
+
+    :param data:
+        The block of bytes to decode.
+
+    :type data:
+        bytes
+
+    :param out:
+        Optional list of preallocated 1D arrays into which the last <len(out)> rows are decoded, for example the rows
+        of a SpectrumArray's values and errors. This avoids allocating and copying a temporary array for each
+        spectrum. Any earlier rows (e.g. the wavelength raster) are decoded into new arrays.
+
+    :type out:
+        List[np.ndarray] or None
+
+    :return:
+        List of 1D arrays, one per row. The last <len(out)> entries are the arrays in <out>.
+    """
+
+    magic, version, codec_id, item_size, row_count, pixel_count = _header.unpack_from(data)
+    assert magic == _magic and version == _version, "Data is not a compressed spectrum."
+    codec = dict((value, key) for key, value in _codec_ids.items())[codec_id]
+    _check_codec(codec)
+    dtype = _dtypes[item_size]
+
+    if out is None:
+        out = []
+    assert len(out) <= row_count, "Compressed spectrum has only {:d} rows.".format(row_count)
+
+    planes = np.frombuffer(_decompress(codec, memoryview(data)[_header.size:]), dtype=np.uint8)
+    planes = planes.reshape(item_size, row_count * pixel_count)
+
+    output = [np.empty(pixel_count, dtype=dtype) for i in range(row_count - len(out))] + list(out)
+    for index, row in enumerate(output):
+        assert row.shape == (pixel_count,), "Compressed spectrum has {:d} pixels.".format(pixel_count)
+        unshuffled = planes[:, index * pixel_count:(index + 1) * pixel_count].T
+
+        # Unshuffle straight into the destination if it has the same type as the stored data; otherwise convert
+        if row.dtype == dtype and row.flags.c_contiguous and row.flags.writeable:
+            row.view(np.uint8).reshape(pixel_count, item_size)[...] = unshuffled
+        else:
+            row[...] = np.ascontiguousarray(unshuffled).view(dtype).reshape(pixel_count)
+    return output
+
+
+def write_compressed_spectrum(filename, rows, codec="zlib", dtype=None):
+    """
+    Write the rows of data describing a spectrum into a compressed binary file.
+
+    :param filename:
+        The filename of the file to write.
+
+    :type filename:
+        str
+
+    :param rows:
+        A list of 1D arrays of equal length, for example [wavelengths, values, value_errors].
+
+    :type rows:
+        List[np.ndarray]
+
+    :param codec:
+        The name of the compression codec to use: <zlib>, <zstd> or <lz4>.
+
+    :type codec:
+        str
+
+    :param dtype:
+        The floating-point type to store the data as, or None to choose automatically (see <encode_spectrum>).
+
+    :return:
+        None
+    """
+
+    with open(filename, "wb") as f:
+        f.write(encode_spectrum(rows=rows, codec=codec, dtype=dtype))
+
+
+def read_compressed_spectrum(filename, out=None):
+    """
+    Read the rows of data describing a spectrum from a compressed binary file written by
+    <write_compressed_spectrum>.
+
+    :param filename:
+        The filename of the file to read.
+
+    :type filename:
+        str
+
+    :param out:
+        Optional list of preallocated 1D arrays into which the last <len(out)> rows are decoded.
+
+    :type out:
+        List[np.ndarray] or None
+
+    :return:
+        List of 1D arrays, one per row.
+    """
+
+    with open(filename, "rb") as f:
+        return decode_spectrum(data=f.read(), out=out)
@@ -1,7 +1,9 @@
 # -*- coding: utf-8 -*-
 
+import os
 from os import path as os_path
 import re
+import json
 
 
 def requires_ids_or_filenames(method):
@@ -118,7 +120,28 @@ class SpectrumLibrary(object):
 
         raise NotImplementedError("The open method must be implemented by each SpectrumLibrary implementation.")
 
-    def insert(self, spectra, filenames, origin="Undefined", metadata=None, overwrite=False):
+    def iter_spectra(self, chunk_size=1000, **kwargs):
+        """
+        Iterate over the spectra within this SpectrumLibrary which fall within some metadata constraints, yielding
+        them in SpectrumArray objects of at most <chunk_size> spectra each.
+
+        :param chunk_size:
+            The maximum number of spectra to include in each SpectrumArray.
+
+        :type chunk_size:
+            int
+
+        :param kwargs:
+            A dictionary of metadata constraints, in the same format as accepted by <search>.
+
+        :return:
+            A generator of SpectrumArray objects.
+        """
+
+        raise NotImplementedError("The iter_spectra method must be implemented by each SpectrumLibrary "
+                                  "implementation.")
+
+    def insert(self, spectra, filenames, origin="Undefined", metadata=None, overwrite=False, workers=None):
         """
         Insert the spectra from a SpectrumArray object into this spectrum library.
         
@@ -136,10 +159,10 @@ class SpectrumLibrary(object):
             
         :param origin: 
             A string describing where these spectra are being imported from. Normally the name of the module which is
-            importing them.
+            importing them. Alternatively, a list with a separate origin for each spectrum.
             
         :type origin:
-            str
+            str or List[str]
             
         :param metadata: 
             A list of dictionaries of metadata to set on each of the spectra in this SpectrumArray.
@@ -152,6 +175,12 @@ class SpectrumLibrary(object):
             
         :type overwrite:
             bool
+
+        :param workers:
+            The number of files to write concurrently, or None to write them one at a time.
+
+        :type workers:
+            int or None
             
         :return:
             None
@@ -159,9 +188,18 @@ class SpectrumLibrary(object):
 
         raise NotImplementedError("The insert method must be implemented by each SpectrumLibrary implementation.")
 
-    def import_from(self, other, overwrite=False, **kwargs):
+    def import_from(self, other, overwrite=False, chunk_size=1000, workers=None, progress_file=None, **kwargs):
         """
         Search for spectra within another SpectrumLibrary, and import all matching spectra into this library.
+
+        Spectra are copied in chunks of up to <chunk_size> spectra, each of which is read from the other library in
+        the background while the previous chunk is being written, and inserted into this library in a single
+        transaction.
+
+        If <progress_file> is set, the id of the last spectrum copied is recorded in this file after each chunk
+        is written. If the import is interrupted, calling this method again with the same arguments resumes from
+        where it left off. If the import is interrupted between a chunk being written and the progress file being
+        updated, that one chunk is imported twice.
         
         :param other:
             The SpectrumLibrary from which we should import spectra.
@@ -174,6 +212,25 @@ class SpectrumLibrary(object):
             
         :type overwrite:
             bool
+
+        :param chunk_size:
+            The maximum number of spectra to copy in each transaction.
+
+        :type chunk_size:
+            int
+
+        :param workers:
+            In libraries which store each spectrum in its own file, the number of files to read and write
+            concurrently, or None to read and write them one at a time.
+
+        :type workers:
+            int or None
+
+        :param progress_file:
+            The path of a file in which to record progress, so that an interrupted import can be resumed, or None.
+
+        :type progress_file:
+            str or None
             
         :param kwargs:
             A dictionary of metadata constraints. Constraints can be specified either as <key: value> pairs, in
@@ -181,18 +238,42 @@ class SpectrumLibrary(object):
             the specified range.
          
         :return:
-            A tuple of objects, each representing a spectrum which matches the search criteria. Within each object,
-            the properties <specId> and <filename> are defined as integers and strings respectively.
+            The number of spectra imported by this call.
         """
 
-        spectra = other.search(**kwargs)
-
-        for spectrum in spectra:
-            uid = spectrum["specId"]
-            filename = spectrum["filename"]
-            origin = spectrum["origin"]
-            obj = other.open(ids=[uid])
-            self.insert(spectra=obj, filenames=[filename], origin=origin, overwrite=overwrite)
+        # Copy spectra in the order of their ids, so that we can resume from the last id we copied. Comparing
+        # filenames in python would not necessarily match the collation order used by the database.
+        spectra = other.search(order_by="specId", **kwargs)
+
+        progress = {"constraints": kwargs, "last_spec_id": None, "count": 0}
+        if progress_file is not None and os_path.exists(progress_file):
+            with open(progress_file) as f:
+                progress = json.loads(f.read())
+            assert progress["constraints"] == json.loads(json.dumps(kwargs)), \
+                "Progress file <{}> was created by an import with different search constraints.".format(progress_file)
+            if progress["last_spec_id"] is not None:
+                spectra = [item for item in spectra if item["specId"] > progress["last_spec_id"]]
+
+        imported = 0
+        for chunk in other.iter_spectra(chunk_size=chunk_size, ids=[item["specId"] for item in spectra],
+                                        workers=workers):
+            items = spectra[imported:imported + len(chunk)]
+            imported += len(chunk)
+
+            self.insert(spectra=chunk,
+                        filenames=[item["filename"] for item in items],
+                        origin=[item["name"] for item in items],
+                        overwrite=overwrite,
+                        workers=workers)
+
+            if progress_file is not None:
+                progress["last_spec_id"] = int(items[-1]["specId"])
+                progress["count"] += len(items)
+                with open(progress_file + ".tmp", "w") as f:
+                    f.write(json.dumps(progress))
+                os.replace(progress_file + ".tmp", progress_file)
+
+        return imported
 
     @classmethod
     def open_and_search(cls, library_spec, workspace, extra_constraints):
@@ -1,9 +1,25 @@
 # -*- coding: utf-8 -*-
 
 import re
+import logging
+from functools import partial
 import MySQLdb
 
 from .spectrum_library_sql import SpectrumLibrarySql
+from .connection_pool import ConnectionPool, ConnectionPoolTimeout
+
+logger = logging.getLogger(__name__)
+
+
+def _connect_mysql(host, user, passwd, db):
+    """
+    Open a new connection to a MySQL database. This is a module-level function, rather than a method, so that the
+    connection pools shared by all spectrum libraries do not keep any particular library alive.
+
+    :return:
+        MySQLdb connection
+    """
+    return MySQLdb.connect(host=host, user=user, passwd=passwd, db=db)
 
 
 class SpectrumLibraryMySql(SpectrumLibrarySql):
@@ -21,10 +37,21 @@ class SpectrumLibraryMySql(SpectrumLibrarySql):
         
     :ivar string _db_host:
         Hostname of the MySQL server
+
+    :ivar _pool:
+        The pool of connections to the MySQL server which this library borrows its connection from, or None if this
+        library opens its own connection
+
+    :ivar float _pool_timeout:
+        The number of seconds to wait for a pooled connection before opening an unpooled one instead
+
+    :ivar bool _borrowed:
+        Boolean flag indicating whether our current connection was borrowed from the pool
     """
 
-    def __init__(self, path, create=False, gzip_spectra=True, binary_spectra=True, purge_db=False,
-                 db_user="fourgp", db_passwd="fourgp", db_name="fourgp", db_host="localhost"):
+    def __init__(self, path, create=False, gzip_spectra=True, binary_spectra=True, storage_format=None, purge_db=False,
+                 db_user="fourgp", db_passwd="fourgp", db_name="fourgp", db_host="localhost",
+                 pooled=True, pool_size=8, pool_timeout=5, dtype="float64"):
         """
         Create a new SpectrumLibrary object, storing metadata about the spectra in a MySQL database.
         
@@ -56,6 +83,15 @@ class SpectrumLibraryMySql(SpectrumLibrarySql):
 
         :type binary_spectra:
             bool
+
+        :param storage_format:
+            The format in which to store spectra on disk, which must be one of the entries in <_storage_formats>. If
+            set, this overrides <gzip_spectra> and <binary_spectra>.
+            This setting is a property of stored when new libraries are created, and the argument is ignored if
+            we are not creating a new library.
+
+        :type storage_format:
+            str or None
          
         :param purge_db:
             If true, wipe the database clean and start a new schema. Warning: This will trash everything in the
@@ -87,6 +123,37 @@ class SpectrumLibraryMySql(SpectrumLibrarySql):
             
         :type db_host:
             str
+
+        :param pooled:
+            If true, borrow a connection from a pool shared by all the spectrum libraries in this process which use
+            the same MySQL database, rather than opening a new connection. The connection is returned to the pool
+            when the library is closed.
+
+        :type pooled:
+            bool
+
+        :param pool_size:
+            The maximum number of connections the pool may hold open at once. Only used if the pool does not
+            already exist.
+
+        :type pool_size:
+            int
+
+        :param pool_timeout:
+            The number of seconds to wait for a connection to be returned to the pool, if all of its connections are in
+            use. After this, the library opens its own connection outside the pool instead.
+
+        :type pool_timeout:
+            float
+
+        :param dtype:
+            The floating-point type used to store the values and value errors of spectra on disk, either float64 or
+            float32. See <SpectrumLibrarySql>.
+            This setting is a property of stored when new libraries are created, and the argument is ignored if
+            we are not creating a new library.
+
+        :type dtype:
+            np.dtype or str
         """
 
         self._db_user = db_user
@@ -97,9 +164,19 @@ class SpectrumLibraryMySql(SpectrumLibrarySql):
 
         self._db = None
         self._db_cursor = None
+        self._pool = None
+        self._pool_timeout = pool_timeout
+        self._borrowed = False
+        if pooled:
+            self._pool = ConnectionPool.get(key=(db_host, db_user, db_passwd, db_name),
+                                            connect=partial(_connect_mysql, host=db_host, user=db_user,
+                                                            passwd=db_passwd, db=db_name),
+                                            health_check=lambda connection: connection.ping(),
+                                            max_size=pool_size)
 
         super(SpectrumLibraryMySql, self).__init__(path=path, create=create,
-                                                   gzip_spectra=gzip_spectra, binary_spectra=binary_spectra)
+                                                   gzip_spectra=gzip_spectra, binary_spectra=binary_spectra,
+                                                   storage_format=storage_format, dtype=dtype)
 
     def _create_database(self):
         """
@@ -118,6 +195,10 @@ class SpectrumLibraryMySql(SpectrumLibrarySql):
             db.commit()
             db.close()
 
+            # Pooled connections may refer to the database we have just dropped
+            if self._pool is not None:
+                self._pool.close_idle()
+
         # Create MySQL database to hold metadata about the spectra in this library
         db = MySQLdb.connect(host=self._db_host, user=self._db_user, passwd=self._db_passwd, db=self._db_name)
         c = db.cursor(cursorclass=MySQLdb.cursors.DictCursor)
@@ -133,11 +214,75 @@ class SpectrumLibraryMySql(SpectrumLibrarySql):
         db.commit()
         db.close()
 
+    def _database_size(self):
+        self._parameterised_query("""
+SELECT SUM(data_length + index_length) FROM information_schema.tables WHERE table_schema=?;""", (self._db_name,))
+        return int(self._db_cursor.fetchall()[0][0] or 0)
+
+    def _optimise_database(self):
+        # Only optimise the tables which hold spectrum libraries, rather than everything else in the database. These
+        # tables are shared by all of the spectrum libraries in the database, so they are optimised too.
+        self._db.commit()
+        tables = ", ".join(re.findall(r"CREATE TABLE (\w+)", self._schema))
+        for statement in ("OPTIMIZE TABLE {};", "ANALYZE TABLE {};"):
+            self._parameterised_query(statement.format(tables))
+            self._db_cursor.fetchall()
+
+    def _list_tables(self):
+        self._parameterised_query("SHOW TABLES;")
+        return [item[0] for item in self._db_cursor.fetchall()]
+
+    def _list_columns(self, table):
+        self._parameterised_query("SHOW COLUMNS FROM {};".format(table))
+        return [item[0] for item in self._db_cursor.fetchall()]
+
+    def _list_indices(self, table):
+        self._parameterised_query("SHOW INDEX FROM {};".format(table))
+        return [item[2] for item in self._db_cursor.fetchall()]
+
+    def _connect(self):
+        return _connect_mysql(host=self._db_host, user=self._db_user, passwd=self._db_passwd, db=self._db_name)
+
     def _open_database(self):
-        self._db = MySQLdb.connect(host=self._db_host, user=self._db_user, passwd=self._db_passwd, db=self._db_name)
+        self._borrowed = False
+        if self._pool is not None:
+            try:
+                self._db = self._pool.acquire(timeout=self._pool_timeout)
+                self._borrowed = True
+            except ConnectionPoolTimeout:
+                logger.warning("All connections in the MySQL connection pool are in use. Opening an unpooled "
+                               "connection instead.")
+        if not self._borrowed:
+            self._db = self._connect()
         self._db_cursor = self._db.cursor(cursorclass=MySQLdb.cursors.Cursor)
         return self._db, self._db_cursor
 
+    def _close_database(self):
+        """
+        Close our connection to the MySQL server, or return it to the pool if it was borrowed from one.
+
+        :return:
+            None
+        """
+
+        if self._db is None:
+            return
+        self._db_cursor.close()
+        if self._borrowed:
+            self._pool.release(self._db)
+        else:
+            self._db.close()
+        self._db = None
+        self._db_cursor = None
+        self._borrowed = False
+
+    def __del__(self):
+        # Make sure that libraries which are never closed don't keep their connection out of the pool forever
+        try:
+            self._close_database()
+        except Exception:
+            pass
+
     def _parameterised_query(self, sql, parameters=None):
         if parameters is None:
             parameters = ()
@@ -7,10 +7,14 @@ import time
 import json
 import hashlib
 import logging
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 from .spectrum_library import SpectrumLibrary, requires_ids_or_filenames
-from .spectrum_array import SpectrumArray
-from .spectrum import Spectrum
+from .spectrum_array import SpectrumArray, LazySpectrumArray, _read_spectrum_file
+from .spectrum import Spectrum, hash_numpy_array, hash_raster
+from .spectrum_codec import available_codecs
 
 logger = logging.getLogger(__name__)
 
@@ -21,6 +25,38 @@ class SpectrumLibrarySql(SpectrumLibrary):
     
     :cvar string _schema:
         The SQL schema used for storing SpectrumLibraries
+
+    :cvar list _schema_upgrades:
+        Columns which have been added to the schema since it was first released, as tuples of (table, column, SQL type).
+        These are added to existing databases when they are opened.
+
+    :cvar int _schema_version:
+        The version number of <_schema>, which is recorded in the <library_props> file of each library. Existing
+        databases are only checked for missing tables, columns and indices if they were last opened by code with an
+        older schema version. This must be incremented whenever <_schema> is changed.
+
+    :cvar int _query_chunk_size:
+        The maximum number of parameters we substitute into a single <IN (...)> list when looking up many spectra at
+        once. SQLite refuses to run queries containing more than 999 parameters.
+
+    :cvar tuple _storage_formats:
+        The formats in which spectrum libraries can store spectra on disk. The <npy> format stores the values and
+        errors of each spectrum in a binary file, without repeating the wavelength raster in every file. The <slab>
+        format packs many spectra sampled on a common wavelength raster into a single 2D array on disk. In both cases,
+        each wavelength raster is stored on disk only once. Spectra are only packed into the same slab if they are
+        inserted by a single call to <insert>, or within a <bulk_insert> block, so libraries in the <slab> format
+        should be written inside <bulk_insert> blocks. Otherwise each call to <insert> writes a new slab file.
+
+    :cvar int _slab_max_rows:
+        The maximum number of spectra we pack into a single slab file.
+
+    :cvar int _mmap_cache_size:
+        The maximum number of cache files which <open> keeps within the library for memory-mapping spectra. When
+        this is exceeded, the least recently used cache files are deleted.
+
+    :cvar int _search_selectivity_sample:
+        When a search has several metadata constraints, we count how many spectra match each one in order to apply the
+        most selective constraint first. Counting stops after this many matches.
         
     :ivar _db:
         Database handle object
@@ -36,14 +72,57 @@ class SpectrumLibrarySql(SpectrumLibrary):
         
     :ivar _library_id:
         The numerical identifier for this SpectrumLibrary in the <libraries> table in the database
+
+    :ivar dict _origin_ids:
+        Cache of the numerical ids of the named data origins we have looked up in the <origins> table
+
+    :ivar dict _metadata_field_ids:
+        Cache of the numerical ids of the metadata fields we have looked up in the <metadata_fields> table
+
+    :ivar bool _read_only:
+        Flag indicating whether this library was opened read-only
+
+    :ivar int _bulk_insert_depth:
+        The number of nested <bulk_insert> blocks we are currently inside. While this is non-zero, database commits
+        are deferred until the outermost block exits.
+
+    :ivar str _format:
+        The format in which this library stores spectra on disk. One of the entries in <_storage_formats>.
+
+    :ivar dict _raster_ids:
+        Cache of the numerical ids of the wavelength rasters we have looked up in the <rasters> table, indexed by hash
+
+    :ivar dict _rasters:
+        Cache of the wavelength rasters we have read from disk, indexed by their numerical ids
+
+    :ivar dict _pending_slabs:
+        Spectra which have been inserted into a slab-format library, but not yet written to disk, indexed by the hash
+        of their wavelength raster
+
+    :ivar bool _label_table:
+        Flag indicating whether this library maintains a wide table of numeric metadata in <spectrum_labels>
+
+    :ivar set _label_columns:
+        The ids of the metadata fields which have columns in the <spectrum_labels> table
+
+    :ivar set _pending_label_columns:
+        The ids of numeric metadata fields which need columns adding to the <spectrum_labels> table. Some databases
+        (e.g. MySQL) commit implicitly when a table is altered, so these are only added once the current transaction
+        has been committed.
     """
 
     _schema = """
 
 -- Table of spectrum libraries using this database
+-- <labelTable> is set if the library maintains a wide table of numeric metadata in <spectrum_labels>
+-- <spectrumCount> is the number of spectra in the library, or NULL if it has not been counted yet
+-- <deduplicate> is set if spectra with identical contents are only stored on disk once
 CREATE TABLE libraries (
     libraryId INTEGER PRIMARY KEY AUTO_INCREMENT,
-    name VARCHAR(760) UNIQUE NOT NULL
+    name VARCHAR(760) UNIQUE NOT NULL,
+    labelTable INTEGER,
+    spectrumCount INTEGER,
+    deduplicate INTEGER
 );
 
 -- Table of string descriptions of which tools imported particular spectra into the library 
@@ -52,19 +131,53 @@ CREATE TABLE origins (
     name VARCHAR(256) UNIQUE NOT NULL
 );
 
+-- Table of wavelength rasters used by spectra in this library, each of which is stored on disk only once
+CREATE TABLE rasters (
+    rasterId INTEGER PRIMARY KEY AUTO_INCREMENT,
+    libraryId INTEGER NOT NULL,
+    hash VARCHAR(64) NOT NULL,
+    filename VARCHAR(256) UNIQUE NOT NULL,
+    FOREIGN KEY (libraryId) REFERENCES libraries (libraryId) ON DELETE CASCADE
+);
+
+CREATE INDEX search_rasters_by_hash ON rasters (libraryId, hash);
+
+-- Table of slab files, each of which packs many spectra sampled on a common raster into a single 2D array
+CREATE TABLE slabs (
+    slabId INTEGER PRIMARY KEY AUTO_INCREMENT,
+    libraryId INTEGER NOT NULL,
+    rasterId INTEGER NOT NULL,
+    filename VARCHAR(256) UNIQUE NOT NULL,
+    rowCount INTEGER NOT NULL,
+    FOREIGN KEY (libraryId) REFERENCES libraries (libraryId) ON DELETE CASCADE,
+    FOREIGN KEY (rasterId) REFERENCES rasters (rasterId) ON DELETE CASCADE
+);
+
 -- Table of spectra within this library
+-- <rasterId> records the wavelength raster the spectrum is sampled on. It is NULL for spectra imported by old versions
+-- In libraries which pack spectra into slabs, <slabId> and <slabRow> record where the spectrum is stored
+-- In libraries which deduplicate spectra, <contentHash> is a hash of the spectrum's wavelength raster, fluxes and
+-- errors, and <dataFilename> is set if the spectrum's data is stored in a file belonging to an identical spectrum
 CREATE TABLE spectra (
     specId INTEGER PRIMARY KEY AUTO_INCREMENT,
     libraryId INTEGER NOT NULL,
     filename VARCHAR(256) UNIQUE NOT NULL,
     originId INTEGER NOT NULL,
     importTime REAL,
+    rasterId INTEGER,
+    slabId INTEGER,
+    slabRow INTEGER,
+    contentHash VARCHAR(64),
+    dataFilename VARCHAR(256),
     FOREIGN KEY (libraryId) REFERENCES libraries (libraryId) ON DELETE CASCADE,
-    FOREIGN KEY (originId) REFERENCES origins (originId) ON DELETE CASCADE
+    FOREIGN KEY (originId) REFERENCES origins (originId) ON DELETE CASCADE,
+    FOREIGN KEY (rasterId) REFERENCES rasters (rasterId) ON DELETE CASCADE,
+    FOREIGN KEY (slabId) REFERENCES slabs (slabId) ON DELETE CASCADE
 );
 
 CREATE INDEX search_by_filename ON spectra (libraryId, filename);
 CREATE INDEX search_by_id ON spectra (libraryId, specId);
+CREATE INDEX search_by_content_hash ON spectra (libraryId, contentHash);
 
 -- Table of metadata fields which have been set on at least one spectrum
 CREATE TABLE metadata_fields (
@@ -87,10 +200,45 @@ CREATE TABLE spectrum_metadata (
 
 CREATE INDEX search_metadata_floats ON spectrum_metadata (libraryId, fieldId, valueFloat);
 CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, valueString);
+
+-- Optional wide copy of the numeric metadata in <spectrum_metadata>, with one row per spectrum, and a column
+-- <field_N> for the metadata field with fieldId N. This is only maintained in libraries with <labelTable> set.
+CREATE TABLE spectrum_labels (
+    specId INTEGER PRIMARY KEY,
+    libraryId INTEGER NOT NULL,
+    FOREIGN KEY (specId) REFERENCES spectra(specId) ON DELETE CASCADE,
+    FOREIGN KEY (libraryId) REFERENCES libraries (libraryId) ON DELETE CASCADE
+);
+
+CREATE INDEX search_labels_by_library ON spectrum_labels (libraryId);
     
     """
 
-    def __init__(self, path, create=False, gzip_spectra=True, binary_spectra=True):
+    _schema_upgrades = (
+        ("spectra", "rasterId", "INTEGER"),
+        ("spectra", "slabId", "INTEGER"),
+        ("spectra", "slabRow", "INTEGER"),
+        ("libraries", "labelTable", "INTEGER"),
+        ("libraries", "spectrumCount", "INTEGER"),
+        ("libraries", "deduplicate", "INTEGER"),
+        ("spectra", "contentHash", "VARCHAR(64)"),
+        ("spectra", "dataFilename", "VARCHAR(256)")
+    )
+
+    _schema_version = 1
+
+    _query_chunk_size = 500
+
+    _storage_formats = ("txt", "txt.gzip", "bin", "npy", "slab", "bin.zlib", "bin.zstd", "bin.lz4")
+
+    _slab_max_rows = 512
+
+    _mmap_cache_size = 16
+
+    _search_selectivity_sample = 10000
+
+    def __init__(self, path, create=False, gzip_spectra=True, binary_spectra=True, storage_format=None,
+                 read_only=False, dtype="float64"):
         """
         Create a new SpectrumLibrary object, storing metadata about the spectra in an SQL database.
         
@@ -122,13 +270,63 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
 
         :type binary_spectra:
             bool
+
+        :param storage_format:
+            The format in which to store spectra on disk, which must be one of the entries in <_storage_formats>. If
+            set, this overrides <gzip_spectra> and <binary_spectra>.
+            This setting is a property of stored when new libraries are created, and the argument is ignored if
+            we are not creating a new library.
+
+        :type storage_format:
+            str or None
+
+        :param read_only:
+            If true, open the library read-only. It is an error to attempt to modify the library. Implementations
+            which support this open their database connection read-only. Libraries whose databases were created by
+            older versions of this code must be opened without <read_only> once, to upgrade them, before they can be
+            opened read-only.
+
+        :type read_only:
+            bool
+
+        :param dtype:
+            The floating-point type used to store the values and value errors of spectra on disk, either float64 or
+            float32. Spectra are opened in this type by default. Single precision is only supported by formats
+            which store the wavelength raster separately: <npy>, <slab> and the compressed <bin.*> formats.
+            This setting is a property of stored when new libraries are created, and the argument is ignored if
+            we are not creating a new library.
+
+        :type dtype:
+            np.dtype or str
         """
 
+        assert not (create and read_only), "Cannot create a new spectrum library read-only."
+
+        # Work out which format to store spectra in, if we are creating a new library
+        if storage_format is None:
+            storage_format = "txt"
+            if gzip_spectra:
+                storage_format = "txt.gzip"
+            if binary_spectra:
+                storage_format = "bin"
+
         # Create new spectrum library if requested
+        self._origin_ids = {}
+        self._metadata_field_ids = {}
+        self._raster_ids = {}
+        self._rasters = {}
+        self._pending_slabs = {}
+        self._pending_label_columns = set()
+        self._bulk_insert_depth = 0
+        self._read_only = read_only
         self._path = path
-        self._gzip = gzip_spectra
-        self._binary_spectra = binary_spectra
+        self._set_format(storage_format)
+        self._dtype = np.dtype(dtype)
         if create:
+            assert self._dtype in (np.float64, np.float32), \
+                "Spectrum libraries must store spectra as float64 or float32, not <{}>.".format(self._dtype)
+            assert self._dtype == np.float64 or self._format in ("npy", "slab") or self._codec is not None, \
+                "Spectrum library format <{}> cannot store spectra in single precision.".format(self._format)
             self._create()
 
         # Check that we're not overwriting an existing library
@@ -156,22 +354,61 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
                 self._unique_id = library_props['unique_id']
                 self._library_id = self._fetch_library_id(self._unique_id, False)
 
-                # Check the data format used to store spectra
-                self._gzip = self._binary_spectra = False
-                if library_props['format'] == 'txt.gzip':
-                    self._gzip = True
-                elif library_props['format'] == 'bin':
-                    self._binary_spectra = True
-                elif library_props['format'] != 'txt':
-                    raise ValueError("Unexpected data format <{}>".format(library_props['format']))
+                # Check the data format used to store spectra. Libraries created by old versions of this code
+                # always use double precision.
+                self._set_format(library_props['format'])
+                self._dtype = np.dtype(library_props.get('dtype', 'float64'))
 
         except (IOError, KeyError, ValueError):
             logger.error("Spectrum library did not have required header files.")
             raise
 
+        # Bring the database up to date if this library was last opened by code with an older schema. We cannot
+        # alter a database which is open read-only, so it can only be read if it already has everything we need.
+        if library_props.get('schema_version', 0) < self._schema_version:
+            if not read_only:
+                self._upgrade_database()
+                library_props['schema_version'] = self._schema_version
+                with open(os_path.join(self._path, "library_props"), "w") as f:
+                    f.write(json.dumps(library_props))
+            else:
+                missing = self._missing_schema()
+                assert not missing, \
+                    "Spectrum library <{}> was created by an older version of this code, and its database is missing " \
+                    "<{}>. Open it without read_only once to upgrade it.".format(path, ", ".join(missing))
+
         # Initialise
         super(SpectrumLibrarySql, self).__init__()
         self._metadata_init()
+        self._label_table_init()
+        self._deduplication_init()
+
+    def _set_format(self, format_id):
+        """
+        Set the format in which this library stores spectra on disk.
+
+        :param format_id:
+            One of the entries in <_storage_formats>.
+
+        :type format_id:
+            str
+
+        :return:
+            None
+        """
+
+        if format_id not in self._storage_formats:
+            raise ValueError("Unexpected data format <{}>".format(format_id))
+
+        self._format = format_id
+        self._gzip = (format_id == "txt.gzip")
+        self._binary_spectra = format_id in ("bin", "npy")
+        self._codec = format_id[4:] if format_id.startswith("bin.") else None
+
+        # Libraries in compressed formats cannot be used if the codec they need is not installed
+        if self._codec is not None and self._codec not in available_codecs():
+            raise ImportError("Spectrum library format <{}> requires a compression codec which is not "
+                              "installed.".format(format_id))
 
     def _create(self):
         """
@@ -211,16 +448,12 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
             self._library_id = self._fetch_library_id(unique_id, True)
 
             # Document the file format used to store spectra
-            format_id = "txt"
-            if self._gzip:
-                format_id = "txt.gzip"
-            if self._binary_spectra:
-                format_id = "bin"
-
             f.write(json.dumps({
                 'type_id': library_type,
                 'unique_id': unique_id,
-                'format': format_id
+                'format': self._format,
+                'dtype': self._dtype.name,
+                'schema_version': self._schema_version
             }))
 
         self._db.commit()
@@ -248,13 +481,232 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
         raise NotImplementedError("The _create_database method must be implemented separately for each SQL "
                                   "implementation")
 
-    def close(self):
+    def _list_tables(self):
+        """
+        List the tables which exist in the SQL database.
+
+        :return:
+            List of str
+        """
+
+        raise NotImplementedError("The _list_tables method must be implemented separately for each SQL "
+                                  "implementation")
+
+    def _list_columns(self, table):
+        """
+        List the columns in a table in the SQL database.
+
+        :param table:
+            The name of the table to inspect.
+
+        :type table:
+            str
+
+        :return:
+            List of str
+        """
+
+        raise NotImplementedError("The _list_columns method must be implemented separately for each SQL "
+                                  "implementation")
+
+    def _list_indices(self, table):
+        """
+        List the indices on a table in the SQL database.
+
+        :param table:
+            The name of the table to inspect.
+
+        :type table:
+            str
+
+        :return:
+            List of str
+        """
+
+        raise NotImplementedError("The _list_indices method must be implemented separately for each SQL "
+                                  "implementation")
+
+    def _database_size(self):
+        """
+        Return the amount of disk space used by the SQL database, if it is known.
+
+        :return:
+            int number of bytes, or None
+        """
+
+        return None
+
+    def _optimise_database(self):
+        """
+        Rebuild the indices of the SQL database, update the statistics its query planner uses, and release any
+        unused space back to the operating system. Any open transaction is committed first.
+
+        :return:
+            None
+        """
+
+        raise NotImplementedError("The _optimise_database method must be implemented separately for each SQL "
+                                  "implementation")
+
+    def _schema_statement(self, statement):
+        """
+        Convert a statement from <_schema> into the dialect of SQL used by this implementation.
+
+        :param statement:
+            An SQL statement from <_schema>.
+
+        :type statement:
+            str
+
+        :return:
+            str
+        """
+
+        return statement
+
+    def _missing_schema(self):
+        """
+        List the tables and columns in <_schema> which are missing from a database created with an older version of
+        it. This only reads the database, so can be used on databases which are open read-only.
+
+        :return:
+            List of str, with columns listed as <table.column>
+        """
+
+        existing_tables = [str(item).lower() for item in self._list_tables()]
+        missing = [table for table in re.findall(r"CREATE TABLE (\w+)", self._schema)
+                   if table.lower() not in existing_tables]
+
+        columns = {}
+        for table, column, column_type in self._schema_upgrades:
+            if table in missing:
+                continue
+            if table not in columns:
+                columns[table] = [str(item).lower() for item in self._list_columns(table)]
+            if column.lower() not in columns[table]:
+                missing.append("{}.{}".format(table, column))
+        return missing
+
+    def _upgrade_database(self):
+        """
+        Bring a database which was created with an older version of <_schema> up to date, by adding any tables,
+        columns and indices which it is missing.
+
+        :return:
+            None
+        """
+
+        changed = False
+
+        # Create any tables which don't exist, together with their indices
+        existing_tables = [str(item).lower() for item in self._list_tables()]
+        new_tables = []
+        for statement in self._schema.split(";"):
+            test_table = re.search(r"CREATE TABLE (\w+)", statement)
+            test_index = re.search(r"CREATE INDEX \w+ ON (\w+)", statement)
+            if ((test_table is not None and test_table.group(1).lower() not in existing_tables) or
+                    (test_index is not None and test_index.group(1) in new_tables)):
+                if test_table is not None:
+                    new_tables.append(test_table.group(1))
+                self._parameterised_query(self._schema_statement(statement.strip()))
+                changed = True
+
+        # Add any columns which are missing from existing tables
+        for table, column, column_type in self._schema_upgrades:
+            if table in new_tables:
+                continue
+            if column.lower() not in [str(item).lower() for item in self._list_columns(table)]:
+                self._parameterised_query("ALTER TABLE {} ADD COLUMN {} {};".format(table, column, column_type))
+                changed = True
+
+        # Add any indices which are missing from existing tables
+        existing_indices = {}
+        for statement in self._schema.split(";"):
+            test_index = re.search(r"CREATE INDEX (\w+) ON (\w+)", statement)
+            if test_index is None or test_index.group(2) in new_tables:
+                continue
+            index, table = test_index.groups()
+            if table not in existing_indices:
+                existing_indices[table] = [str(item).lower() for item in self._list_indices(table)]
+            if index.lower() not in existing_indices[table]:
+                self._parameterised_query(self._schema_statement(statement.strip()))
+                changed = True
+
+        # Count the spectra in libraries which were created by old versions of this code
+        self._parameterised_query("""
+UPDATE libraries SET spectrumCount = (SELECT COUNT(*) FROM spectra WHERE spectra.libraryId=libraries.libraryId)
+WHERE spectrumCount IS NULL;""")
+        if self._db_cursor.rowcount:
+            changed = True
+
+        if changed:
+            self._db.commit()
+
+    def _commit(self):
+        """
+        Commit changes into the database, unless we are inside a <bulk_insert> block, in which case the commit is
+        deferred until the block exits. Any spectra waiting to be packed into slabs are written to disk first.
+
+        :return:
+            None
+        """
+
+        if self._bulk_insert_depth == 0:
+            self._flush_slabs()
+            self._db.commit()
+            self._add_pending_label_columns()
+
+    @contextmanager
+    def bulk_insert(self):
+        """
+        Context manager which defers all database commits until the end of the block. This makes it much quicker to
+        import large numbers of spectra with repeated calls to <insert> or <set_metadata>, for example:
+
+        with library.bulk_insert():
+            for item in spectra:
+                library.insert(spectra=item, filenames=item.metadata["Starname"])
+
+        :return:
+            None
+        """
+
+        self._bulk_insert_depth += 1
+        try:
+            yield
+        finally:
+            self._bulk_insert_depth -= 1
+            self._commit()
+
+    def _finish_writes(self):
+        """
+        Write any spectra waiting to be packed into slabs, commit all changes into the database, and add any columns
+        which the label table is waiting for. This is done before the database connection is closed.
+
+        :return:
+            None
+        """
+
+        self._flush_slabs()
         self._db.commit()
+        self._add_pending_label_columns()
+
+    def _close_database(self):
+        """
+        Close the connection to the SQL database.
+
+        :return:
+            None
+        """
+
         self._db.close()
 
+    def close(self):
+        self._finish_writes()
+        self._close_database()
+
     def refresh_database(self):
-        self._db.commit()
-        self._db.close()
+        self._finish_writes()
+        self._close_database()
         self._open_database()
 
     def __str__(self):
@@ -272,9 +724,11 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
 
         # Create list of available metadata fields
         self._metadata_fields = []
+        self._metadata_field_ids = {}
         self._parameterised_query("SELECT fieldId, name FROM metadata_fields;")
         for item in self._db_cursor:
             self._metadata_fields.append(item[1])
+            self._metadata_field_ids[item[1]] = item[0]
 
     def _fetch_library_id(self, name, add_record=False):
         """
@@ -312,7 +766,7 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
                 return results[0][0]
 
             # If not, add it into the database
-            self._parameterised_query("INSERT INTO libraries (name) VALUES (?);", (name,))
+            self._parameterised_query("INSERT INTO libraries (name, spectrumCount) VALUES (?, 0);", (name,))
             self._db.commit()
             add_record = False
 
@@ -331,16 +785,20 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
             Integer origin id.
         """
 
+        # See if we have already looked up this origin
+        if name in self._origin_ids:
+            return self._origin_ids[name]
+
         while True:
             # Look up whether this origin name already exists in the database
             self._parameterised_query("SELECT originId FROM origins WHERE name=?;", (name,))
             results = self._db_cursor.fetchall()
             if results:
+                self._origin_ids[name] = results[0][0]
                 return results[0][0]
 
-            # If not, add it into the database
+            # If not, add it into the database. This is committed along with the spectra which refer to it.
             self._parameterised_query("INSERT INTO origins (name) VALUES (?);", (name,))
-            self._db.commit()
 
     def _fetch_metadata_field_id(self, name):
         """
@@ -357,194 +815,1150 @@ CREATE INDEX search_metadata_strings ON spectrum_metadata (libraryId, fieldId, v
             Integer field id.
         """
 
+        # See if we have already looked up this metadata field
+        if name in self._metadata_field_ids:
+            return self._metadata_field_ids[name]
+
         while True:
             # Look up whether this metadata field already exists in the database
             self._parameterised_query("SELECT fieldId FROM metadata_fields WHERE name=?;", (name,))
             results = self._db_cursor.fetchall()
             if results:
+                self._metadata_field_ids[name] = results[0][0]
+                if name not in self._metadata_fields:
+                    self._metadata_fields.append(name)
                 return results[0][0]
 
-            # If not, add it into the database
+            # If not, add it into the database. This is committed along with the metadata which refers to it.
             self._parameterised_query("INSERT INTO metadata_fields (name) VALUES (?);", (name,))
-            self._db.commit()
-            self._metadata_init()
 
-    def _filenames_to_ids(self, filenames):
+    def _label_table_init(self):
         """
-        Convert a list of spectra filenames into database Ids. This helper function is used by various methods which
-        can act on spectra referenced either by database id or by filename.
-         
-        :param filenames:
-            A list of filenames whose database ids should be looked up.
-            
-        :type filenames:
-            list of str
-            
+        Check whether this library maintains a wide table of numeric metadata, and if so, which metadata fields it
+        has columns for.
+
         :return:
-            list of int
+            None
         """
 
-        if len(filenames) == 0:
-            return []
+        self._parameterised_query("SELECT labelTable FROM libraries WHERE libraryId=?;", (self._library_id,))
+        self._label_table = bool(self._db_cursor.fetchall()[0][0])
+        self._label_columns = set()
+        if self._label_table:
+            self._label_columns = set(int(str(item)[6:]) for item in self._list_columns("spectrum_labels")
+                                      if str(item).startswith("field_"))
 
-        output = []
-        for filename in filenames:
-            self._parameterised_query("SELECT specId FROM spectra WHERE libraryId=? AND filename=?;",
-                                      (self._library_id, filename))
+    def _add_label_column(self, field_id):
+        """
+        Make sure that the <spectrum_labels> table has a column for a particular metadata field. This alters the
+        table, so must not be called while a transaction is open.
 
-            for item in self._db_cursor:
-                output.append(item[0])
+        :param field_id:
+            The numerical id of the metadata field.
 
-        assert len(output) == len(filenames), "Some of the requested filenames did not exist in database. " \
-                                              "Matched {} of {} filenames.".format(len(output), len(filenames))
-        return output
+        :type field_id:
+            int
 
-    def _ids_to_filenames(self, ids):
-        """
-        Convert a list of database Ids into spectra filenames. This helper function is used by various methods which
-        can act on spectra referenced either by database id or by filename.
-         
-        :param ids:
-            A list of database ids whose filenames should be looked up.
-            
-        :type ids:
-            list of int
-            
         :return:
-            list of str
+            None
         """
 
-        if len(ids) == 0:
-            return []
-
-        output = []
-        for item in ids:
-            self._parameterised_query("SELECT filename FROM spectra WHERE libraryId=? AND specId=?;",
-                                      (self._library_id, item))
-            for item in self._db_cursor:
-                output.append(item[0])
+        if field_id in self._label_columns:
+            return
 
-        assert len(output) == len(ids), "Some of the requested IDs did not exist in database. " \
-                                        "Matched {} of {} IDs.".format(len(output), len(ids))
-        return output
+        # Another process may have added the column since we last looked
+        self._label_table_init()
+        if field_id not in self._label_columns:
+            self._parameterised_query("ALTER TABLE spectrum_labels ADD COLUMN field_{:d} REAL;".format(field_id))
+            self._label_columns.add(field_id)
 
-    def __len__(self):
+    def _fill_label_column(self, field_id):
         """
-        Return the number of spectra in this spectrum library.
+        Copy the values of a numeric metadata field from <spectrum_metadata> into its column of the
+        <spectrum_labels> table. This does not commit the changes.
 
-        :return:
+        :param field_id:
+            The numerical id of the metadata field.
+
+        :type field_id:
             int
+
+        :return:
+            None
         """
 
-        # See if we have a cached count
-        try:
-            with open(os_path.join(self._path, "spectrum_count")) as f:
-                count = int(f.read())
-                return count
-        except (IOError, ValueError):
-            pass
-
-        # Calculate count
-        count = 0
-        self._parameterised_query("SELECT COUNT(1) FROM spectra;")
-        results = self._db_cursor.fetchall()
-        if results:
-            count = results[0][0]
-
-        # Cache count to file
-        with open(os_path.join(self._path, "spectrum_count"), "w") as f:
-            f.write(str(count))
-
-        # Return spectrum count
-        return count
+        self._parameterised_query("""
+UPDATE spectrum_labels SET field_{0:d} =
+   (SELECT m.valueFloat FROM spectrum_metadata m WHERE m.specId = spectrum_labels.specId AND m.fieldId = ?)
+WHERE libraryId=?;""".format(field_id), (field_id, self._library_id))
 
-    def purge(self):
+    def _add_pending_label_columns(self):
         """
-        This irrevocably deletes the spectrum library from the database and from your disk. You have been warned.
-         
+        Add columns to the <spectrum_labels> table for any numeric metadata fields which were first set within the
+        transaction which has just been committed, and fill them with the values stored in <spectrum_metadata>.
+
         :return:
             None
         """
 
-        # Delete spectra
-        self._parameterised_query("SELECT filename FROM spectra WHERE libraryId=?;", (self._library_id,))
-        for item in self._db_cursor:
-            os.unlink(os_path.join(self._path, item[0]))
-
-        # Delete id files
-        os.unlink(os_path.join(self._path, "library_props"))
-
-        # Delete cached spectrum count
-        if os.path.isfile(os_path.join(self._path, "spectrum_count")):
-            os.unlink(os_path.join(self._path, "spectrum_count"))
+        if not self._pending_label_columns:
+            return
 
-        # Delete database entries
-        self._parameterised_query("DELETE FROM libraries WHERE libraryId=?;", (self._library_id,))
+        field_ids = sorted(self._pending_label_columns)
+        self._pending_label_columns = set()
+        for field_id in field_ids:
+            self._add_label_column(field_id)
+            self._fill_label_column(field_id)
         self._db.commit()
 
-    def search(self, **kwargs):
+    def enable_label_table(self):
         """
-        Search for spectra within this SpectrumLibrary which fall within some metadata constraints.
-        
-        :param kwargs:
-            A dictionary of metadata constraints. Constraints can be specified either as <key: value> pairs, in
-            which case the value must match exactly, or as <key: [min,max]> in which case the value must fall within
-            the specified range.
-         
+        Start maintaining a wide table of the numeric metadata in this library, with one row per spectrum and one
+        column per metadata field. Searches on numeric metadata, and calls to <get_metadata_columns> which list the
+        fields to return, then become single scans of this table, rather than pivoting through one row per metadata
+        item. This is worthwhile for libraries with many labels, such as grids of abundances.
+
+        The table is populated with all of the metadata already in the library, and is kept up to date by <insert>
+        and <set_metadata>. This should be called while no other process is writing to the library.
+
         :return:
-            A tuple of objects, each representing a spectrum which matches the search criteria. Within each object,
-            the properties <specId> and <filename> are defined as integers and strings respectively.
+            None
         """
 
-        # Start building a list of SQL search criteria as string fragments
-        criteria = ["libraryId = ?"]
+        assert not self._read_only, "Cannot modify a spectrum library which was opened read-only."
+        assert self._bulk_insert_depth == 0, "Cannot enable the label table within a <bulk_insert> block."
 
-        # List of parameters to substitute into the SQL query we are building
-        criteria_params = [self._library_id]
+        if self._label_table:
+            return
 
-        # Loop over metadata constraints
-        for key, search_range in kwargs.items():
+        # Create a row for every spectrum in the library
+        self._parameterised_query("""
+REPLACE INTO spectrum_labels (specId, libraryId)
+SELECT specId, libraryId FROM spectra WHERE libraryId=?;""", (self._library_id,))
 
-            # Check that requested metadata field exists
-            assert key in self._metadata_fields, "Unknown metadata field <{}>.".format(key)
+        # Copy each numeric metadata field into its own column
+        self._parameterised_query("""
+SELECT DISTINCT fieldId FROM spectrum_metadata WHERE libraryId=? AND valueFloat IS NOT NULL;""", (self._library_id,))
+        for field_id in [item[0] for item in self._db_cursor.fetchall()]:
+            self._add_label_column(field_id)
+            self._fill_label_column(field_id)
 
-            constraint = """s.specId IN (SELECT specId FROM spectrum_metadata 
-                                         WHERE libraryId=? AND
-                                               fieldId=(SELECT fieldId FROM metadata_fields WHERE name=?) AND
-                                               ({}) )"""
-            criteria_params.append(self._library_id)
-            criteria_params.append(key)
+        self._parameterised_query("UPDATE libraries SET labelTable=1 WHERE libraryId=?;", (self._library_id,))
+        self._label_table = True
+        self._commit()
 
-            # If constraint is specified as a list, it should be of the form [min, max]
-            if isinstance(search_range, (list, tuple)):
-                assert len(search_range) == 2, \
-                    "Search ranges must have two items, a minimum and a maximum. Supplied range has %d items." % \
-                    (format(len(search_range)))
+    def _deduplication_init(self):
+        """
+        Check whether this library only stores one copy of spectra with identical contents.
 
-                if isinstance(search_range[0], (int, float)):
-                    criteria.append(constraint.format("valueFloat BETWEEN ? AND ?"))
-                else:
-                    criteria.append(constraint.format("valueString BETWEEN ? AND ?"))
-                criteria_params.append(min(search_range))
-                criteria_params.append(max(search_range))
+        :return:
+            None
+        """
+
+        self._parameterised_query("SELECT deduplicate FROM libraries WHERE libraryId=?;", (self._library_id,))
+        self._deduplicate = bool(self._db_cursor.fetchall()[0][0])
+
+    @staticmethod
+    def _content_hash(raster_hash, values, value_errors, dtype=np.float64):
+        """
+        Produce a string hash of the contents of a spectrum, which is the same for any two spectra with byte-identical
+        wavelength rasters, fluxes and errors.
+
+        :param raster_hash:
+            The hash of the wavelength raster the spectrum is sampled on.
+
+        :type raster_hash:
+            str
+
+        :param values:
+            The fluxes of the spectrum.
+
+        :type values:
+            np.ndarray
+
+        :param value_errors:
+            The errors in the fluxes of the spectrum.
+
+        :type value_errors:
+            np.ndarray
+
+        :param dtype:
+            The floating-point type the spectrum is stored in. Spectra which are identical at this precision have the
+            same hash.
+
+        :type dtype:
+            np.dtype
+
+        :return:
+            String hash
+        """
+
+        digest = hashlib.sha1(raster_hash.encode("utf-8"))
+        for item in (values, value_errors):
+            digest.update(np.ascontiguousarray(item, dtype=dtype).view(np.uint8))
+        return digest.hexdigest()
+
+    def _fetch_stored_copies(self, content_hashes):
+        """
+        Look up where spectra with particular content hashes are already stored in this library.
+
+        :param content_hashes:
+            A list of the content hashes to look up.
+
+        :type content_hashes:
+            List of str
+
+        :return:
+            Dictionary mapping each content hash which is already stored onto a tuple of the form (data filename,
+            raster id, slab id, slab row).
+        """
+
+        output = {}
+        for item in self._query_in_chunks(sql="""
+SELECT contentHash, COALESCE(dataFilename, filename), rasterId, slabId, slabRow
+FROM spectra WHERE libraryId=? AND contentHash IN ({});""", keys=list(set(content_hashes)),
+                                          parameters=(self._library_id,)):
+            output.setdefault(str(item[0]), (str(item[1]),) + tuple(item[2:]))
+        return output
+
+    def enable_deduplication(self):
+        """
+        Start storing only one copy of spectra whose wavelength rasters, fluxes and errors are byte-identical. Each
+        spectrum inserted afterwards is hashed, and if the library already contains a spectrum with the same contents,
+        the new spectrum gets its own database entry and metadata, but refers to the existing copy on disk.
+
+        The spectra already in the library are hashed, so that new spectra can be matched against them, but existing
+        duplicates continue to occupy their own files. This should be called while no other process is writing to the
+        library.
+
+        :return:
+            None
+        """
+
+        assert not self._read_only, "Cannot modify a spectrum library which was opened read-only."
+
+        if self._deduplicate:
+            return
+
+        self._parameterised_query("SELECT specId FROM spectra WHERE libraryId=? AND contentHash IS NULL;",
+                                  (self._library_id,))
+        ids = [item[0] for item in self._db_cursor.fetchall()]
+        updates = []
+        for spectra in self.iter_spectra(ids=ids):
+            for index in range(len(spectra)):
+                updates.append((self._content_hash(raster_hash=spectra.raster_hash,
+                                                   values=spectra.values[index],
+                                                   value_errors=spectra.value_errors[index],
+                                                   dtype=self._dtype),
+                                ids[len(updates)]))
+        self._parameterised_query_many("UPDATE spectra SET contentHash=? WHERE specId=?;", updates)
+
+        self._parameterised_query("UPDATE libraries SET deduplicate=1 WHERE libraryId=?;", (self._library_id,))
+        self._deduplicate = True
+        self._commit()
+
+    def deduplication_stats(self):
+        """
+        Report how much disk space this library saves by storing only one copy of identical spectra.
+
+        :return:
+            Dictionary containing the number of <spectra> in the library, the number of copies of spectra <stored> on
+            disk, the number of <duplicates> which refer to another spectrum's copy, and the deduplication <ratio>
+            of spectra to stored copies.
+        """
+
+        if self._format == "slab":
+            self._parameterised_query("""
+SELECT COUNT(*) FROM (SELECT DISTINCT slabId, slabRow FROM spectra WHERE libraryId=?) AS stored;""",
+                                      (self._library_id,))
+        else:
+            self._parameterised_query("""
+SELECT COUNT(DISTINCT COALESCE(dataFilename, filename)) FROM spectra WHERE libraryId=?;""", (self._library_id,))
+        stored = int(self._db_cursor.fetchall()[0][0])
+        count = len(self)
+
+        return {
+            "spectra": count,
+            "stored": stored,
+            "duplicates": count - stored,
+            "ratio": float(count) / stored if stored else 1.
+        }
+
+    def _fetch_raster_id(self, wavelengths, raster_hash=None):
+        """
+        Look up the database internal id used to represent a particular wavelength raster. If this raster has not
+        been seen before in this library, it is saved to disk and added to the database.
+
+        :param wavelengths:
+            The wavelength raster to look up.
+
+        :type wavelengths:
+            np.ndarray
+
+        :param raster_hash:
+            The hash of the wavelength raster, if it is already known, or None to calculate it.
+
+        :type raster_hash:
+            str or None
+
+        :return:
+            Integer raster id.
+        """
+
+        if raster_hash is None:
+            raster_hash = hash_raster(wavelengths)
+
+        # See if we have already looked up this raster
+        if raster_hash in self._raster_ids:
+            return self._raster_ids[raster_hash]
+
+        while True:
+            # Look up whether this raster already exists in the database
+            self._parameterised_query("SELECT rasterId FROM rasters WHERE libraryId=? AND hash=?;",
+                                      (self._library_id, raster_hash))
+            results = self._db_cursor.fetchall()
+            if results:
+                self._raster_ids[raster_hash] = results[0][0]
+                return results[0][0]
+
+            # If not, save it to disk and add it into the database
+            filename = "{}.{}.raster.npy".format(raster_hash[:16], hashlib.md5(os.urandom(32)).hexdigest()[:8])
+            np.save(os_path.join(self._path, filename), wavelengths)
+            self._parameterised_query("INSERT INTO rasters (libraryId, hash, filename) VALUES (?, ?, ?);",
+                                      (self._library_id, raster_hash, filename))
+
+    def _stage_slab_row(self, spectrum, filename, origin_id, import_time, metadata, content_hash=None):
+        """
+        Queue a spectrum to be packed into a slab file. Spectra are held in memory until the database is next
+        committed, or until we have enough spectra on a common raster to fill a slab.
+
+        :param spectrum:
+            The spectrum to be stored.
+
+        :type spectrum:
+            Spectrum
+
+        :param filename:
+            The unique filename used to refer to this spectrum in the database.
+
+        :type filename:
+            str
+
+        :param origin_id:
+            The numerical id of the origin of this spectrum.
+
+        :type origin_id:
+            int
+
+        :param import_time:
+            The unix time when this spectrum was imported.
+
+        :type import_time:
+            float
+
+        :param metadata:
+            Dictionary of metadata to set on this spectrum.
+
+        :type metadata:
+            dict
+
+        :param content_hash:
+            In libraries which deduplicate spectra, the hash of the contents of this spectrum. Spectra with the same
+            hash as one already queued share its row in the slab.
+
+        :type content_hash:
+            str or None
+
+        :return:
+            None
+        """
+
+        raster_hash = spectrum.raster_hash
+        if raster_hash not in self._pending_slabs:
+            self._pending_slabs[raster_hash] = {
+                "raster_hash": raster_hash,
+                "wavelengths": spectrum.wavelengths,
+                "values": [],
+                "value_errors": [],
+                "content_hashes": {},
+                "rows": []
+            }
+
+        # Take a copy of the data, since the caller is free to modify the spectrum after it has been inserted
+        pending = self._pending_slabs[raster_hash]
+        slab_row = pending["content_hashes"].get(content_hash)
+        if slab_row is None:
+            slab_row = len(pending["values"])
+            pending["values"].append(np.array(spectrum.values, dtype=self._dtype))
+            pending["value_errors"].append(np.array(spectrum.value_errors, dtype=self._dtype))
+            if content_hash is not None:
+                pending["content_hashes"][content_hash] = slab_row
+        pending["rows"].append((filename, origin_id, import_time, metadata, content_hash, slab_row))
+
+        if len(pending["values"]) >= self._slab_max_rows:
+            self._flush_slabs(raster_hashes=(raster_hash,))
+
+    def _flush_slabs(self, raster_hashes=None):
+        """
+        Write any spectra which are queued to be packed into slabs out to disk, and create their database entries.
+        This does not commit the changes.
+
+        :param raster_hashes:
+            The hashes of the wavelength rasters whose queues should be flushed, or None to flush all queues.
+
+        :type raster_hashes:
+            list or tuple or None
+
+        :return:
+            None
+        """
+
+        if raster_hashes is None:
+            raster_hashes = list(self._pending_slabs.keys())
+
+        # Remove the spectra from the queue before we start writing, so that they can never be written twice
+        batches = [self._pending_slabs.pop(raster_hash) for raster_hash in raster_hashes]
+
+        for pending in batches:
+            raster_id = self._fetch_raster_id(wavelengths=pending["wavelengths"], raster_hash=pending["raster_hash"])
+
+            # Write all of the spectra into a single slab file, with shape [2, spectrum count, pixel count]
+            slab_filename = "{}.slab.npy".format(hashlib.md5(os.urandom(32)).hexdigest()[:24])
+            np.save(os_path.join(self._path, slab_filename),
+                    np.asarray([pending["values"], pending["value_errors"]], dtype=self._dtype))
+
+            self._parameterised_query("""
+INSERT INTO slabs (libraryId, rasterId, filename, rowCount) VALUES (?, ?, ?, ?);
+""", (self._library_id, raster_id, slab_filename, len(pending["values"])))
+            self._parameterised_query("SELECT slabId FROM slabs WHERE filename=?;", (slab_filename,))
+            slab_id = self._db_cursor.fetchall()[0][0]
+
+            # Create database entries for the spectra in this slab
+            self._create_spectra_records(
+                rows=[(filename, origin_id, import_time, raster_id, slab_id, slab_row, content_hash, None)
+                      for filename, origin_id, import_time, metadata, content_hash, slab_row in pending["rows"]],
+                metadata_list=[item[3] for item in pending["rows"]])
+
+    def _create_spectra_records(self, rows, metadata_list):
+        """
+        Create database entries for spectra which have been written to disk, and set their metadata. This does not
+        commit the changes.
+
+        :param rows:
+            A list of tuples of the form (filename, origin id, import time, raster id, slab id, slab row, content hash,
+            data filename). The slab id and row should be None unless the spectrum is stored in a slab. The content
+            hash is None unless the library deduplicates spectra, and the data filename is None unless the spectrum's
+            data is stored in a file belonging to another spectrum.
+
+        :type rows:
+            List of tuple
+
+        :param metadata_list:
+            A list of dictionaries of metadata to set on each spectrum.
+
+        :type metadata_list:
+            List of dict
+
+        :return:
+            None
+        """
+
+        # Count how many new spectra we are adding, as opposed to replacing, so we can update the library's count
+        # in the same transaction
+        replaced = self._query_in_chunks(sql="SELECT COUNT(*) FROM spectra WHERE libraryId=? AND filename IN ({});",
+                                         keys=list(set(item[0] for item in rows)),
+                                         parameters=(self._library_id,))
+        added = len(set(item[0] for item in rows)) - sum(item[0] for item in replaced)
+
+        self._parameterised_query_many("""
+REPLACE INTO spectra (filename, originId, importTime, rasterId, slabId, slabRow, contentHash, dataFilename,
+                     libraryId)
+ VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?);
+            """, [tuple(item) + (self._library_id,) for item in rows])
+        self._parameterised_query("UPDATE libraries SET spectrumCount = spectrumCount + ? WHERE libraryId=?;",
+                                  (added, self._library_id))
+
+        # Set metadata on these spectra
+        ids = self._filenames_to_ids(filenames=[item[0] for item in rows])
+        if self._label_table:
+            self._parameterised_query_many("REPLACE INTO spectrum_labels (specId, libraryId) VALUES (?, ?);",
+                                           [(id_no, self._library_id) for id_no in ids])
+        self._store_metadata(items=list(zip(ids, metadata_list)))
+
+    def _query_in_chunks(self, sql, keys, parameters=()):
+        """
+        Run an SQL query containing an <IN (...)> clause over a long list of keys. The list is split into chunks of at
+        most <_query_chunk_size> items, so that we issue a handful of set-based queries rather than one query per key.
+
+        :param sql:
+            An SQL query containing a single {} placeholder, which is replaced by a list of ? parameters.
+
+        :type sql:
+            str
+
+        :param keys:
+            The list of keys to substitute into the <IN (...)> clause.
+
+        :type keys:
+            list
+
+        :param parameters:
+            Any parameters to substitute into the query before the list of keys.
+
+        :type parameters:
+            list or tuple
+
+        :return:
+            List of all the rows returned by all of the queries.
+        """
+
+        output = []
+        for start in range(0, len(keys), self._query_chunk_size):
+            chunk = list(keys[start:start + self._query_chunk_size])
+            self._parameterised_query(sql.format(", ".join(["?"] * len(chunk))), list(parameters) + chunk)
+            output.extend(self._db_cursor.fetchall())
+        return output
+
+    def _filenames_to_ids(self, filenames):
+        """
+        Convert a list of spectra filenames into database Ids. This helper function is used by various methods which
+        can act on spectra referenced either by database id or by filename.
+         
+        :param filenames:
+            A list of filenames whose database ids should be looked up.
+            
+        :type filenames:
+            list of str
+            
+        :return:
+            list of int
+        """
+
+        if len(filenames) == 0:
+            return []
+
+        filenames = [str(item) for item in filenames]
+        lookup = dict((str(item[0]), item[1]) for item in self._query_in_chunks(
+            sql="SELECT filename, specId FROM spectra WHERE libraryId=? AND filename IN ({});",
+            keys=list(set(filenames)),
+            parameters=(self._library_id,)))
+
+        # Return ids in the same order as the filenames we were passed
+        output = [lookup[item] for item in filenames if item in lookup]
+
+        assert len(output) == len(filenames), "Some of the requested filenames did not exist in database. " \
+                                              "Matched {} of {} filenames.".format(len(output), len(filenames))
+        return output
+
+    def _ids_to_filenames(self, ids):
+        """
+        Convert a list of database Ids into spectra filenames. This helper function is used by various methods which
+        can act on spectra referenced either by database id or by filename.
+         
+        :param ids:
+            A list of database ids whose filenames should be looked up.
+            
+        :type ids:
+            list of int
+            
+        :return:
+            list of str
+        """
+
+        if len(ids) == 0:
+            return []
+
+        ids = [int(item) for item in ids]
+        lookup = dict((item[0], str(item[1])) for item in self._query_in_chunks(
+            sql="SELECT specId, filename FROM spectra WHERE libraryId=? AND specId IN ({});",
+            keys=list(set(ids)),
+            parameters=(self._library_id,)))
+
+        # Return filenames in the same order as the ids we were passed
+        output = [lookup[item] for item in ids if item in lookup]
+
+        assert len(output) == len(ids), "Some of the requested IDs did not exist in database. " \
+                                        "Matched {} of {} IDs.".format(len(output), len(ids))
+        return output
+
+    def __len__(self):
+        """
+        Return the number of spectra in this spectrum library. This is read from a count which is kept up to date
+        in the <libraries> table, so it is quick even for very large libraries.
+
+        :return:
+            int
+        """
+
+        self._parameterised_query("SELECT spectrumCount FROM libraries WHERE libraryId=?;", (self._library_id,))
+        count = self._db_cursor.fetchall()[0][0]
+
+        # Libraries created by old versions of this code, which have only ever been opened read-only, are not counted
+        if count is None:
+            self._parameterised_query("SELECT COUNT(*) FROM spectra WHERE libraryId=?;", (self._library_id,))
+            count = self._db_cursor.fetchall()[0][0]
+        return int(count)
+
+    def purge(self):
+        """
+        This irrevocably deletes the spectrum library from the database and from your disk. You have been warned.
+         
+        :return:
+            None
+        """
+
+        assert not self._read_only, "Cannot modify a spectrum library which was opened read-only."
+
+        # Discard any spectra which have not yet been packed into slabs
+        self._pending_slabs = {}
+
+        # Delete spectra. Identical spectra may share a single file.
+        if self._format != "slab":
+            self._parameterised_query("""
+SELECT DISTINCT COALESCE(dataFilename, filename) FROM spectra WHERE libraryId=?;""", (self._library_id,))
+            for item in self._db_cursor.fetchall():
+                os.unlink(os_path.join(self._path, item[0]))
+
+        # Delete slab files and wavelength rasters
+        for table in ("slabs", "rasters"):
+            self._parameterised_query("SELECT filename FROM {} WHERE libraryId=?;".format(table), (self._library_id,))
+            for item in self._db_cursor.fetchall():
+                os.unlink(os_path.join(self._path, item[0]))
+
+        # Delete memory-mapping cache files
+        for item in os.listdir(self._path):
+            if item.endswith(".mmap.npy"):
+                os.unlink(os_path.join(self._path, item))
+
+        # Delete id files
+        os.unlink(os_path.join(self._path, "library_props"))
+
+        # Delete spectrum count cached by old versions of this code
+        if os.path.isfile(os_path.join(self._path, "spectrum_count")):
+            os.unlink(os_path.join(self._path, "spectrum_count"))
+
+        # Delete database entries
+        self._parameterised_query("DELETE FROM libraries WHERE libraryId=?;", (self._library_id,))
+        self._db.commit()
+
+    def compact(self, orphans="remove", remove_missing=False, optimise=True, workers=None, dry_run=False):
+        """
+        Check the integrity of this spectrum library, and reclaim the disk space wasted by interrupted imports and
+        overwritten spectra. This should only be run while no other process is writing to the library, since files
+        which another process is in the middle of importing are indistinguishable from orphans.
+
+        The following problems are detected:
+
+        * Orphan files: spectra, wavelength rasters or slabs stored in the library's directory, which are not
+          referenced by the database. These can be left in place, removed, or reattached. Reattached spectra are
+          added to the library with no metadata, with the origin <orphan>. Only files which contain their own
+          wavelength raster can be reattached; other orphans are left in place.
+        * Missing files: spectra in the database whose files no longer exist. These can optionally be removed from
+          the database.
+        * Dangling metadata: metadata attached to spectra which are no longer in the database.
+        * Unused slabs and wavelength rasters, which no spectra refer to any longer.
+        * Cache files written by <open> with <mmap> set, which are always safe to delete.
+
+        Afterwards, the database's indices and statistics are rebuilt, and its unused pages are released.
+
+        :param orphans:
+            What to do with orphan files: either <keep>, <remove> or <reattach>.
+
+        :type orphans:
+            str
+
+        :param remove_missing:
+            If true, remove spectra whose files are missing from the database.
+
+        :type remove_missing:
+            bool
+
+        :param optimise:
+            If true, rebuild the database's indices and statistics, and release its unused pages.
+
+        :type optimise:
+            bool
+
+        :param workers:
+            The number of files to inspect concurrently, or None to inspect them one at a time.
+
+        :type workers:
+            int or None
+
+        :param dry_run:
+            If true, only report what problems exist, without changing anything.
+
+        :type dry_run:
+            bool
+
+        :return:
+            Dictionary reporting the problems found, what was done about them, and how much disk space was saved.
+        """
+
+        assert orphans in ("keep", "remove", "reattach"), "Unknown action <{}> for orphan files.".format(orphans)
+        assert dry_run or not self._read_only, "Cannot modify a spectrum library which was opened read-only."
+
+        start_time = time.time()
+        if not dry_run:
+            self._flush_slabs()
+            self._db.commit()
+
+        def disk_usage(filenames):
+            def file_size(filename):
+                try:
+                    return os.stat(os_path.join(self._path, filename)).st_size
+                except OSError:
+                    return 0
+
+            if workers is not None and workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    return sum(executor.map(file_size, filenames))
+            return sum(file_size(item) for item in filenames)
+
+        report = {"database_bytes_before": self._database_size()}
+
+        # Compile a list of all the files the database refers to
+        referenced = {}
+        for table, column in (("spectra", "COALESCE(dataFilename, filename)"),
+                              ("rasters", "filename"), ("slabs", "filename")):
+            self._parameterised_query("SELECT {} FROM {} WHERE libraryId=?;".format(column, table),
+                                      (self._library_id,))
+            referenced[table] = set(str(item[0]) for item in self._db_cursor.fetchall())
+        if self._format == "slab":
+            referenced["spectra"] = set()
+
+        # Compare this with the files on disk
+        data_files = re.compile(r"\.spec(\.npy|\.gz|\.cz)?$|\.raster\.npy$|\.slab\.npy$")
+        cache_files = re.compile(r"\.mmap\.npy(\.\w+\.tmp)?$")
+        on_disk = os.listdir(self._path)
+        orphan_files = sorted(item for item in on_disk if data_files.search(item) and
+                              not any(item in filenames for filenames in referenced.values()))
+        cache_list = [item for item in on_disk if cache_files.search(item)]
+        missing_files = sorted(referenced["spectra"].difference(on_disk))
+
+        report["orphan_files"] = len(orphan_files)
+        report["orphan_bytes"] = disk_usage(orphan_files)
+        report["missing_files"] = len(missing_files)
+        report["cache_files"] = len(cache_list)
+        report["cache_bytes"] = disk_usage(cache_list)
+
+        # Find metadata, slabs and rasters which are no longer used
+        self._parameterised_query("""
+SELECT COUNT(*) FROM spectrum_metadata
+WHERE libraryId=? AND specId NOT IN (SELECT specId FROM spectra WHERE libraryId=?);""",
+                                  (self._library_id, self._library_id))
+        report["dangling_metadata"] = self._db_cursor.fetchall()[0][0]
+
+        self._parameterised_query("""
+SELECT slabId, filename FROM slabs
+WHERE libraryId=? AND slabId NOT IN (SELECT slabId FROM spectra WHERE libraryId=? AND slabId IS NOT NULL);""",
+                                  (self._library_id, self._library_id))
+        unused_slabs = self._db_cursor.fetchall()
+        report["unused_slabs"] = len(unused_slabs)
+
+        # Work out which orphans can be reattached. Only files in this library's format which include their own
+        # wavelength raster contain everything we need.
+        reattach = []
+        if orphans == "reattach" and self._format in ("txt", "txt.gzip", "bin"):
+            suffix = {"txt": ".spec", "txt.gzip": ".spec.gz", "bin": ".spec.npy"}[self._format]
+
+            def read_orphan(filename):
+                try:
+                    return _read_spectrum_file(filename=os_path.join(self._path, filename),
+                                               binary=self._binary_spectra)
+                except Exception:
+                    return None
+
+            candidates = [item for item in orphan_files if item.endswith(suffix)]
+            if workers is not None and workers > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    contents = list(executor.map(read_orphan, candidates))
+            else:
+                contents = [read_orphan(item) for item in candidates]
+            reattach = [(filename, data) for filename, data in zip(candidates, contents)
+                        if data is not None and data.ndim == 2 and data.shape[0] == 3]
+        report["orphans_reattached"] = len(reattach)
+
+        # Orphan spectra which could not be reattached are kept, but orphan rasters and slabs are of no use
+        orphans_to_remove = []
+        if orphans == "remove":
+            orphans_to_remove = list(orphan_files)
+        elif orphans == "reattach":
+            orphans_to_remove = [item for item in orphan_files
+                                 if not item.endswith((".spec", ".spec.gz", ".spec.npy", ".spec.cz"))]
+        report["orphans_removed"] = len(orphans_to_remove)
+        report["missing_removed"] = len(missing_files) if remove_missing else 0
+
+        if not dry_run:
+            # Reattach orphans
+            if reattach:
+                origin_id = self._fetch_origin_id("orphan")
+                rows = []
+                for filename, data in reattach:
+                    raster_id = self._fetch_raster_id(wavelengths=data[0])
+                    content_hash = None
+                    if self._deduplicate:
+                        content_hash = self._content_hash(raster_hash=hash_numpy_array(data[0]),
+                                                          values=data[1], value_errors=data[2], dtype=self._dtype)
+                    rows.append((filename, origin_id, os.stat(os_path.join(self._path, filename)).st_mtime,
+                                 raster_id, None, None, content_hash, None))
+                self._create_spectra_records(rows=rows, metadata_list=[{} for item in rows])
+
+            # Remove spectra whose files are missing
+            if remove_missing and missing_files:
+                for item in self._query_in_chunks(sql="""
+SELECT specId FROM spectra WHERE libraryId=? AND COALESCE(dataFilename, filename) IN ({});""",
+                                                  keys=missing_files,
+                                                  parameters=(self._library_id,)):
+                    self._parameterised_query("DELETE FROM spectra WHERE specId=?;", (item[0],))
+
+            # Remove dangling metadata
+            for table in ("spectrum_metadata", "spectrum_labels"):
+                self._parameterised_query("""
+DELETE FROM {} WHERE libraryId=? AND specId NOT IN (SELECT specId FROM spectra WHERE libraryId=?);""".format(table),
+                                          (self._library_id, self._library_id))
+
+            # Remove unused slabs
+            for slab_id, filename in unused_slabs:
+                self._parameterised_query("DELETE FROM slabs WHERE slabId=?;", (slab_id,))
+
+        # Find wavelength rasters which are no longer used. This must happen after orphans are reattached, since they
+        # may be sampled on a raster which was previously unused.
+        self._parameterised_query("""
+SELECT rasterId, filename FROM rasters WHERE libraryId=? AND
+   rasterId NOT IN (SELECT rasterId FROM spectra WHERE libraryId=? AND rasterId IS NOT NULL) AND
+   rasterId NOT IN (SELECT rasterId FROM slabs WHERE libraryId=?);""",
+                                  (self._library_id, self._library_id, self._library_id))
+        unused_rasters = self._db_cursor.fetchall()
+        report["unused_rasters"] = len(unused_rasters)
+
+        files_to_remove = (orphans_to_remove + cache_list +
+                           [str(item[1]) for item in unused_slabs] + [str(item[1]) for item in unused_rasters])
+        report["file_bytes_freed"] = disk_usage(files_to_remove)
+
+        if not dry_run:
+            for raster_id, filename in unused_rasters:
+                self._parameterised_query("DELETE FROM rasters WHERE rasterId=?;", (raster_id,))
+            self._raster_ids = {}
+            self._rasters = {}
+
+            # Recount the spectra in the library
+            self._parameterised_query("""
+UPDATE libraries SET spectrumCount = (SELECT COUNT(*) FROM spectra WHERE libraryId=?) WHERE libraryId=?;""",
+                                      (self._library_id, self._library_id))
+            self._db.commit()
+
+            # Only delete files once the database no longer refers to them
+            for filename in files_to_remove:
+                os.unlink(os_path.join(self._path, filename))
+
+            if optimise:
+                self._optimise_database()
+
+        report["database_bytes_after"] = self._database_size()
+        report["time_taken"] = time.time() - start_time
+
+        logger.info("Compacted spectrum library <{}>: {}".format(self._path, json.dumps(report, sort_keys=True)))
+        return report
+
+    def _plan_search(self, constraints):
+        """
+        Turn a dictionary of metadata constraints into a list of conditions on the <spectrum_metadata> table, ordered
+        so that the most selective constraint comes first.
+
+        :param constraints:
+            A dictionary of metadata constraints, in the format accepted by <search>.
+
+        :type constraints:
+            dict
+
+        :return:
+            List of dictionaries, each containing the <fieldId> of a metadata field, an SQL <condition> on its value
+            (with the column left as a format placeholder), the <parameters> to substitute into it, and flags
+            indicating whether the constraint is <numeric>, and whether it is applied to the wide table of
+            labels (<label>). Returns None if any constraint matches no spectra at all.
+        """
+
+        plan = []
+
+        for key, search_range in constraints.items():
+
+            # Check that requested metadata field exists
+            assert key in self._metadata_fields, "Unknown metadata field <{}>.".format(key)
+
+            # If constraint is specified as a list, it should be of the form [min, max]
+            if isinstance(search_range, (list, tuple)):
+                assert len(search_range) == 2, \
+                    "Search ranges must have two items, a minimum and a maximum. Supplied range has %d items." % \
+                    (format(len(search_range)))
+
+                plan.append({"fieldId": self._fetch_metadata_field_id(key),
+                             "numeric": isinstance(search_range[0], (int, float)),
+                             "condition": "{column} BETWEEN ? AND ?",
+                             "parameters": [min(search_range), max(search_range)]})
+
+            # If constraint is not a list or tuple, we must match its exact value
+            else:
+                plan.append({"fieldId": self._fetch_metadata_field_id(key),
+                             "numeric": isinstance(search_range, (int, float)),
+                             "condition": "{column} = ?",
+                             "parameters": [search_range]})
+
+        # Numeric constraints on fields with a column in the wide table of labels are applied to that table
+        for item in plan:
+            item["label"] = self._label_table and item["numeric"] and item["fieldId"] in self._label_columns
+            item["matches"] = 0
+
+        # Estimate how many spectra match each remaining constraint, using the (libraryId, fieldId, value) indexes.
+        # The count is capped, so that broad constraints cost no more than scanning <_search_selectivity_sample>
+        # index entries.
+        unlabelled = [item for item in plan if not item["label"]]
+        if len(unlabelled) > 1:
+            for item in unlabelled:
+                self._parameterised_query("""
+SELECT COUNT(*) FROM
+   (SELECT 1 FROM spectrum_metadata m WHERE m.libraryId=? AND m.fieldId=? AND {} LIMIT ?) AS sample;
+""".format(self._search_condition(item, alias="m")),
+                                          [self._library_id, item["fieldId"]] + item["parameters"] +
+                                          [self._search_selectivity_sample])
+                item["matches"] = self._db_cursor.fetchall()[0][0]
+                if item["matches"] == 0:
+                    return None
+        plan.sort(key=lambda item: (not item["label"], item["matches"]))
+
+        return plan
+
+    @staticmethod
+    def _search_condition(item, alias):
+        """
+        Render the SQL condition for one of the metadata constraints returned by <_plan_search>.
+
+        :param item:
+            One of the items returned by <_plan_search>.
+
+        :type item:
+            dict
+
+        :param alias:
+            The alias of the table the condition is applied to: either a copy of <spectrum_metadata>, or
+            <spectrum_labels> if the constraint is applied to the wide table of labels.
+
+        :type alias:
+            str
+
+        :return:
+            str
+        """
+
+        if item["label"]:
+            column = "{}.field_{:d}".format(alias, item["fieldId"])
+        else:
+            column = "{}.{}".format(alias, "valueFloat" if item["numeric"] else "valueString")
+        return item["condition"].format(column=column)
+
+    def _search_query(self, constraints, columns, order_by=None, limit=None, offset=0):
+        """
+        Build an SQL query which searches for spectra matching some metadata constraints. The most selective
+        constraint is used to drive the query, via the (libraryId, fieldId, value) indexes, and each further constraint
+        is applied by joining on the primary key of <spectrum_metadata>. In libraries with a wide table of labels, all
+        numeric constraints are instead applied in a single scan of that table.
+
+        :param constraints:
+            A dictionary of metadata constraints, in the format accepted by <search>.
+
+        :type constraints:
+            dict
+
+        :param columns:
+            The SQL expression for the columns to select. The table <spectra> has alias <s>, and <origins> has alias
+            <o>.
+
+        :type columns:
+            str
+
+        :param order_by:
+            The ordering of the results, in the format accepted by <search>, or None for no ordering.
+
+        :type order_by:
+            str or None
+
+        :param limit:
+            The maximum number of results to return, or None for no limit.
+
+        :type limit:
+            int or None
+
+        :param offset:
+            The number of results to skip before the first one returned.
+
+        :type offset:
+            int
+
+        :return:
+            A tuple of the SQL query and a list of parameters to substitute into it, or None if no spectra can match.
+        """
+
+        plan = self._plan_search(constraints=constraints)
+        if plan is None:
+            return None
+
+        joins = []
+        parameters = []
+        criteria = []
+        criteria_params = []
+
+        unlabelled = [item for item in plan if not item["label"]]
+
+        if plan and plan[0]["label"]:
+            # All numeric constraints are applied in a single scan of the wide table of labels
+            source = "spectrum_labels l\nINNER JOIN spectra s ON s.specId = l.specId"
+            criteria.append("l.libraryId=?")
+            criteria_params.append(self._library_id)
+            for item in plan:
+                if item["label"]:
+                    criteria.append(self._search_condition(item, alias="l"))
+                    criteria_params.extend(item["parameters"])
+        elif plan:
+            source = "spectrum_metadata m0\nINNER JOIN spectra s ON s.specId = m0.specId"
+            criteria.append("m0.libraryId=? AND m0.fieldId=? AND {}".format(self._search_condition(plan[0], "m0")))
+            criteria_params.extend([self._library_id, plan[0]["fieldId"]] + plan[0]["parameters"])
+            unlabelled = unlabelled[1:]
+        else:
+            source = "spectra s"
+            criteria.append("s.libraryId = ?")
+            criteria_params.append(self._library_id)
+
+        for index, item in enumerate(unlabelled, start=1):
+            alias = "m{:d}".format(index)
+            joins.append("INNER JOIN spectrum_metadata {0} ON {0}.specId = s.specId AND {0}.fieldId=? AND {1}"
+                         .format(alias, self._search_condition(item, alias)))
+            parameters.extend([item["fieldId"]] + item["parameters"])
+
+        joins.append("INNER JOIN origins o ON s.originId = o.originId")
+
+        # Work out how to sort the results. A leading minus sign reverses the order.
+        ordering = ""
+        if order_by is not None:
+            descending = order_by.startswith("-")
+            key = order_by.lstrip("-")
+            direction = " DESC" if descending else ""
+            if key in ("filename", "specId", "importTime"):
+                ordering = "ORDER BY s.{}{}".format(key, direction)
+            else:
+                assert key in self._metadata_fields, "Unknown metadata field <{}>.".format(key)
+                joins.append("LEFT JOIN spectrum_metadata k ON k.specId = s.specId AND k.fieldId=?")
+                parameters.append(self._fetch_metadata_field_id(key))
+                ordering = "ORDER BY k.valueFloat{0}, k.valueString{0}, s.filename".format(direction)
+
+        # SQLite only accepts an OFFSET after a LIMIT, so use the largest possible limit if none was given
+        paging = ""
+        paging_params = []
+        if limit is not None or offset:
+            assert limit is None or limit >= 0, "Search limit must not be negative."
+            assert offset >= 0, "Search offset must not be negative."
+            paging = "LIMIT ? OFFSET ?"
+            paging_params = [limit if limit is not None else 2 ** 63 - 1, offset]
+
+        query = """
+SELECT {columns}
+FROM {source}
+{joins}
+WHERE {criteria} {ordering} {paging};""".format(columns=columns, source=source, joins="\n".join(joins),
+                                                criteria=" AND ".join(criteria), ordering=ordering, paging=paging)
+
+        return query, parameters + criteria_params + paging_params
+
+    def search(self, order_by="filename", limit=None, offset=0, **kwargs):
+        """
+        Search for spectra within this SpectrumLibrary which fall within some metadata constraints.
+
+        :param order_by:
+            The name of the property to sort the results by: either <filename>, <specId>, <importTime>, or the name of
+            a metadata field. Prefix with a minus sign to sort in descending order.
+
+        :type order_by:
+            str
 
-            # If constraint is not a list or tuple, we must match its exact value
-            else:
-                if isinstance(search_range, (int, float)):
-                    criteria.append(constraint.format("valueFloat = ?"))
-                else:
-                    criteria.append(constraint.format("valueString = ?"))
-                criteria_params.append(search_range)
+        :param limit:
+            The maximum number of results to return, or None to return all matching spectra.
 
-        # Assemble our list of search criteria into an SQL query
-        query = """
-SELECT s.specId, s.filename, o.name AS origin
-FROM spectra s
-INNER JOIN origins o ON s.originId = o.originId
-WHERE {} ORDER BY s.filename;""".format(" AND ".join(criteria))
-        self._parameterised_query(query, criteria_params)
+        :type limit:
+            int or None
+
+        :param offset:
+            The number of matching spectra to skip before the first result returned. Together with <limit>, this
+            allows search results to be fetched one page at a time.
+
+        :type offset:
+            int
+        
+        :param kwargs:
+            A dictionary of metadata constraints. Constraints can be specified either as <key: value> pairs, in
+            which case the value must match exactly, or as <key: [min,max]> in which case the value must fall within
+            the specified range.
+         
+        :return:
+            A tuple of objects, each representing a spectrum which matches the search criteria. Within each object,
+            the properties <specId> and <filename> are defined as integers and strings respectively.
+        """
+
+        query = self._search_query(constraints=kwargs, columns="s.specId, s.filename, o.name AS origin",
+                                   order_by=order_by, limit=limit, offset=offset)
+        if query is None:
+            return []
+
+        self._parameterised_query(*query)
         return [{"specId": x[0], "filename": str(x[1]), "name": x[2]} for x in self._db_cursor.fetchall()]
 
+    def search_count(self, **kwargs):
+        """
+        Count the spectra within this SpectrumLibrary which fall within some metadata constraints, without fetching
+        the list of them.
+
+        :param kwargs:
+            A dictionary of metadata constraints, in the same format as accepted by <search>.
+
+        :return:
+            Integer number of matching spectra.
+        """
+
+        query = self._search_query(constraints=kwargs, columns="COUNT(*)")
+        if query is None:
+            return 0
+
+        self._parameterised_query(*query)
+        return self._db_cursor.fetchall()[0][0]
+
+    def _fetch_metadata_rows(self, ids):
+        """
+        Fetch all of the metadata set on a list of spectra, using a handful of set-based queries rather than one query
+        per spectrum.
+
+        :param ids:
+            A list of integer ids of the spectra to be queried.
+
+        :type ids:
+            List of int
+
+        :return:
+            Dictionary, indexed by spectrum id, of dictionaries of the metadata set on each spectrum.
+        """
+
+        output = {}
+        for entry in self._query_in_chunks(sql="""
+SELECT i.specId, f.name, i.valueFloat, i.valueString
+FROM spectrum_metadata i
+INNER JOIN metadata_fields f ON f.fieldId=i.fieldId
+WHERE i.libraryId=? AND i.specId IN ({});
+""", keys=list(set(ids)), parameters=(self._library_id,)):
+            key = str(entry[1])  # Need str() here as SQL returns unicode strings
+            item = output.setdefault(entry[0], {})
+            if entry[2] is not None:
+                item[key] = entry[2]
+            else:
+                item[key] = entry[3]
+        return output
+
     @requires_ids_or_filenames
     def get_metadata(self, ids=None, filenames=None):
         """
@@ -570,35 +1984,122 @@ WHERE {} ORDER BY s.filename;""".format(" AND ".join(criteria))
         # If we are searching by filename, turn the list of filenames into a list of ids
         if filenames is not None:
             ids = self._filenames_to_ids(filenames=filenames)
+        ids = [int(item) for item in ids]
 
-        # Start building a list of output
-        output = []
+        # Fetch metadata on all the spectra at once, and return a separate dictionary for each spectrum requested
+        metadata = self._fetch_metadata_rows(ids=ids)
+        return [metadata.get(id_no, {}).copy() for id_no in ids]
 
-        # Loop over the spectra we are querying
-        for id_no in ids:
+    @requires_ids_or_filenames
+    def get_metadata_columns(self, ids=None, filenames=None, fields=None):
+        """
+        Fetch the metadata set on a list of spectra in this library, returned as a dictionary of columns. This is much
+        quicker than calling <get_metadata> and looping over the result when building tables of labels for large
+        training sets.
 
-            # Start building a dictionary of metadata
-            item = {}
+        Fields which hold numerical values on all of the requested spectra are returned as float arrays, with NaN
+        for spectra where the field is not set. Other fields are returned as arrays of Python objects, with None for
+        spectra where the field is not set.
 
-            # Search the database for metadata
-            self._parameterised_query("""
-SELECT f.name, i.valueFloat, i.valueString
-FROM spectrum_metadata i
-INNER JOIN metadata_fields f ON f.fieldId=i.fieldId
-WHERE i.libraryId=? AND i.specId=?;
-            """, (self._library_id, id_no))
-
-            # Enter metadata into dictionary
-            for entry in self._db_cursor:
-                key = str(entry[0])  # Need str() here as SQL returns unicode strings
-                if entry[1] is not None:
-                    item[key] = entry[1]
-                else:
-                    item[key] = entry[2]
+        :param ids:
+            A list of integer ids of the spectra to be queried. Set to None to search by filename instead.
+
+        :type ids:
+            List of int, or None
+
+        :param filenames:
+            A list of the filenames of the spectra to be queried. Set to None to search by integer id instead.
+
+        :type filenames:
+            List of str, or None
+
+        :param fields:
+            A list of the names of the metadata fields to return, or None to return all fields set on any of the
+            requested spectra.
+
+        :type fields:
+            List of str, or None
+
+        :return:
+            Dictionary of numpy arrays, indexed by metadata field name, with one entry per requested spectrum.
+        """
+
+        # If we are searching by filename, turn the list of filenames into a list of ids
+        if filenames is not None:
+            ids = self._filenames_to_ids(filenames=filenames)
+        ids = [int(item) for item in ids]
+
+        # Read numeric fields straight out of the wide table of labels, if we can
+        if (fields is not None and self._label_table and
+                all(self._metadata_field_ids.get(field) in self._label_columns for field in fields)):
+            return self._fetch_label_columns(ids=ids, fields=fields)
+
+        # Fetch metadata on all the spectra at once
+        metadata = self._fetch_metadata_rows(ids=ids)
+        rows = [metadata.get(id_no, {}) for id_no in ids]
+
+        # Work out which fields we are to return
+        if fields is None:
+            fields = sorted(set(key for item in metadata.values() for key in item))
+
+        # Pivot the metadata into one array per field
+        output = {}
+        for field in fields:
+            column = [item.get(field, None) for item in rows]
+            if all(value is None or isinstance(value, (int, float)) for value in column):
+                output[field] = np.array([np.nan if value is None else value for value in column], dtype=float)
+            else:
+                output[field] = np.array(column, dtype=object)
+        return output
+
+    def _fetch_label_columns(self, ids, fields):
+        """
+        Fetch metadata fields from the wide table of labels, with the same output as <get_metadata_columns>. Every
+        field must have a column in the table.
+
+        :param ids:
+            A list of integer ids of the spectra to be queried.
+
+        :type ids:
+            List of int
 
-            output.append(item)
+        :param fields:
+            A list of the names of the metadata fields to return.
+
+        :type fields:
+            List of str
+
+        :return:
+            Dictionary of numpy arrays, indexed by metadata field name, with one entry per requested spectrum.
+        """
+
+        field_ids = [self._metadata_field_ids[field] for field in fields]
+        columns = ", ".join(["field_{:d}".format(field_id) for field_id in field_ids])
+
+        lookup = dict((item[0], item[1:]) for item in self._query_in_chunks(
+            sql="SELECT specId, {} FROM spectrum_labels WHERE libraryId=? AND specId IN ({{}});".format(columns),
+            keys=list(set(ids)),
+            parameters=(self._library_id,)))
+        blank = (None,) * len(fields)
+        values = np.array([lookup.get(id_no, blank) for id_no in ids], dtype=float).reshape((len(ids), len(fields)))
+        output = dict((field, values[:, index]) for index, field in enumerate(fields))
+
+        # Fields which are not set in the table may still have been set to string values
+        if np.isnan(values).any():
+            strings = {}
+            for spec_id, field_id, value in self._query_in_chunks(sql="""
+SELECT specId, fieldId, valueString FROM spectrum_metadata
+WHERE libraryId=? AND valueString IS NOT NULL AND fieldId IN ({}) AND specId IN ({{}});
+""".format(", ".join(["{:d}".format(field_id) for field_id in field_ids])),
+                                                                  keys=list(set(ids)),
+                                                                  parameters=(self._library_id,)):
+                strings.setdefault(field_id, {})[spec_id] = value
+
+            for field, field_id in zip(fields, field_ids):
+                if field_id in strings:
+                    output[field] = np.array([strings[field_id].get(id_no, None if np.isnan(value) else value)
+                                              for id_no, value in zip(ids, output[field])], dtype=object)
 
-        # Return list of output
         return output
 
     @requires_ids_or_filenames
@@ -628,38 +2129,96 @@ WHERE i.libraryId=? AND i.specId=?;
             None
         """
 
+        assert not self._read_only, "Cannot modify a spectrum library which was opened read-only."
+
         # If we are searching by filename, turn the list of filenames into a list of ids
         if filenames is not None:
             ids = self._filenames_to_ids(filenames=filenames)
 
-        # Loop over the metadata fields we are to set
-        for key, value in metadata.items():
+        # Set the same metadata on every spectrum
+        self._store_metadata(items=[(id_no, metadata) for id_no in ids])
+
+        # Commit changes into database
+        self._commit()
+
+    def _store_metadata(self, items):
+        """
+        Write metadata on a list of spectra into the database, batching all the rows into two <executemany> queries.
+        This does not commit the changes.
+
+        :param items:
+            A list of tuples of the form (spectrum id, dictionary of metadata to set on that spectrum).
+
+        :type items:
+            List of (int, dict)
+
+        :return:
+            None
+        """
+
+        # Build a big table of parameters to substitute into SQL queries, acting on every spectrum at once
+        float_rows = []
+        string_rows = []
+        for id_no, metadata in items:
+            for key, value in metadata.items():
 
-            # Look up the numeric id for this metadata field
-            keyId = self._fetch_metadata_field_id(name=key)
+                # Look up the numeric id for this metadata field
+                key_id = self._fetch_metadata_field_id(name=key)
 
-            # Create a big table of parameters to substitute into an SQL query, acting on every spectrum at once
-            query_data = list(zip([self._library_id] * len(ids), ids, [keyId] * len(ids), [value] * len(ids)))
+                # If this metadata item has a numeric value, we store it in the SQL field <valueFloat>
+                # ... otherwise we store it in the SQL field <valueString>
+                if isinstance(value, (int, float)):
+                    float_rows.append((self._library_id, id_no, key_id, value))
+                else:
+                    string_rows.append((self._library_id, id_no, key_id, value))
 
-            # If this metadata item has a numeric value, we store it in the SQL field <valueFloat>
-            if isinstance(value, (int, float)):
-                self._parameterised_query_many("""
+        if float_rows:
+            self._parameterised_query_many("""
 REPLACE INTO spectrum_metadata (libraryId, specId, fieldId, valueFloat) VALUES 
-(?, ?, ?, ?)""", query_data)
+(?, ?, ?, ?)""", float_rows)
 
-            # ... otherwise we store it in the SQL field <valueString>
-            else:
-                self._parameterised_query_many("""
+        if string_rows:
+            self._parameterised_query_many("""
 REPLACE INTO spectrum_metadata (libraryId, specId, fieldId, valueString) VALUES 
-(?, ?, ?, ?)""", query_data)
-
-        # Commit changes into database
-        self._db.commit()
+(?, ?, ?, ?)""", string_rows)
+
+        # Keep the wide table of numeric metadata in sync. String values have no place in it, but may replace a
+        # numeric value set previously. Fields which don't have columns yet are filled in from <spectrum_metadata>
+        # when their columns are added, after this transaction is committed.
+        if self._label_table:
+            columns = {}
+            for library_id, id_no, key_id, value in float_rows:
+                columns.setdefault(key_id, []).append((value, id_no))
+            for library_id, id_no, key_id, value in string_rows:
+                if key_id in self._label_columns:
+                    columns.setdefault(key_id, []).append((None, id_no))
+
+            for key_id, rows in columns.items():
+                if key_id not in self._label_columns:
+                    self._pending_label_columns.add(key_id)
+                    continue
+                self._parameterised_query_many("UPDATE spectrum_labels SET field_{:d}=? WHERE specId=?;".format(key_id),
+                                               rows)
 
     @requires_ids_or_filenames
-    def open(self, ids=None, filenames=None, shared_memory=False):
+    def open(self, ids=None, filenames=None, shared_memory=False, mmap=False, workers=None, use_processes=False,
+             dtype=None, lazy=False, lambda_min=None, lambda_max=None):
         """
         Open some spectra from this spectrum library, and return them as a SpectrumArray object.
+
+        If <mmap> is set, the SpectrumArray is memory-mapped from disk rather than copied into memory, so that many
+        processes can share a single copy of (for example) a library of template spectra through the page cache. In
+        slab-format libraries, a consecutive run of spectra within a single slab is mapped directly. Otherwise, the
+        requested spectra are first packed into a cache file within the library, which is reused by subsequent calls
+        requesting the same spectra. Only the <_mmap_cache_size> most recently used cache files are kept. Libraries
+        opened read-only never write cache files: if no cache file exists, the spectra are read into memory instead.
+
+        If <lazy> is set, the spectra are not read from disk until their values or value errors are first used.
+        This is much quicker for scripts which only use the spectra's metadata, or a few of the spectra.
+
+        If <lambda_min> or <lambda_max> are set, the SpectrumArray only contains the pixels within this wavelength
+        window. In libraries which store spectra in uncompressed binary files or slabs, only these pixels are read
+        from disk.
         
         :param ids: 
             List of the integer ids of the spectra to receive this metadata, or None to select them by filename.
@@ -678,25 +2237,497 @@ REPLACE INTO spectrum_metadata (libraryId, specId, fieldId, valueString) VALUES
             
         :type shared_memory:
             bool
+
+        :param mmap:
+            Boolean flag indicating whether this SpectrumArray should be memory-mapped, read-only, from disk.
+
+        :type mmap:
+            bool
+
+        :param workers:
+            In libraries which store each spectrum in its own file, the number of files to read concurrently, or None
+            to read them one at a time.
+
+        :type workers:
+            int or None
+
+        :param use_processes:
+            Boolean specifying whether to read files using a pool of processes, rather than a pool of threads. This is
+            quicker for libraries of text files, where parsing the files is the bottleneck.
+
+        :type use_processes:
+            bool
+
+        :param dtype:
+            The floating-point type used to hold the values and value errors in memory, either float64 or float32.
+            None to use the type the library stores spectra in. Memory-mapped spectra use whatever type they are
+            stored in.
+
+        :type dtype:
+            np.dtype or str or None
+
+        :param lazy:
+            Boolean flag indicating whether to return a LazySpectrumArray, which defers reading the spectra from disk
+            until they are needed.
+
+        :type lazy:
+            bool
+
+        :param lambda_min:
+            The shortest wavelength to include in the SpectrumArray, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include in the SpectrumArray, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
             
         :return:
             A SpectrumArray object.
         """
 
-        if ids is not None:
-            filenames = self._ids_to_filenames(ids=ids)
+        assert not (mmap and shared_memory), "Memory-mapped SpectrumArrays cannot also use shared memory."
+        assert not (mmap and lazy), "Memory-mapped SpectrumArrays cannot also be lazy."
+
+        if filenames is not None:
+            ids = self._filenames_to_ids(filenames=filenames)
+        ids = [int(item) for item in ids]
+
+        metadata_list = self.get_metadata(ids=ids)
+        locations = self._spectrum_locations(ids=ids)
+
+        if mmap:
+            return self._open_memory_mapped(ids=ids, locations=locations, metadata_list=metadata_list,
+                                            workers=workers, use_processes=use_processes,
+                                            lambda_min=lambda_min, lambda_max=lambda_max)
+
+        if lazy:
+            # The loader only reads files, so it is safe to call from other threads. The LazySpectrumArray narrows any
+            # wavelength window requested from it to lie within the window we were asked to open.
+            def loader(indices=None, lambda_min=None, lambda_max=None):
+                if indices is None:
+                    indices = range(len(locations))
+                return self._read_spectra(locations=[locations[i] for i in indices],
+                                          metadata_list=[metadata_list[i] for i in indices],
+                                          shared_memory=shared_memory,
+                                          workers=workers,
+                                          use_processes=use_processes,
+                                          dtype=dtype,
+                                          lambda_min=lambda_min,
+                                          lambda_max=lambda_max)
+
+            # If we know the wavelength raster of the spectra, we don't need to read them to find it out
+            wavelengths = None
+            raster_ids = set(item[1] for item in locations)
+            if len(raster_ids) == 1 and None not in raster_ids:
+                wavelengths = self._load_raster(*locations[0][1:3])
+                wavelengths = wavelengths[SpectrumArray._pixel_window(wavelengths, lambda_min=lambda_min,
+                                                                      lambda_max=lambda_max)]
+            return LazySpectrumArray(loader=loader, metadata_list=metadata_list, wavelengths=wavelengths,
+                                     shared_memory=shared_memory, lambda_min=lambda_min, lambda_max=lambda_max)
+
+        return self._read_spectra(locations=locations,
+                                  metadata_list=metadata_list,
+                                  shared_memory=shared_memory,
+                                  workers=workers,
+                                  use_processes=use_processes,
+                                  dtype=dtype,
+                                  lambda_min=lambda_min,
+                                  lambda_max=lambda_max)
+
+    def _open_memory_mapped(self, ids, locations, metadata_list, workers=None, use_processes=False,
+                            lambda_min=None, lambda_max=None):
+        """
+        Open a list of spectra as a read-only SpectrumArray which is memory-mapped from disk.
+
+        :param ids:
+            A list of integer ids of the spectra to open.
+
+        :type ids:
+            List of int
+
+        :param locations:
+            A list of the locations of the spectra to read, as returned by <_spectrum_locations>.
+
+        :type locations:
+            List of tuple
+
+        :param metadata_list:
+            A list of dictionaries of metadata about each of the spectra.
+
+        :type metadata_list:
+            List of dict
+
+        :param workers:
+            The number of files to read concurrently when building a cache file, or None to read them one at a time.
+
+        :type workers:
+            int or None
+
+        :param use_processes:
+            Boolean specifying whether to read files using a pool of processes, rather than a pool of threads.
+
+        :type use_processes:
+            bool
+
+        :param lambda_min:
+            The shortest wavelength to include in the SpectrumArray, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include in the SpectrumArray, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :return:
+            A SpectrumArray object.
+        """
+
+        # If the spectra are a consecutive run of rows in a single slab, we can map the slab directly
+        if self._format == "slab" and len(set(item[1] for item in locations)) == 1:
+            slab_filename, first_row = locations[0][3:]
+            if all(item[3:] == (slab_filename, first_row + i) for i, item in enumerate(locations)):
+                return SpectrumArray.from_slabs(path=self._path,
+                                                wavelengths=self._load_raster(*locations[0][1:3]),
+                                                slab_rows=[item[3:] for item in locations],
+                                                metadata_list=metadata_list,
+                                                mmap=True,
+                                                lambda_min=lambda_min,
+                                                lambda_max=lambda_max)
+
+        # Otherwise, pack the spectra into a cache file. The import times of the spectra are included in the cache
+        # key, so that the cache is not reused if any of the spectra are overwritten.
+        import_times = dict(self._query_in_chunks(
+            sql="SELECT specId, importTime FROM spectra WHERE libraryId=? AND specId IN ({});",
+            keys=list(set(ids)),
+            parameters=(self._library_id,)))
+        cache_key = hashlib.sha1(json.dumps([[item, import_times[item]] for item in ids]).encode('utf-8'))
+        cache_filename = os_path.join(self._path, "{}.mmap.npy".format(cache_key.hexdigest()))
+
+        if not os_path.exists(cache_filename):
+            # We cannot write a cache file into a library which is open read-only
+            if self._read_only:
+                logger.info("No memory-mapping cache file exists for these spectra, so reading them into memory.")
+                return self._read_spectra(locations=locations, metadata_list=metadata_list,
+                                          workers=workers, use_processes=use_processes,
+                                          lambda_min=lambda_min, lambda_max=lambda_max)
+
+            # Write the cache file under a temporary name, so that other processes never see a partial file
+            temporary_filename = "{}.{}.tmp".format(cache_filename, hashlib.md5(os.urandom(32)).hexdigest()[:8])
+            spectra = self._read_spectra(locations=locations, metadata_list=metadata_list,
+                                         workers=workers, use_processes=use_processes)
+            spectra.to_packed_file(filename=temporary_filename)
+            os.rename(temporary_filename, cache_filename)
+            self._expire_mmap_cache()
+        elif not self._read_only:
+            # Mark this cache file as recently used
+            os.utime(cache_filename, None)
+
+        spectra = SpectrumArray.from_packed_file(filename=cache_filename,
+                                                 metadata_list=metadata_list,
+                                                 mmap=True)
+        if lambda_min is not None or lambda_max is not None:
+            spectra = spectra.window(lambda_min=lambda_min, lambda_max=lambda_max)
+        return spectra
+
+    def _expire_mmap_cache(self):
+        """
+        Delete the least recently used memory-mapping cache files within this library, so that no more than
+        <_mmap_cache_size> of them are kept. Cache files are marked as used by updating their modification times.
+
+        :return:
+            None
+        """
+
+        # Other processes may delete cache files while we are doing this, or (on Windows) may still have them mapped
+        cache_files = []
+        for item in os.listdir(self._path):
+            if item.endswith(".mmap.npy"):
+                try:
+                    cache_files.append((os_path.getmtime(os_path.join(self._path, item)), item))
+                except OSError:
+                    pass
+        if len(cache_files) <= self._mmap_cache_size:
+            return
+
+        cache_files.sort(reverse=True)
+        for modification_time, item in cache_files[self._mmap_cache_size:]:
+            try:
+                os.unlink(os_path.join(self._path, item))
+            except OSError:
+                pass
+
+    def _spectrum_locations(self, ids):
+        """
+        Look up where a list of spectra are stored on disk.
+
+        :param ids:
+            A list of integer ids of the spectra to look up.
+
+        :type ids:
+            List of int
+
+        :return:
+            A list of tuples, one per spectrum, of the form (filename, raster id, raster filename, slab filename,
+            slab row). The raster id and filename are None for spectra imported by old versions of this code, which
+            did not record the raster. The slab filename and row are None unless this library stores spectra in slabs.
+        """
+
+        lookup = dict((item[0], (str(item[1]), item[2], item[3], item[4], item[5]))
+                      for item in self._query_in_chunks(sql="""
+SELECT s.specId, COALESCE(s.dataFilename, s.filename), s.rasterId, r.filename, sl.filename, s.slabRow
+FROM spectra s
+LEFT JOIN rasters r ON r.rasterId=s.rasterId
+LEFT JOIN slabs sl ON sl.slabId=s.slabId
+WHERE s.libraryId=? AND s.specId IN ({});
+""", keys=list(set(ids)), parameters=(self._library_id,)))
+
+        assert len(lookup) == len(set(ids)), "Some of the requested IDs did not exist in database. " \
+                                             "Matched {} of {} IDs.".format(len(lookup), len(set(ids)))
+        return [lookup[item] for item in ids]
+
+    def _load_raster(self, raster_id, raster_filename):
+        """
+        Read a wavelength raster from disk, caching it in memory so that each raster is only read once.
+
+        :param raster_id:
+            The numerical id of the raster.
+
+        :type raster_id:
+            int
+
+        :param raster_filename:
+            The filename of the binary file containing the raster.
+
+        :type raster_filename:
+            str
+
+        :return:
+            np.ndarray
+        """
+
+        if raster_id not in self._rasters:
+            self._rasters[raster_id] = np.load(os_path.join(self._path, str(raster_filename)))
+        return self._rasters[raster_id]
+
+    def _read_spectra(self, locations, metadata_list, shared_memory=False, workers=None, use_processes=False,
+                      dtype=None, lambda_min=None, lambda_max=None):
+        """
+        Read spectra from disk into a SpectrumArray. This does not touch the database, and so is safe to call from a
+        background thread.
+
+        :param locations:
+            A list of the locations of the spectra to read, as returned by <_spectrum_locations>.
+
+        :type locations:
+            List of tuple
+
+        :param metadata_list:
+            A list of dictionaries of metadata about each of the spectra.
+
+        :type metadata_list:
+            List of dict
+
+        :param shared_memory:
+            Boolean flag indicating whether this SpectrumArray should use multiprocessing shared memory.
+
+        :type shared_memory:
+            bool
+
+        :param workers:
+            The number of files to read concurrently, or None to read them one at a time.
 
-        metadata_list = self.get_metadata(filenames=filenames)
+        :type workers:
+            int or None
 
-        return SpectrumArray.from_files(path=self._path,
-                                        filenames=filenames,
-                                        binary=self._binary_spectra,
+        :param use_processes:
+            Boolean specifying whether to read files using a pool of processes, rather than a pool of threads.
+
+        :type use_processes:
+            bool
+
+        :param dtype:
+            The floating-point type used to hold the values and value errors in memory, either float64 or float32.
+            None to use the type the library stores spectra in.
+
+        :type dtype:
+            np.dtype or str or None
+
+        :param lambda_min:
+            The shortest wavelength to include in the SpectrumArray, or None to start at the beginning of the raster.
+
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include in the SpectrumArray, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :return:
+            A SpectrumArray object.
+        """
+
+        if dtype is None:
+            dtype = self._dtype
+
+        # If we know which raster every spectrum is sampled on, we can check they match by comparing integer ids
+        # rather than reading and hashing the raster stored alongside every spectrum
+        raster_ids = set(item[1] for item in locations)
+        wavelengths = None
+        if None not in raster_ids:
+            assert len(raster_ids) == 1, \
+                "Cannot open spectra sampled on different wavelength rasters into a single SpectrumArray."
+            wavelengths = self._load_raster(*locations[0][1:3])
+
+        if self._format != "slab":
+            return SpectrumArray.from_files(path=self._path,
+                                            filenames=[item[0] for item in locations],
+                                            binary=self._binary_spectra,
+                                            compressed=self._codec is not None,
+                                            wavelengths=wavelengths,
+                                            metadata_list=metadata_list,
+                                            shared_memory=shared_memory,
+                                            workers=workers,
+                                            use_processes=use_processes,
+                                            dtype=dtype,
+                                            lambda_min=lambda_min,
+                                            lambda_max=lambda_max)
+
+        return SpectrumArray.from_slabs(path=self._path,
+                                        wavelengths=wavelengths,
+                                        slab_rows=[item[3:] for item in locations],
                                         metadata_list=metadata_list,
-                                        shared_memory=shared_memory)
+                                        shared_memory=shared_memory,
+                                        dtype=dtype,
+                                        lambda_min=lambda_min,
+                                        lambda_max=lambda_max)
+
+    def iter_spectra(self, chunk_size=1000, ids=None, prefetch=True, workers=None, dtype=None, lambda_min=None,
+                     lambda_max=None, **kwargs):
+        """
+        Iterate over the spectra within this SpectrumLibrary which fall within some metadata constraints, yielding
+        them in SpectrumArray objects of at most <chunk_size> spectra each. This allows scripts to work through very
+        large libraries without holding every spectrum in memory at once. Spectra are yielded in the same order as
+        they are returned by <search>, or in the order of <ids>. Chunks are split wherever the wavelength raster
+        changes, so chunks may contain fewer than <chunk_size> spectra in libraries with several rasters.
+
+        While the caller is working on one chunk, the next chunk is read from disk by a background thread, so that the
+        iterator itself holds at most two chunks in memory at any time. All database queries are made from the
+        calling thread.
+
+        :param chunk_size:
+            The maximum number of spectra to include in each SpectrumArray.
+
+        :type chunk_size:
+            int
+
+        :param ids:
+            List of the integer ids of the spectra to iterate over, or None to iterate over the results of a search
+            with the metadata constraints <kwargs>.
+
+        :type ids:
+            List of int, or None
+
+        :param prefetch:
+            Boolean flag indicating whether to read the next chunk in a background thread while the caller is
+            working on the current one.
+
+        :type prefetch:
+            bool
+
+        :param workers:
+            In libraries which store each spectrum in its own file, the number of files to read concurrently within
+            each chunk, or None to read them one at a time.
+
+        :type workers:
+            int or None
+
+        :param dtype:
+            The floating-point type used to hold the values and value errors in memory, either float64 or float32.
+            None to use the type the library stores spectra in.
+
+        :type dtype:
+            np.dtype or str or None
+
+        :param lambda_min:
+            The shortest wavelength to include in the SpectrumArray, or None to start at the beginning of the raster.
 
-    def insert(self, spectra, filenames=None, origin="Undefined", metadata_list=None, overwrite=False):
+        :type lambda_min:
+            float or None
+
+        :param lambda_max:
+            The longest wavelength to include in the SpectrumArray, or None to continue to the end of the raster.
+
+        :type lambda_max:
+            float or None
+
+        :param kwargs:
+            A dictionary of metadata constraints, in the same format as accepted by <search>.
+
+        :return:
+            A generator of SpectrumArray objects.
+        """
+
+        assert chunk_size > 0, "Chunk size must be a positive integer."
+        assert ids is None or not kwargs, "Must supply either a list of Ids or metadata constraints, not both."
+
+        if ids is None:
+            ids = [item["specId"] for item in self.search(**kwargs)]
+        ids = [int(item) for item in ids]
+
+        def fetch_chunks():
+            for index in range(0, len(ids), chunk_size):
+                chunk_ids = ids[index:index + chunk_size]
+                locations = self._spectrum_locations(ids=chunk_ids)
+                metadata_list = self.get_metadata(ids=chunk_ids)
+
+                # Split the chunk wherever the wavelength raster changes, since a SpectrumArray must have one raster
+                start = 0
+                for end in range(1, len(locations) + 1):
+                    if end == len(locations) or locations[end][1] != locations[start][1]:
+                        yield {"locations": locations[start:end],
+                               "metadata_list": metadata_list[start:end],
+                               "workers": workers,
+                               "dtype": dtype,
+                               "lambda_min": lambda_min,
+                               "lambda_max": lambda_max}
+                        start = end
+
+        if not prefetch:
+            for chunk in fetch_chunks():
+                yield self._read_spectra(**chunk)
+            return
+
+        # Only disk reads happen in the background thread; database connections may not be shared between threads
+        executor = ThreadPoolExecutor(max_workers=1)
+        try:
+            pending = None
+            for chunk in fetch_chunks():
+                upcoming = executor.submit(self._read_spectra, **chunk)
+                if pending is not None:
+                    yield pending.result()
+                pending = upcoming
+            if pending is not None:
+                yield pending.result()
+        finally:
+            executor.shutdown(wait=True)
+
+    def insert(self, spectra, filenames=None, origin="Undefined", metadata_list=None, overwrite=False, workers=None):
         """
-        Insert the spectra from a SpectrumArray object into this spectrum library.
+        Insert the spectra from a SpectrumArray object into this spectrum library. In libraries which deduplicate
+        spectra (see <enable_deduplication>), spectra identical to one already stored are not written to disk again.
+
+        In libraries which store spectra in slabs, each call to <insert> outside a <bulk_insert> block writes its
+        spectra into a new slab file as soon as it returns, so that they can be searched for straight away. Inserting
+        spectra one at a time into such libraries should always be done within a <bulk_insert> block.
         
         :param spectra: 
             A SpectrumArray or single Spectrum object containing the spectra to be inserted into this spectrum library.
@@ -714,10 +2745,10 @@ REPLACE INTO spectrum_metadata (libraryId, specId, fieldId, valueString) VALUES
             
         :param origin: 
             A string describing where these spectra are being imported from. Normally the name of the module which is
-            importing them.
+            importing them. Alternatively, a list with a separate origin for each spectrum.
             
         :type origin:
-            str
+            str or List[str]
             
         :param metadata_list: 
             A list of dictionaries of metadata to set on each of the spectra in this SpectrumArray, or a single
@@ -731,18 +2762,33 @@ REPLACE INTO spectrum_metadata (libraryId, specId, fieldId, valueString) VALUES
             
         :type overwrite:
             bool
+
+        :param workers:
+            In libraries which store each spectrum in its own file, the number of files to write concurrently, or None
+            to write them one at a time.
+
+        :type workers:
+            int or None
             
         :return:
             None
         """
 
+        assert not self._read_only, "Cannot modify a spectrum library which was opened read-only."
+
+        # In libraries which store spectra in slabs, the spectra are held in memory until the database is committed,
+        # so that spectra inserted within a <bulk_insert> block are packed together into large slab files.
+
         # Sanity check input
         if not isinstance(filenames, (list, tuple)):
             filenames = [filenames]
         if not isinstance(metadata_list, (list, tuple)):
             metadata_list = [metadata_list] * len(filenames)
+        if not isinstance(origin, (list, tuple)):
+            origin = [origin] * len(filenames)
 
         assert len(filenames) == len(metadata_list), "Inconsistent number of items being inserted."
+        assert len(filenames) == len(origin), "Inconsistent number of items being inserted."
 
         if isinstance(spectra, Spectrum):
             assert len(filenames) == 1
@@ -751,47 +2797,106 @@ REPLACE INTO spectrum_metadata (libraryId, specId, fieldId, valueString) VALUES
         else:
             raise TypeError("Argument 'spectra' must be either a Spectrum or a SpectrumArray.")
 
-        # Fetch the numerical id of the origin of these spectra
-        origin_id = self._fetch_origin_id(origin)
-
-        # Delete cached spectrum count
-        if os.path.isfile(os_path.join(self._path, "spectrum_count")):
-            os.unlink(os_path.join(self._path, "spectrum_count"))
-
-        # Insert each spectrum in turn
-        for index, (filename_stub, metadata) in enumerate(zip(filenames, metadata_list)):
+        # Fetch the numerical ids of the origins of these spectra, and of the wavelength raster they are sampled on
+        origin_ids = [self._fetch_origin_id(item) for item in origin]
+        raster_id = None
+        if self._format != "slab":
+            raster_id = self._fetch_raster_id(wavelengths=spectra.wavelengths, raster_hash=spectra.raster_hash)
+
+        # In libraries which deduplicate spectra, hash the contents of each spectrum, and look up which of them are
+        # already stored
+        content_hashes = [None] * len(filenames)
+        stored_copies = {}
+        if self._deduplicate:
+            if isinstance(spectra, Spectrum):
+                content_hashes = [self._content_hash(raster_hash=spectra.raster_hash, values=spectra.values,
+                                                     value_errors=spectra.value_errors, dtype=self._dtype)]
+            else:
+                content_hashes = [self._content_hash(raster_hash=spectra.raster_hash, values=spectra.values[index],
+                                                     value_errors=spectra.value_errors[index], dtype=self._dtype)
+                                  for index in range(len(spectra))]
+            stored_copies = self._fetch_stored_copies(content_hashes=content_hashes)
+
+        # Write each spectrum to disk in turn, building a list of the database entries we need to create
+        import_time = time.time()
+        spectra_rows = []
+        metadata_items = []
+        file_writes = []
+        for index, (filename_stub, metadata, origin_id, content_hash) in enumerate(zip(filenames, metadata_list,
+                                                                                        origin_ids, content_hashes)):
 
             # Add suffix to filename to ensure it is unique, and it is gzipped if requested
             if filename_stub is None:
                 filename_stub = hashlib.md5(os.urandom(32)).hexdigest()[:16]
             random_key = hashlib.md5(os.urandom(32)).hexdigest()[:8]
             filename = "{}.{}.spec".format(filename_stub, random_key)
-            if self._binary_spectra:
+            if self._format == "slab":
+                filename += ".slab"
+            elif self._binary_spectra:
                 filename += ".npy"
+            elif self._codec is not None:
+                filename += ".cz"
             elif self._gzip:
                 filename += ".gz"
 
-            # Write spectrum to text file
+            # Metadata passed to this method overrides any metadata carried by the spectrum itself
             spectrum = spectra if isinstance(spectra, Spectrum) else spectra.extract_item(index)
-            success = spectrum.to_file(filename=os_path.join(self._path, filename),
-                                       overwrite=overwrite,
-                                       binary=self._binary_spectra)
-            if not success:
+            item_metadata = spectrum.metadata.copy()
+            if metadata is not None:
+                item_metadata.update(metadata)
+
+            # Spectra identical to one already stored refer to the existing copy rather than being written again
+            if content_hash in stored_copies:
+                data_filename, stored_raster_id, slab_id, slab_row = stored_copies[content_hash]
+                if self._format == "slab":
+                    spectra_rows.append((filename, origin_id, import_time, stored_raster_id, slab_id, slab_row,
+                                         content_hash, None))
+                else:
+                    spectra_rows.append((filename, origin_id, import_time, raster_id, None, None,
+                                         content_hash, data_filename))
+                metadata_items.append(item_metadata)
                 continue
 
-            # Create database entry a spectrum
-            self._parameterised_query("""
-REPLACE INTO spectra (filename, originId, libraryId, importTime)
- VALUES (?, ?, ?, ?);
-            """, (filename, origin_id, self._library_id, time.time()))
+            # Spectra stored in slabs are queued up and written to disk in batches
+            if self._format == "slab":
+                self._stage_slab_row(spectrum=spectrum, filename=filename, origin_id=origin_id,
+                                     import_time=import_time, metadata=item_metadata, content_hash=content_hash)
+                continue
 
-            # Set metadata on this spectrum
-            self.set_metadata(filenames=(filename,), metadata=spectrum.metadata)
-            if metadata is not None:
-                self.set_metadata(filenames=(filename,), metadata=metadata)
+            if content_hash is not None:
+                stored_copies[content_hash] = (filename, raster_id, None, None)
+            file_writes.append((spectrum, filename))
+            spectra_rows.append((filename, origin_id, import_time, raster_id, None, None, content_hash, None))
+            metadata_items.append(item_metadata)
+
+        # Write spectra to disk, possibly in parallel, and only create database entries for those which succeeded
+        if file_writes:
+            def write_file(item):
+                return item[0].to_file(filename=os_path.join(self._path, item[1]),
+                                       overwrite=overwrite,
+                                       binary=self._binary_spectra,
+                                       include_wavelengths=(self._format != "npy" and self._codec is None),
+                                       codec=self._codec,
+                                       dtype=self._dtype)
+
+            if workers is not None and workers > 1 and len(file_writes) > 1:
+                with ThreadPoolExecutor(max_workers=workers) as executor:
+                    successes = list(executor.map(write_file, file_writes))
+            else:
+                successes = [write_file(item) for item in file_writes]
+
+            # Duplicates of spectra in this batch are only kept if the file they refer to was written
+            failed = set(item[1] for item, success in zip(file_writes, successes) if not success)
+            keep = [row[0] not in failed and row[7] not in failed for row in spectra_rows]
+            spectra_rows = [row for row, success in zip(spectra_rows, keep) if success]
+            metadata_items = [item for item, success in zip(metadata_items, keep) if success]
+
+        # Create database entries for all the spectra at once
+        if spectra_rows:
+            self._create_spectra_records(rows=spectra_rows, metadata_list=metadata_items)
 
         # Commit changes into database
-        self._db.commit()
+        self._commit()
 
     def _parameterised_query(self, sql, parameters=None):
         raise NotImplementedError
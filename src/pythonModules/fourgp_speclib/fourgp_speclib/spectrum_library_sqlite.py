@@ -4,6 +4,7 @@ import os
 from os import path as os_path
 import re
 import sqlite3
+from urllib.request import pathname2url
 
 from .spectrum_library_sql import SpectrumLibrarySql
 
@@ -14,11 +15,37 @@ class SpectrumLibrarySqlite(SpectrumLibrarySql):
     
     :cvar string _index_file_name:
         The filename used to store the SQLite database within the directory holding this SpectrumLibrary.
+
+    :cvar dict _performance_profiles:
+        Named sets of SQLite PRAGMA settings which can be applied when a library is opened. The <concurrent> profile
+        uses write-ahead logging, so that many processes can read a library while another process writes to it. The
+        <bulk_import> profile additionally stops SQLite from waiting for each transaction to reach the disk, which is
+        much faster for large imports, but may corrupt the database if the machine crashes during the import.
     """
 
     _index_file_name = "index.db"
 
-    def __init__(self, path, create=False, gzip_spectra=True, binary_spectra=True):
+    _performance_profiles = {
+        "default": {},
+        "concurrent": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "cache_size": -65536,
+            "mmap_size": 268435456,
+            "busy_timeout": 60000
+        },
+        "bulk_import": {
+            "journal_mode": "WAL",
+            "synchronous": "OFF",
+            "cache_size": -262144,
+            "mmap_size": 268435456,
+            "temp_store": "MEMORY",
+            "busy_timeout": 60000
+        }
+    }
+
+    def __init__(self, path, create=False, gzip_spectra=True, binary_spectra=True, storage_format=None,
+                 profile="default", pragmas=None, read_only=False, dtype="float64"):
         """
         Create a new SpectrumLibrary object, storing metadata about the spectra in an SQLite database.
         
@@ -50,13 +77,60 @@ class SpectrumLibrarySqlite(SpectrumLibrarySql):
 
         :type binary_spectra:
             bool
+
+        :param storage_format:
+            The format in which to store spectra on disk, which must be one of the entries in <_storage_formats>. If
+            set, this overrides <gzip_spectra> and <binary_spectra>.
+            This setting is a property of stored when new libraries are created, and the argument is ignored if
+            we are not creating a new library.
+
+        :type storage_format:
+            str or None
+
+        :param profile:
+            The name of the set of SQLite settings to apply to the database connection, which must be one of the
+            entries in <_performance_profiles>.
+
+        :type profile:
+            str
+
+        :param pragmas:
+            A dictionary of SQLite PRAGMA settings to apply on top of those in <profile>, for example
+            {"cache_size": -1048576}.
+
+        :type pragmas:
+            dict or None
+
+        :param read_only:
+            If true, open the database read-only. Many processes can safely read a library in this mode, even while
+            another process is writing to it, if the library uses write-ahead logging (e.g. the <concurrent>
+            profile).
+
+        :type read_only:
+            bool
+
+        :param dtype:
+            The floating-point type used to store the values and value errors of spectra on disk, either float64 or
+            float32. See <SpectrumLibrarySql>.
+            This setting is a property of stored when new libraries are created, and the argument is ignored if
+            we are not creating a new library.
+
+        :type dtype:
+            np.dtype or str
         """
 
+        assert profile in self._performance_profiles, "Unknown SQLite performance profile <{}>".format(profile)
+
         self._db = None
         self._db_cursor = None
+        self._pragmas = dict(self._performance_profiles[profile])
+        if pragmas is not None:
+            self._pragmas.update(pragmas)
 
         super(SpectrumLibrarySqlite, self).__init__(path=path, create=create,
-                                                    gzip_spectra=gzip_spectra, binary_spectra=binary_spectra)
+                                                    gzip_spectra=gzip_spectra, binary_spectra=binary_spectra,
+                                                    storage_format=storage_format, read_only=read_only,
+                                                    dtype=dtype)
 
     def _create_database(self):
         """
@@ -72,22 +146,63 @@ class SpectrumLibrarySqlite(SpectrumLibrarySql):
         assert not os_path.exists(db_path), \
             "Attempting to overwrite SQLite database <{}> that already exists.".format(db_path)
 
-        # SQLite databases work faster if primary keys don't auto increment, so remove keyword from schema
         db = sqlite3.connect(db_path)
         c = db.cursor()
-        schema = re.sub("AUTO_INCREMENT", "", self._schema)
-        c.executescript(schema)
+        c.executescript(self._schema_statement(self._schema))
         db.commit()
         db.close()
 
+    def _schema_statement(self, statement):
+        # SQLite databases work faster if primary keys don't auto increment, so remove keyword from schema
+        return re.sub("AUTO_INCREMENT", "", statement)
+
+    def _database_size(self):
+        return sum(os_path.getsize(self._path_db + suffix) for suffix in ("", "-wal")
+                   if os_path.exists(self._path_db + suffix))
+
+    def _optimise_database(self):
+        self._db.commit()
+        for statement in ("REINDEX;", "ANALYZE;", "VACUUM;"):
+            self._db_cursor.execute(statement)
+        if self._pragmas.get("journal_mode", "").upper() == "WAL":
+            self._db_cursor.execute("PRAGMA wal_checkpoint(TRUNCATE);")
+            self._db_cursor.fetchall()
+
+    def _list_tables(self):
+        self._parameterised_query("SELECT name FROM sqlite_master WHERE type='table';")
+        return [item[0] for item in self._db_cursor.fetchall()]
+
+    def _list_columns(self, table):
+        self._parameterised_query("PRAGMA table_info({});".format(table))
+        return [item[1] for item in self._db_cursor.fetchall()]
+
+    def _list_indices(self, table):
+        self._parameterised_query("PRAGMA index_list({});".format(table))
+        return [item[1] for item in self._db_cursor.fetchall()]
+
     def _open_database(self):
         self._path_db = os_path.join(self._path, self._index_file_name)
 
         assert os_path.exists(self._path_db), \
             "Attempting to open an SQLite database <{}> that doesn't exist.".format(self._path_db)
 
-        self._db = sqlite3.connect(self._path_db)
+        if self._read_only:
+            self._db = sqlite3.connect("file:{}?mode=ro".format(pathname2url(os_path.abspath(self._path_db))),
+                                       uri=True)
+        else:
+            self._db = sqlite3.connect(self._path_db)
         self._db_cursor = self._db.cursor()
+
+        # Apply performance settings. The journal mode is stored in the database file, and can only be changed by
+        # a connection which can write to it.
+        for key, value in sorted(self._pragmas.items()):
+            assert re.match(r"^\w+$", key) and re.match(r"^[\w-]+$", str(value)), \
+                "Illegal SQLite PRAGMA <{}={}>".format(key, value)
+            if self._read_only and key == "journal_mode":
+                continue
+            self._db_cursor.execute("PRAGMA {}={};".format(key, value))
+            self._db_cursor.fetchall()
+
         return self._db, self._db_cursor
 
     def purge(self):
@@ -100,9 +215,12 @@ class SpectrumLibrarySqlite(SpectrumLibrarySql):
 
         super(SpectrumLibrarySqlite, self).purge()
 
-        # Delete SQLite file
+        # Delete SQLite file, together with any write-ahead log
         self._db.close()
         os.unlink(os_path.join(self._path_db))
+        for suffix in ("-wal", "-shm"):
+            if os_path.exists(self._path_db + suffix):
+                os.unlink(self._path_db + suffix)
 
     def _parameterised_query(self, sql, parameters=None):
         if parameters is None:
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the pool of database connections shared by spectrum libraries
+"""
+
+import sqlite3
+import threading
+import unittest
+import fourgp_speclib
+
+
+class TestConnectionPool(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a pool of connections to an in-memory SQLite database, which stands in for a database server.
+        """
+        self._connections_opened = 0
+
+        def connect():
+            self._connections_opened += 1
+            return sqlite3.connect(":memory:", check_same_thread=False)
+
+        def health_check(connection):
+            connection.execute("SELECT 1;")
+
+        self._pool = fourgp_speclib.ConnectionPool(connect=connect, health_check=health_check, max_size=2)
+
+    def tearDown(self):
+        self._pool.close_idle()
+
+    def test_reuse(self):
+        """
+        Check that connections which are returned to the pool are reused.
+        """
+        connection = self._pool.acquire()
+        self._pool.release(connection)
+        self.assertIs(self._pool.acquire(), connection)
+        self.assertEqual(self._connections_opened, 1)
+        self.assertEqual(len(self._pool), 1)
+
+    def test_health_check(self):
+        """
+        Check that broken connections are replaced rather than being handed out again.
+        """
+        connection = self._pool.acquire()
+        self._pool.release(connection)
+        connection.close()
+        replacement = self._pool.acquire()
+        self.assertIsNot(replacement, connection)
+        self.assertEqual(self._connections_opened, 2)
+        self.assertEqual(len(self._pool), 1)
+
+    def test_max_size(self):
+        """
+        Check that the pool never opens more than <max_size> connections, and that borrowers wait for a connection to
+        be returned.
+        """
+        connection_1 = self._pool.acquire()
+        connection_2 = self._pool.acquire()
+        with self.assertRaises(RuntimeError):
+            self._pool.acquire(timeout=0.05)
+
+        timer = threading.Timer(0.05, self._pool.release, args=(connection_1,))
+        timer.start()
+        self.assertIs(self._pool.acquire(timeout=5), connection_1)
+        timer.join()
+
+        self._pool.discard(connection_2)
+        self.assertEqual(len(self._pool), 1)
+        self._pool.acquire(timeout=0.05)
+        self.assertEqual(self._connections_opened, 3)
+
+    def test_shared_pools(self):
+        """
+        Check that pools are shared by everything in a process which connects to the same database.
+        """
+        pool_1 = fourgp_speclib.ConnectionPool.get(key=("host", "db_1"), connect=lambda: None)
+        pool_2 = fourgp_speclib.ConnectionPool.get(key=("host", "db_1"), connect=lambda: None)
+        pool_3 = fourgp_speclib.ConnectionPool.get(key=("host", "db_2"), connect=lambda: None)
+        self.assertIs(pool_1, pool_2)
+        self.assertIsNot(pool_1, pool_3)
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
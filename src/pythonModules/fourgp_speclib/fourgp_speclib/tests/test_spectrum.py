@@ -72,6 +72,31 @@ class TestSpectrum(unittest.TestCase):
         # Check that we got back the same spectrum we put in
         self.assertEqual(self._spectrum, new_spectrum)
 
+    def test_spectrum_retrieval_compressed(self):
+        for codec in fourgp_speclib.spectrum_codec.available_codecs():
+            unique_filename = str(uuid.uuid4())
+            unique_path = os_path.join("/tmp", unique_filename + ".cz")
+            self._spectrum.to_file(unique_path, codec=codec)
+            new_spectrum = self._spectrum.from_file(unique_path, compressed=True)
+            os.unlink(unique_path)
+
+            # Check that we got back the same spectrum we put in
+            self.assertEqual(self._spectrum, new_spectrum)
+            self.assertTrue(np.array_equal(self._spectrum.value_errors, new_spectrum.value_errors))
+
+    def test_spectrum_codec_output_buffers(self):
+        rows = [self._raster.astype(float), self._values.astype(float), self._value_errors]
+        data = fourgp_speclib.spectrum_codec.encode_spectrum(rows=rows, dtype=np.float32)
+
+        # Decode the last two rows into preallocated buffers of both single and double precision
+        for dtype in (np.float32, np.float64):
+            out = [np.zeros(self._size, dtype=dtype), np.zeros(self._size, dtype=dtype)]
+            decoded = fourgp_speclib.spectrum_codec.decode_spectrum(data=data, out=out)
+            self.assertIs(decoded[1], out[0])
+            self.assertIs(decoded[2], out[1])
+            self.assertTrue(np.allclose(decoded[0], self._raster))
+            self.assertTrue(np.allclose(out[1], self._value_errors.astype(np.float32)))
+
     def test_spectrum_retrieval_unspecified_format(self):
         unique_filename = str(uuid.uuid4())
         unique_path = os_path.join("/tmp", unique_filename + ".npy")
@@ -82,6 +107,31 @@ class TestSpectrum(unittest.TestCase):
         # Check that we got back the same spectrum we put in
         self.assertEqual(self._spectrum, new_spectrum)
 
+    def test_raster_hash(self):
+        """
+        Check that raster hashes do not depend on the memory layout of the raster, are shared by spectra sampled on
+        the same raster, and are updated when the raster changes.
+        """
+
+        raster = np.linspace(4000, 5000, 2 * self._size)
+        self.assertEqual(fourgp_speclib.hash_numpy_array(raster[::2]),
+                         fourgp_speclib.hash_numpy_array(raster[::2].copy()))
+
+        spectrum_1 = fourgp_speclib.Spectrum(wavelengths=raster, values=raster, value_errors=raster)
+        spectrum_2 = fourgp_speclib.Spectrum(wavelengths=raster.copy(), values=raster, value_errors=raster)
+        self.assertEqual(spectrum_1.raster_hash, spectrum_2.raster_hash)
+        self.assertTrue(fourgp_speclib.same_raster(spectrum_1, spectrum_2))
+        self.assertFalse(fourgp_speclib.same_raster(spectrum_1, self._spectrum))
+
+        # Replacing the raster changes the hash
+        spectrum_2.wavelengths = raster * 2
+        self.assertNotEqual(spectrum_1.raster_hash, spectrum_2.raster_hash)
+
+        # Rasters modified in place need their hash to be updated explicitly
+        raster *= 2
+        spectrum_1._update_raster_hash()
+        self.assertEqual(spectrum_1.raster_hash, spectrum_2.raster_hash)
+
     def test_addition_multiplication(self):
         """
         Try adding spectra together repeatedly using the __sum__ and __isum__ methods. Check that this is the same
@@ -177,6 +227,68 @@ class TestSpectrum(unittest.TestCase):
         # Check that none of the calculations failed
         self.assertEqual(failures, 0)
 
+    def test_multiplication_into_buffers(self):
+        """
+        Check that multiplying and dividing spectra into existing arrays gives the same results as the * and /
+        operators, and that the in-place operators do not overwrite arrays shared with other spectra.
+        """
+
+        other = fourgp_speclib.Spectrum(wavelengths=self._raster,
+                                        values=np.random.random(self._size) + 1,
+                                        value_errors=np.random.random(self._size))
+        spectrum = self._spectrum.copy()
+        spectrum.values = spectrum.values.astype(np.float64)
+
+        for method, operator in ((fourgp_speclib.Spectrum.multiply, lambda a, b: a * b),
+                                 (fourgp_speclib.Spectrum.divide, lambda a, b: a / b)):
+            expected = operator(spectrum, other)
+
+            # Write into a separate spectrum
+            output = other.copy()
+            buffers = (output.values, output.value_errors)
+            self.assertIs(method(spectrum, other, out=output), output)
+            self.assertIs(output.values, buffers[0])
+            self.assertTrue(np.allclose(output.values, expected.values))
+            self.assertTrue(np.allclose(output.value_errors, expected.value_errors))
+
+            # Overwrite the spectrum on either side of the operation
+            for out_left in (True, False):
+                left, right = spectrum.copy(), other.copy()
+                method(left, right, out=left if out_left else right)
+                output = left if out_left else right
+                self.assertTrue(np.allclose(output.values, expected.values))
+                self.assertTrue(np.allclose(output.value_errors, expected.value_errors))
+
+        # In-place operators replace the arrays of the spectrum, leaving any other spectra which share them unchanged
+        values = spectrum.values
+        original = values.copy()
+        spectrum *= other
+        self.assertIsNot(spectrum.values, values)
+        self.assertTrue(np.array_equal(values, original))
+
+    def test_scratch_buffer_size_cap(self):
+        """
+        Check that large products are computed correctly, without each thread keeping their scratch memory afterwards.
+        """
+
+        from fourgp_speclib import spectrum as spectrum_module
+        max_bytes = spectrum_module._scratch_buffer_max_bytes
+        spectrum_module._scratch_buffer_max_bytes = 8 * self._size
+        spectrum_module._scratch.buffer = None
+        try:
+            values, value_errors = spectrum_module.propagate_product(np.multiply,
+                                                                     np.ones((4, self._size)) * self._values,
+                                                                     np.ones((4, self._size)) * self._value_errors,
+                                                                     self._values, self._value_errors)
+            expected = self._spectrum * self._spectrum
+            for i in range(4):
+                self.assertTrue(np.allclose(values[i], expected.values))
+                self.assertTrue(np.allclose(value_errors[i], expected.value_errors))
+            buffer = getattr(spectrum_module._scratch, "buffer", None)
+            self.assertTrue(buffer is None or buffer.nbytes <= 8 * self._size)
+        finally:
+            spectrum_module._scratch_buffer_max_bytes = max_bytes
+
     def tearDown(self):
         """
         Tear down Spectrum object.
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+Unit tests for the SpectrumArray class
+"""
+
+import os
+from os import path as os_path
+import uuid
+import unittest
+import numpy as np
+import fourgp_speclib
+
+
+class TestSpectrumArray(unittest.TestCase):
+    def setUp(self):
+        """
+        Create a SpectrumArray object.
+        """
+
+        self._size = 50
+        self._count = 4
+        self._raster = np.linspace(5000, 5100, self._size)
+        self._array = fourgp_speclib.SpectrumArray(wavelengths=self._raster,
+                                                   values=np.random.random((self._count, self._size)) + 1,
+                                                   value_errors=np.random.random((self._count, self._size)),
+                                                   metadata_list=[{"index": i} for i in range(self._count)])
+
+    def test_arithmetic_matches_spectra(self):
+        """
+        Check that arithmetic on whole SpectrumArrays gives the same results as arithmetic on each spectrum in turn.
+        """
+
+        other = fourgp_speclib.SpectrumArray(wavelengths=self._raster,
+                                             values=np.random.random((self._count, self._size)) + 1,
+                                             value_errors=np.random.random((self._count, self._size)),
+                                             metadata_list=[{} for i in range(self._count)])
+        single = other.extract_item(0)
+
+        for operation in (lambda a, b: a + b, lambda a, b: a - b, lambda a, b: a * b, lambda a, b: a / b):
+            for operand in (other, single):
+                result = operation(self._array, operand)
+                self.assertEqual([item["index"] for item in result.metadata_list], list(range(self._count)))
+                for i in range(self._count):
+                    operand_item = operand if operand is single else operand.extract_item(i)
+                    expected = operation(self._array.extract_item(i), operand_item)
+                    self.assertTrue(np.allclose(result.values[i], expected.values))
+                    self.assertTrue(np.allclose(result.value_errors[i], expected.value_errors))
+
+        # In-place operations give the same results as the operators which return new SpectrumArrays, and write them
+        # into the existing arrays
+        values, value_errors = self._array.values, self._array.value_errors
+        expected = ((self._array + other) - single) * other / single
+        self._array += other
+        self._array -= single
+        self._array *= other
+        self._array /= single
+        self.assertIs(self._array.values, values)
+        self.assertIs(self._array.value_errors, value_errors)
+        self.assertTrue(np.allclose(self._array.values, expected.values))
+        self.assertTrue(np.allclose(self._array.value_errors, expected.value_errors))
+
+    def test_arithmetic_requires_common_raster(self):
+        """
+        Check that we cannot do arithmetic on spectra sampled on different rasters, or arrays of different lengths.
+        """
+
+        with self.assertRaises(AssertionError):
+            self._array + self._array.apply_redshift(0.1)
+        with self.assertRaises(AssertionError):
+            self._array + self._array.window(lambda_max=5050)
+        with self.assertRaises(AssertionError):
+            self._array + fourgp_speclib.SpectrumArray(wavelengths=self._raster,
+                                                       values=self._array.values[:2],
+                                                       value_errors=self._array.value_errors[:2],
+                                                       metadata_list=[{}, {}])
+
+    def test_radial_velocity(self):
+        """
+        Check that applying a radial velocity to each spectrum in a SpectrumArray matches shifting each spectrum in
+        turn and interpolating it back onto the original raster.
+        """
+
+        velocities = np.array([-20e3, 0, 15e3, 40e3])
+        shifted = self._array.apply_radial_velocity(velocities)
+        self.assertEqual(shifted.raster_hash, self._array.raster_hash)
+
+        for i in range(self._count):
+            expected = self._array.extract_item(i).apply_radial_velocity(velocities[i])
+            self.assertTrue(np.allclose(shifted.values[i],
+                                        np.interp(self._raster, expected.wavelengths, expected.values)))
+        self.assertTrue(np.allclose(shifted.values[1], self._array.values[1]))
+
+        # A single velocity redshifts the whole raster, like Spectrum.apply_radial_velocity
+        single = self._array.apply_radial_velocity(15e3)
+        expected = self._array.extract_item(0).apply_radial_velocity(15e3)
+        self.assertTrue(np.allclose(single.wavelengths, expected.wavelengths))
+        self.assertTrue(np.array_equal(single.values, self._array.values))
+
+        restored = single.correct_radial_velocity(15e3)
+        self.assertTrue(np.allclose(restored.wavelengths, self._raster))
+
+    def test_mask(self):
+        """
+        Check that masks set on a SpectrumArray are applied to all of its spectra.
+        """
+
+        self._array.mask_exclude(wavelength_max=5020)
+        self._array.mask_exclude(wavelength_min=5080)
+        self._array.mask_include(wavelength_min=5000, wavelength_max=5005)
+        self.assertTrue(self._array.mask_set)
+
+        expected = self._array.extract_item(2)
+        self.assertTrue(expected.mask_set)
+        expected = expected.truncate_to_mask()
+
+        truncated = self._array.truncate_to_mask()
+        self.assertTrue(np.array_equal(truncated.wavelengths, expected.wavelengths))
+        self.assertTrue(np.array_equal(truncated.values[2], expected.values))
+        self.assertEqual(truncated.values.shape[1], np.sum(self._array.mask))
+
+        # Masks are combined by arithmetic
+        other = self._array.copy()
+        other.mask_include()
+        other.mask_exclude(wavelength_min=5050)
+        total = other + self._array
+        self.assertTrue(np.array_equal(total.mask, other.mask * self._array.mask))
+
+        self._array.mask_include()
+        self.assertFalse(self._array.mask_set)
+
+    def test_packed_file(self):
+        """
+        Check that packed files keep the floating-point type of a SpectrumArray, without rounding its raster.
+        """
+
+        filename = os_path.join("/tmp", "speclib_test_{}.npy".format(uuid.uuid4()))
+        for dtype in (np.float64, np.float32):
+            spectra = fourgp_speclib.SpectrumArray(wavelengths=self._raster + 1e-6,
+                                                   values=self._array.values.astype(dtype),
+                                                   value_errors=self._array.value_errors.astype(dtype),
+                                                   metadata_list=self._array.metadata_list)
+            spectra.to_packed_file(filename=filename)
+            packed = fourgp_speclib.SpectrumArray.from_packed_file(filename=filename,
+                                                                   metadata_list=spectra.metadata_list, mmap=True)
+            self.assertEqual(packed.values.dtype, dtype)
+            self.assertTrue(np.array_equal(packed.wavelengths, spectra.wavelengths))
+            self.assertTrue(np.array_equal(packed.values, spectra.values))
+            self.assertTrue(np.array_equal(packed.value_errors, spectra.value_errors))
+            del packed
+            os.unlink(filename)
+
+    def tearDown(self):
+        """
+        Tear down SpectrumArray object.
+        """
+        del self._array
+
+
+# Run tests if we are run from command line
+if __name__ == '__main__':
+    unittest.main()
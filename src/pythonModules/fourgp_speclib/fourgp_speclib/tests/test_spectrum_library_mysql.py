@@ -67,6 +67,38 @@ class TestSpectrumLibraryMySqlCreation(unittest.TestCase):
                                                 db_user=db_user, db_passwd=db_passwd,
                                                 db_name=db_name, db_host=db_host)
 
+    def test_connection_pool(self):
+        """
+        Test that SpectrumLibraries which use the same MySQL database share a pool of connections.
+        """
+        unique_filename = uuid.uuid4()
+        db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        lib = fourgp_speclib.SpectrumLibraryMySql(path=db_path, create=True, purge_db=True,
+                                                  db_user=db_user, db_passwd=db_passwd,
+                                                  db_name=db_name, db_host=db_host)
+        lib.close()
+
+        # Opening and closing a library repeatedly should reuse a single connection
+        pool = fourgp_speclib.ConnectionPool.get(key=(db_host, db_user, db_passwd, db_name), connect=None)
+        open_connections = len(pool)
+        for i in range(5):
+            lib = fourgp_speclib.SpectrumLibraryMySql(path=db_path,
+                                                      db_user=db_user, db_passwd=db_passwd,
+                                                      db_name=db_name, db_host=db_host)
+            self.assertEqual(len(lib.search()), 0)
+            lib.close()
+        self.assertEqual(len(pool), open_connections)
+
+        # Connections which the server has closed should be replaced
+        connection = pool.acquire()
+        connection.close()
+        pool.release(connection)
+        lib = fourgp_speclib.SpectrumLibraryMySql(path=db_path,
+                                                  db_user=db_user, db_passwd=db_passwd,
+                                                  db_name=db_name, db_host=db_host)
+        self.assertEqual(len(lib.search()), 0)
+        lib.purge()
+
 
 class TestSpectrumLibraryMySQLBinary(unittest.TestCase, TestSpectrumLibrarySQL):
     def setUp(self):
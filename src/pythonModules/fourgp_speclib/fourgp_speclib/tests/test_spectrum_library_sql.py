@@ -5,6 +5,7 @@
 Unit tests for all SQL implementations of spectrum libraries.
 """
 
+import os
 from os import path as os_path
 import uuid
 import unittest
@@ -51,6 +52,426 @@ class TestSpectrumLibrarySQL(object):
         # Check that we got back the same spectrum we put in
         self.assertEqual(my_spectrum, input_spectrum)
 
+    def test_bulk_retrieval_preserves_order(self):
+        """
+        Check that we can open more spectra than fit into a single database query, in an arbitrary order.
+        """
+
+        # Insert more spectra than the library looks up in a single query
+        size = 10
+        count = 2 * self._lib._query_chunk_size + 10
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(count)])
+
+        # Open them back in a shuffled order, by both id and by filename
+        my_spectra = self._lib.search()
+        order = np.random.permutation(count)
+        ids = [my_spectra[i]["specId"] for i in order]
+        filenames = [my_spectra[i]["filename"] for i in order]
+        array_by_id = self._lib.open(ids=ids)
+        array_by_filename = self._lib.open(filenames=filenames)
+
+        # Check that ids and filenames are resolved in the order we requested them
+        self.assertEqual(self._lib._filenames_to_ids(filenames=filenames), ids)
+        self.assertEqual(self._lib._ids_to_filenames(ids=ids), filenames)
+
+        # Check that spectra came back in the order we requested them
+        indices_expected = [int(filename.split(".")[0].split("_")[1]) for filename in filenames]
+        self.assertEqual(indices_expected, [int(array_by_id.get_metadata(i)["index"]) for i in range(count)])
+        self.assertEqual(indices_expected, [int(array_by_filename.get_metadata(i)["index"]) for i in range(count)])
+        for i in range(count):
+            self.assertTrue(np.array_equal(array_by_id.values[i], input_array.values[indices_expected[i]]))
+
+    def test_metadata_columns(self):
+        """
+        Check that we can fetch the metadata on many spectra as columns, with gaps where fields are not set.
+        """
+
+        # Insert spectra with a mixture of numerical and string metadata, not all of which is set on every spectrum
+        size = 50
+        for x in range(5):
+            metadata = {"x_value": x, "name": "star_{}".format(x)}
+            if x % 2 == 0:
+                metadata["y_value"] = 10 * x
+            input_spectrum = fourgp_speclib.Spectrum(wavelengths=np.arange(size),
+                                                     values=np.random.random(size),
+                                                     value_errors=np.random.random(size),
+                                                     metadata=metadata)
+            self._lib.insert(input_spectrum, "x_{}".format(x))
+
+        # Fetch metadata in reverse order of insertion
+        filenames = [item["filename"] for item in self._lib.search()][::-1]
+        columns = self._lib.get_metadata_columns(filenames=filenames)
+
+        # Check that each column matches the per-spectrum metadata
+        self.assertEqual(sorted(columns.keys()), ["name", "x_value", "y_value"])
+        self.assertEqual(list(columns["x_value"]), [4, 3, 2, 1, 0])
+        self.assertEqual(list(columns["name"]), ["star_4", "star_3", "star_2", "star_1", "star_0"])
+        self.assertTrue(np.array_equal(columns["y_value"], [40, np.nan, 20, np.nan, 0], equal_nan=True))
+
+        # Check that we can request a subset of fields
+        columns = self._lib.get_metadata_columns(filenames=filenames, fields=["y_value", "z_value"])
+        self.assertEqual(sorted(columns.keys()), ["y_value", "z_value"])
+        self.assertTrue(np.all(np.isnan(columns["z_value"])))
+
+    def test_bulk_insert(self):
+        """
+        Check that spectra inserted within a bulk_insert block are all committed, with their metadata.
+        """
+
+        # Insert spectra one at a time within a single transaction, adding a new metadata field part way through
+        size = 50
+        with self._lib.bulk_insert():
+            for x in range(10):
+                metadata = {"x_value": x}
+                if x >= 5:
+                    metadata["y_value"] = "high"
+                input_spectrum = fourgp_speclib.Spectrum(wavelengths=np.arange(size),
+                                                         values=np.random.random(size),
+                                                         value_errors=np.random.random(size),
+                                                         metadata=metadata)
+                self._lib.insert(input_spectrum, "x_{}".format(x), metadata_list={"origin": "unit-test"})
+
+        # Check that the new metadata field is searchable, and that all metadata was set
+        my_spectra = self._lib.search(y_value="high")
+        metadata = self._lib.get_metadata(ids=[item["specId"] for item in my_spectra])
+        self.assertEqual(sorted([item["x_value"] for item in metadata]), [5, 6, 7, 8, 9])
+        self.assertTrue(all(item["origin"] == "unit-test" for item in metadata))
+        self.assertEqual(len(self._lib.search()), 10)
+
+    def test_open_memory_mapped(self):
+        """
+        Check that we can open spectra as read-only, memory-mapped SpectrumArrays.
+        """
+
+        # Insert some spectra into the library in a single call
+        size = 50
+        count = 20
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(count)])
+
+        # Open all of the spectra, in the order they were inserted, and also in reverse order
+        ids = sorted([item["specId"] for item in self._lib.search()])
+        for id_list in (ids, ids[::-1], ids[::-1]):
+            my_array = self._lib.open(ids=id_list, mmap=True)
+            self.assertFalse(my_array.values.flags.writeable)
+            for i in range(len(id_list)):
+                index = int(my_array.get_metadata(i)["index"])
+                self.assertTrue(np.array_equal(my_array.extract_item(i).values, input_array.values[index]))
+                self.assertTrue(np.array_equal(my_array.value_errors[i], input_array.value_errors[index]))
+
+        def cache_files():
+            return [item for item in os.listdir(self._lib._path) if item.endswith(".mmap.npy")]
+
+        # Libraries opened read-only read the spectra into memory rather than writing a new cache file
+        existing = cache_files()
+        self._lib._read_only = True
+        my_array = self._lib.open(ids=ids[1::2], mmap=True)
+        self._lib._read_only = False
+        self.assertTrue(np.array_equal(my_array.values, input_array.values[1::2]))
+        self.assertEqual(cache_files(), existing)
+
+        # Only the most recently used cache files are kept
+        self._lib._mmap_cache_size = 2
+        for i in range(4):
+            self._lib.open(ids=ids[i:i + 2][::-1], mmap=True)
+        self.assertEqual(len(cache_files()), 2)
+
+    def test_insert_is_one_transaction(self):
+        """
+        Check that nothing is committed if inserting spectra fails part way through, even if the spectra introduce a
+        new origin and new metadata fields.
+        """
+
+        size = 50
+        input_spectrum = fourgp_speclib.Spectrum(wavelengths=np.arange(size),
+                                                 values=np.random.random(size),
+                                                 value_errors=np.random.random(size))
+
+        def failing_store_metadata(items):
+            raise RuntimeError("Interrupted")
+
+        self._lib._store_metadata = failing_store_metadata
+        with self.assertRaises(RuntimeError):
+            self._lib.insert(input_spectrum, "x_0", origin="new_origin", metadata_list={"new_field": 1})
+        del self._lib._store_metadata
+
+        # Roll back the failed transaction, as would happen if the process had died
+        self._lib._db.rollback()
+        self._lib._origin_ids = {}
+        self._lib._metadata_field_ids = {}
+        self._lib._pending_slabs = {}
+        self.assertEqual(len(self._lib), 0)
+        self._lib._parameterised_query("SELECT COUNT(*) FROM origins WHERE name=?;", ("new_origin",))
+        self.assertEqual(self._lib._db_cursor.fetchall()[0][0], 0)
+
+    def test_open_mixed_rasters(self):
+        """
+        Check that we cannot open spectra sampled on different wavelength rasters into a single SpectrumArray.
+        """
+
+        size = 50
+        for x in range(2):
+            input_spectrum = fourgp_speclib.Spectrum(wavelengths=np.arange(size) * (x + 1),
+                                                     values=np.random.random(size),
+                                                     value_errors=np.random.random(size))
+            self._lib.insert(input_spectrum, "x_{}".format(x))
+
+        my_spectra = self._lib.search()
+        for item in my_spectra:
+            self._lib.open(ids=item["specId"])
+        with self.assertRaises(AssertionError):
+            self._lib.open(ids=[item["specId"] for item in my_spectra])
+
+    def test_open_parallel(self):
+        """
+        Check that reading spectra in parallel gives the same result as reading them one at a time.
+        """
+
+        size = 50
+        count = 30
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(count)])
+
+        ids = [item["specId"] for item in self._lib.search()]
+        serial = self._lib.open(ids=ids)
+        for use_processes in (False, True):
+            parallel = self._lib.open(ids=ids, workers=4, use_processes=use_processes)
+            self.assertTrue(np.array_equal(serial.values, parallel.values))
+            self.assertTrue(np.array_equal(serial.value_errors, parallel.value_errors))
+
+    def test_open_lazy(self):
+        """
+        Check that lazily opened spectra are only read from disk when they are used.
+        """
+
+        size = 50
+        count = 5
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.linspace(4000, 5000, size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(count)])
+        ids = [item["specId"] for item in self._lib.search(order_by="index")]
+
+        # Metadata, single spectra and wavelength windows can be used without reading the whole array
+        spectra = self._lib.open(ids=ids, lazy=True)
+        self.assertEqual(len(spectra), count)
+        self.assertEqual([item["index"] for item in spectra.metadata_list], list(range(count)))
+        self.assertTrue(np.array_equal(spectra.extract_item(3).values, input_array.values[3]))
+
+        window = spectra.window(lambda_min=4200, lambda_max=4600)
+        pixels = (input_array.wavelengths >= 4200) * (input_array.wavelengths <= 4600)
+        self.assertTrue(np.array_equal(window.wavelengths, input_array.wavelengths[pixels]))
+        self.assertTrue(np.array_equal(window.value_errors, input_array.value_errors[:, pixels]))
+        self.assertFalse(spectra.loaded)
+
+        # Touching the values reads everything
+        self.assertTrue(np.array_equal(spectra.values, input_array.values))
+        self.assertTrue(spectra.loaded)
+        self.assertEqual(spectra.raster_hash, input_array.raster_hash)
+        self.assertTrue(np.array_equal(spectra.window(lambda_max=4600).values,
+                                       input_array.values[:, input_array.wavelengths <= 4600]))
+
+    def test_open_wavelength_window(self):
+        """
+        Check that we can open only the pixels of spectra which lie within a wavelength window.
+        """
+
+        size = 50
+        count = 5
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.linspace(4000, 5000, size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(count)])
+        ids = [item["specId"] for item in self._lib.search(order_by="index")]
+        pixels = (input_array.wavelengths >= 4200) * (input_array.wavelengths <= 4600)
+
+        for kwargs in ({}, {"lazy": True}, {"mmap": True}):
+            spectra = self._lib.open(ids=ids, lambda_min=4200, lambda_max=4600, **kwargs)
+            self.assertTrue(np.array_equal(spectra.wavelengths, input_array.wavelengths[pixels]))
+            self.assertTrue(np.array_equal(spectra.values, input_array.values[:, pixels]))
+            self.assertTrue(np.array_equal(spectra.value_errors, input_array.value_errors[:, pixels]))
+            self.assertEqual([item["index"] for item in spectra.metadata_list], list(range(count)))
+
+        # A window requested from a lazy array cannot extend beyond the window it was opened with, and only that
+        # window is requested from disk
+        spectra = self._lib.open(ids=ids, lambda_min=4200, lazy=True)
+        loader = spectra._loader
+        requests = []
+
+        def recording_loader(**kwargs):
+            requests.append((kwargs["lambda_min"], kwargs["lambda_max"]))
+            return loader(**kwargs)
+
+        spectra._loader = recording_loader
+        window = spectra.window(lambda_min=4000, lambda_max=4600)
+        self.assertTrue(np.array_equal(window.values, input_array.values[:, pixels]))
+        spectra.extract_item(0)
+        spectra.load()
+        self.assertEqual(requests, [(4200, 4600), (4200, None), (4200, None)])
+
+        # Windows which exclude every pixel are an error
+        with self.assertRaises(AssertionError):
+            self._lib.open(ids=ids, lambda_min=6000)
+
+        chunks = list(self._lib.iter_spectra(chunk_size=2, lambda_max=4600))
+        values = np.concatenate([chunk.values for chunk in chunks])
+        self.assertTrue(np.array_equal(values, input_array.values[:, input_array.wavelengths <= 4600]))
+
+    def test_iter_spectra(self):
+        """
+        Check that we can stream the results of a search in chunks, with or without prefetching.
+        """
+
+        size = 50
+        count = 25
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i, "odd": i % 2} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{:02d}".format(i) for i in range(count)])
+
+        for prefetch in (True, False):
+            chunks = list(self._lib.iter_spectra(chunk_size=10, prefetch=prefetch))
+            self.assertEqual([len(chunk) for chunk in chunks], [10, 10, 5])
+            values = np.concatenate([chunk.values for chunk in chunks])
+            self.assertTrue(np.array_equal(values, input_array.values))
+
+        odd = list(self._lib.iter_spectra(chunk_size=4, odd=1))
+        indices = [int(metadata["index"]) for chunk in odd for metadata in chunk.metadata_list]
+        self.assertEqual(indices, list(range(1, count, 2)))
+
+        self.assertEqual(list(self._lib.iter_spectra(odd=5)), [])
+
+    def test_spectrum_count(self):
+        """
+        Check that the number of spectra in a library is kept up to date as spectra are inserted.
+        """
+
+        size = 50
+        self.assertEqual(len(self._lib), 0)
+
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((3, size)),
+                                                   value_errors=np.random.random((3, size)),
+                                                   metadata_list=[{"index": i} for i in range(3)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(3)])
+        self.assertEqual(len(self._lib), 3)
+
+        with self._lib.bulk_insert():
+            for i in range(4):
+                self._lib.insert(input_array.extract_item(0), filenames="extra_{}".format(i))
+        self.assertEqual(len(self._lib), 7)
+
+        # Libraries created by old versions of this code have no count stored until they are upgraded
+        self._lib._parameterised_query("UPDATE libraries SET spectrumCount=NULL;")
+        self.assertEqual(len(self._lib), 7)
+        self._lib._upgrade_database()
+        self._lib._parameterised_query("SELECT spectrumCount FROM libraries WHERE libraryId=?;",
+                                       (self._lib._library_id,))
+        self.assertEqual(self._lib._db_cursor.fetchall()[0][0], 7)
+        self._lib.insert(input_array.extract_item(1), filenames="another")
+        self.assertEqual(len(self._lib), 8)
+
+    def test_compact(self):
+        """
+        Check that we can find and remove orphan files, missing files and dangling metadata.
+        """
+
+        size = 50
+        count = 6
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"index": i} for i in range(count)])
+        self._lib.insert(input_array, filenames=["item_{}".format(i) for i in range(count)])
+
+        # Damage the library
+        np.save(os_path.join(self._lib._path, "0123456789abcdef.stray.raster.npy"), np.arange(size))
+        np.save(os_path.join(self._lib._path, "0123456789abcdef.mmap.npy"), np.arange(size))
+        self._lib._parameterised_query("""
+INSERT INTO spectrum_metadata (libraryId, specId, fieldId, valueFloat) VALUES (?, ?, ?, ?);""",
+                                       (self._lib._library_id, 999999, self._lib._fetch_metadata_field_id("index"), 1))
+        missing = 0
+        if self._lib._format != "slab":
+            os.unlink(os_path.join(self._lib._path, self._lib.search(index=0)[0]["filename"]))
+            missing = 1
+
+        report = self._lib.compact(dry_run=True)
+        self.assertEqual(report["orphan_files"], 1)
+        self.assertEqual(report["cache_files"], 1)
+        self.assertEqual(report["missing_files"], missing)
+        self.assertEqual(report["dangling_metadata"], 1)
+        self.assertGreater(report["file_bytes_freed"], 0)
+
+        report = self._lib.compact(orphans="remove", remove_missing=True, workers=2)
+        self.assertEqual(report["orphans_removed"], 1)
+        self.assertEqual(report["missing_removed"], missing)
+        self.assertFalse(os_path.exists(os_path.join(self._lib._path, "0123456789abcdef.stray.raster.npy")))
+        self.assertFalse(os_path.exists(os_path.join(self._lib._path, "0123456789abcdef.mmap.npy")))
+        self.assertEqual(len(self._lib), count - missing)
+
+        # A second pass should find nothing wrong, and the library should still work
+        report = self._lib.compact(dry_run=True)
+        for key in ("orphan_files", "cache_files", "missing_files", "dangling_metadata", "unused_slabs",
+                    "unused_rasters"):
+            self.assertEqual(report[key], 0)
+        spectra = self._lib.open(ids=[item["specId"] for item in self._lib.search()])
+        self.assertTrue(np.array_equal(spectra.values, input_array.values[missing:]))
+
+    def test_deduplication(self):
+        """
+        Check that identical spectra are only stored once in libraries which deduplicate spectra.
+        """
+
+        size = 50
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((3, size)),
+                                                   value_errors=np.random.random((3, size)),
+                                                   metadata_list=[{"index": i} for i in range(3)])
+
+        # Spectra inserted before deduplication is enabled should still be matched afterwards
+        self._lib.insert(input_array.extract_item(0), filenames="original")
+        self._lib.enable_deduplication()
+        self.assertEqual(self._lib.deduplication_stats()["duplicates"], 0)
+
+        # Insert a batch containing a copy of the original spectrum, and two copies of a new spectrum
+        batch = fourgp_speclib.SpectrumArray.from_spectra([input_array.extract_item(i) for i in (0, 1, 1, 2)])
+        self._lib.insert(batch, filenames=["copy_0", "copy_1a", "copy_1b", "copy_2"],
+                         metadata_list=[{"copy": i} for i in range(4)])
+        with self._lib.bulk_insert():
+            self._lib.insert(input_array.extract_item(2), filenames="copy_2b")
+
+        stats = self._lib.deduplication_stats()
+        self.assertEqual(stats["spectra"], 6)
+        self.assertEqual(stats["stored"], 3)
+        self.assertEqual(stats["duplicates"], 3)
+        self.assertAlmostEqual(stats["ratio"], 2)
+
+        # Each copy keeps its own metadata, but reads back the same data
+        ids = [item["specId"] for item in self._lib.search(order_by="filename")]
+        spectra = self._lib.open(ids=ids)
+        for index, item in enumerate((0, 1, 1, 2, 2, 0)):
+            self.assertTrue(np.array_equal(spectra.values[index], input_array.values[item]))
+            self.assertTrue(np.array_equal(spectra.value_errors[index], input_array.value_errors[item]))
+        self.assertEqual([metadata.get("copy") for metadata in spectra.metadata_list], [0, 1, 2, 3, None, None])
+
+        # Shared files are neither orphans nor missing
+        report = self._lib.compact(dry_run=True)
+        self.assertEqual(report["orphan_files"], 0)
+        self.assertEqual(report["missing_files"], 0)
+
     def test_search_illegal_metadata(self):
         """
         Check that we can search for spectra on a simple metadata constraint.
@@ -120,6 +541,89 @@ class TestSpectrumLibrarySQL(object):
         # Check that we got back the same spectrum we put in
         self.assertEqual(x_values, [5])
 
+    def test_search_multiple_constraints(self):
+        """
+        Check that we can search for spectra on several metadata constraints at once, with ordering and pagination.
+        """
+
+        size = 50
+        count = 40
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                   values=np.random.random((count, size)),
+                                                   value_errors=np.random.random((count, size)),
+                                                   metadata_list=[{"x_value": i,
+                                                                   "y_value": i % 4,
+                                                                   "label": "even" if i % 2 == 0 else "odd"}
+                                                                  for i in range(count)])
+        self._lib.insert(input_array, filenames=["x_{:02d}".format(i) for i in range(count)])
+
+        def x_values(results):
+            return [int(item["x_value"]) for item in self._lib.get_metadata(ids=[i["specId"] for i in results])]
+
+        expected = [i for i in range(10, 30) if i % 4 == 2]
+        self.assertEqual(x_values(self._lib.search(x_value=[10, 29], y_value=2, label="even")), expected)
+        self.assertEqual(self._lib.search_count(x_value=[10, 29], y_value=2, label="even"), len(expected))
+        self.assertEqual(self._lib.search(x_value=[10, 29], y_value=2, label="odd"), [])
+        self.assertEqual(self._lib.search_count(x_value=[10, 29], y_value=2, label="odd"), 0)
+
+        self.assertEqual(x_values(self._lib.search(order_by="-x_value", label="odd", limit=3)), [39, 37, 35])
+        self.assertEqual(x_values(self._lib.search(order_by="x_value", limit=5, offset=10)), list(range(10, 15)))
+        self.assertEqual(x_values(self._lib.search(order_by="-filename", offset=37)), [2, 1, 0])
+        self.assertEqual(self._lib.search_count(), count)
+
+    def test_label_table(self):
+        """
+        Check that searches and metadata reads give the same results once a library has a wide table of labels.
+        """
+
+        size = 50
+        count = 30
+
+        def insert(start):
+            input_array = fourgp_speclib.SpectrumArray(wavelengths=np.arange(size),
+                                                       values=np.random.random((count, size)),
+                                                       value_errors=np.random.random((count, size)),
+                                                       metadata_list=[{"x_value": i,
+                                                                       "y_value": i % 3,
+                                                                       "label": "even" if i % 2 == 0 else "odd"}
+                                                                      for i in range(start, start + count)])
+            self._lib.insert(input_array, filenames=["x_{:02d}".format(i) for i in range(start, start + count)])
+
+        def snapshot():
+            ids = [item["specId"] for item in self._lib.search()]
+            return (self._lib.search(x_value=[5, 50], y_value=1),
+                    self._lib.search(x_value=[5, 50], label="odd", order_by="-y_value"),
+                    self._lib.search_count(y_value=2),
+                    self._lib.get_metadata_columns(ids=ids, fields=["x_value", "y_value"]))
+
+        insert(start=0)
+        before = snapshot()
+        self._lib.enable_label_table()
+        after = snapshot()
+        self.assertEqual(before[:3], after[:3])
+        for field in ("x_value", "y_value"):
+            self.assertTrue(np.array_equal(before[3][field], after[3][field]))
+
+        # Check that the table is kept up to date by insert and set_metadata
+        insert(start=count)
+        self._lib.set_metadata(ids=self._lib.search(x_value=3)[0]["specId"], metadata={"y_value": 9})
+        self._lib.set_metadata(ids=self._lib.search(x_value=4)[0]["specId"], metadata={"x_value": "four"})
+        self.assertEqual([item["filename"].split(".")[0] for item in self._lib.search(y_value=9)], ["x_03"])
+        self.assertEqual(self._lib.search_count(x_value=[0, 100]), 2 * count - 1)
+
+        ids = [item["specId"] for item in self._lib.search(order_by="filename", limit=6)]
+        columns = self._lib.get_metadata_columns(ids=ids, fields=["x_value", "y_value"])
+        self.assertEqual(list(columns["x_value"]), [0, 1, 2, 3, "four", 5])
+        self.assertEqual(list(columns["y_value"]), [0, 1, 2, 9, 1, 2])
+
+        # New numeric fields set within a bulk_insert block only get columns once the transaction is committed
+        with self._lib.bulk_insert():
+            self._lib.set_metadata(ids=ids[:3], metadata={"z_value": 7})
+            self.assertNotIn(self._lib._fetch_metadata_field_id("z_value"), self._lib._label_columns)
+            self.assertEqual(self._lib.search_count(z_value=7), 3)
+        self.assertIn(self._lib._fetch_metadata_field_id("z_value"), self._lib._label_columns)
+        self.assertEqual(self._lib.search_count(z_value=7), 3)
+
     def test_search_1d_string_range(self):
         """
         Check that we can search for spectra on a simple metadata string range constraint.
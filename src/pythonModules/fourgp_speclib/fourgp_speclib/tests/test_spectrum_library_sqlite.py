@@ -5,9 +5,15 @@
 Unit tests for the SQLite implementation of spectrum libraries
 """
 
+import os
+import json
+import sys
+import subprocess
 from os import path as os_path
 import uuid
+import sqlite3
 import unittest
+import numpy as np
 import fourgp_speclib
 
 from test_spectrum_library_sql import TestSpectrumLibrarySQL
@@ -50,6 +56,230 @@ class TestSpectrumLibrarySQLiteCreation(unittest.TestCase):
             fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=False)
 
 
+    def test_schema_upgrade(self):
+        """
+        Test that we can open a SpectrumLibrary whose database was created with an older schema.
+        """
+        unique_filename = uuid.uuid4()
+        db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=True)
+        lib.close()
+
+        # Remove the tables and columns which were added to the schema after it was first released
+        db = sqlite3.connect(os_path.join(db_path, "index.db"))
+        db.executescript("""
+DROP TABLE spectra;
+DROP TABLE slabs;
+DROP TABLE rasters;
+CREATE TABLE spectra (
+    specId INTEGER PRIMARY KEY,
+    libraryId INTEGER NOT NULL,
+    filename VARCHAR(256) UNIQUE NOT NULL,
+    originId INTEGER NOT NULL,
+    importTime REAL
+);
+""")
+        db.commit()
+        db.close()
+
+        # Libraries created by old versions of this code do not record which version of the schema they use
+        with open(os_path.join(db_path, "library_props")) as f:
+            library_props = json.loads(f.read())
+        del library_props["schema_version"]
+        with open(os_path.join(db_path, "library_props"), "w") as f:
+            f.write(json.dumps(library_props))
+
+        # Legacy databases cannot be upgraded while open read-only, so refuse to open them read-only
+        with self.assertRaises(AssertionError):
+            fourgp_speclib.SpectrumLibrarySqlite(path=db_path, read_only=True)
+
+        lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path)
+        self.assertIn("rasterId", lib._list_columns("spectra"))
+        self.assertIn("slabRow", lib._list_columns("spectra"))
+        self.assertIn("contentHash", lib._list_columns("spectra"))
+        self.assertIn("search_by_content_hash", lib._list_indices("spectra"))
+        self.assertIn("slabs", lib._list_tables())
+        lib.close()
+
+        # Once upgraded, the library records that its database is up to date, so it is not inspected again
+        with open(os_path.join(db_path, "library_props")) as f:
+            self.assertEqual(json.loads(f.read())["schema_version"], lib._schema_version)
+        lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, read_only=True)
+        self.assertEqual(len(lib), 0)
+        lib.close()
+
+        # Libraries whose databases are complete can be opened read-only, even if they don't record a schema version
+        with open(os_path.join(db_path, "library_props")) as f:
+            library_props = json.loads(f.read())
+        del library_props["schema_version"]
+        with open(os_path.join(db_path, "library_props"), "w") as f:
+            f.write(json.dumps(library_props))
+        lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, read_only=True)
+        self.assertEqual(lib._missing_schema(), [])
+        lib.close()
+
+        lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path)
+        lib.purge()
+
+    def test_read_only(self):
+        """
+        Test that many readers can open a SpectrumLibrary read-only while a writer is importing spectra into it.
+        """
+        unique_filename = uuid.uuid4()
+        db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        writer = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=True, profile="concurrent")
+        writer.close()
+        writer = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, profile="concurrent")
+        size = 50
+
+        def insert(index):
+            writer.insert(fourgp_speclib.Spectrum(wavelengths=np.arange(size),
+                                                  values=np.random.random(size),
+                                                  value_errors=np.random.random(size),
+                                                  metadata={"x_value": index}), "x_{}".format(index))
+
+        insert(0)
+        readers = [fourgp_speclib.SpectrumLibrarySqlite(path=db_path, read_only=True, profile="concurrent")
+                   for i in range(3)]
+
+        # Readers can see committed spectra while the writer holds a transaction open
+        with writer.bulk_insert():
+            insert(1)
+            for reader in readers:
+                self.assertEqual(len(reader.search()), 1)
+                self.assertEqual(len(reader.open(ids=reader.search()[0]["specId"])), 1)
+        for reader in readers:
+            self.assertEqual(len(reader.search()), 2)
+
+        writer._db_cursor.execute("PRAGMA journal_mode;")
+        self.assertEqual(writer._db_cursor.fetchall()[0][0].lower(), "wal")
+
+        with self.assertRaises(AssertionError):
+            readers[0].set_metadata(ids=readers[0].search()[0]["specId"], metadata={"x_value": 5})
+        with self.assertRaises(AssertionError):
+            fourgp_speclib.SpectrumLibrarySqlite(path=db_path, read_only=True, profile="unknown")
+
+        for reader in readers:
+            reader.close()
+        writer.purge()
+        self.assertFalse(os_path.exists(os_path.join(db_path, "index.db-wal")))
+
+    def test_import_from(self):
+        """
+        Test that we can copy spectra between SpectrumLibraries in chunks, and resume an interrupted copy.
+        """
+        paths = [os_path.join("/tmp", "speclib_test_{}".format(uuid.uuid4())) for i in range(3)]
+        source = fourgp_speclib.SpectrumLibrarySqlite(path=paths[0], create=True, storage_format="slab")
+        size = 50
+        count = 25
+        with source.bulk_insert():
+            for i in range(count):
+                source.insert(fourgp_speclib.Spectrum(wavelengths=np.arange(size) * (1 + i % 2),
+                                                      values=np.random.random(size),
+                                                      value_errors=np.random.random(size),
+                                                      metadata={"index": i, "odd": i % 2}),
+                              filenames="x_{:02d}".format(i), origin="origin_{}".format(i % 3))
+
+        # Copy all the odd-numbered spectra in one go
+        destination = fourgp_speclib.SpectrumLibrarySqlite(path=paths[1], create=True, storage_format="npy")
+        self.assertEqual(destination.import_from(source, chunk_size=4, workers=3, odd=1), 12)
+        self.assertEqual(len(destination), 12)
+        for item in destination.search():
+            metadata = destination.get_metadata(ids=item["specId"])[0]
+            self.assertEqual(item["name"], "origin_{}".format(int(metadata["index"]) % 3))
+            self.assertTrue(np.array_equal(destination.open(ids=item["specId"]).wavelengths, np.arange(size) * 2))
+
+        # Interrupt a copy after the first few chunks, and then resume it
+        destination = fourgp_speclib.SpectrumLibrarySqlite(path=paths[2], create=True)
+        progress_file = os_path.join(paths[2], "import_progress")
+        insert = destination.insert
+        calls = []
+
+        def interrupted_insert(**kwargs):
+            calls.append(len(kwargs["filenames"]))
+            assert len(calls) <= 3, "Interrupted"
+            insert(**kwargs)
+
+        destination.insert = interrupted_insert
+        with self.assertRaises(AssertionError):
+            destination.import_from(source, chunk_size=5, progress_file=progress_file)
+        destination.insert = insert
+        self.assertEqual(len(destination), sum(calls[:3]))
+        self.assertEqual(destination.import_from(source, chunk_size=5, progress_file=progress_file),
+                         count - sum(calls[:3]))
+        indices = sorted(int(item["index"]) for item in destination.get_metadata(
+            ids=[item["specId"] for item in destination.search()]))
+        self.assertEqual(indices, list(range(count)))
+
+        for library in (source, destination):
+            library.purge()
+
+    def test_compact_reattach(self):
+        """
+        Test that orphan spectrum files can be reattached to a SpectrumLibrary.
+        """
+        unique_filename = uuid.uuid4()
+        db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=True, binary_spectra=True)
+        size = 50
+        orphan = fourgp_speclib.Spectrum(wavelengths=np.arange(size),
+                                         values=np.random.random(size),
+                                         value_errors=np.random.random(size))
+        orphan.to_file(filename=os_path.join(db_path, "orphan.0123abcd.spec.npy"), binary=True)
+
+        report = lib.compact(orphans="reattach")
+        self.assertEqual(report["orphans_reattached"], 1)
+        self.assertEqual(len(lib), 1)
+        item = lib.search()[0]
+        self.assertEqual(item["name"], "orphan")
+        self.assertTrue(np.array_equal(lib.open(ids=item["specId"]).values[0], orphan.values))
+        lib.close()
+
+        # Check that the command-line tool runs
+        self.assertEqual(subprocess.call([sys.executable, "-m", "fourgp_speclib.compact_library",
+                                          "--library", db_path, "--dry-run"],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL), 0)
+        fourgp_speclib.SpectrumLibrarySqlite(path=db_path).purge()
+
+
+    def test_single_precision(self):
+        """
+        Test that libraries can store spectra in single precision, and open them in either precision.
+        """
+        size = 50
+        input_array = fourgp_speclib.SpectrumArray(wavelengths=np.linspace(4000, 5000, size),
+                                                   values=np.random.random((4, size)),
+                                                   value_errors=np.random.random((4, size)),
+                                                   metadata_list=[{"index": i} for i in range(4)])
+
+        # Formats which store the wavelength raster alongside each spectrum must use double precision
+        with self.assertRaises(AssertionError):
+            fourgp_speclib.SpectrumLibrarySqlite(path=os_path.join("/tmp", "speclib_test_{}".format(uuid.uuid4())),
+                                                 create=True, storage_format="bin", dtype="float32")
+
+        for storage_format in ("npy", "slab", "bin.zlib"):
+            db_path = os_path.join("/tmp", "speclib_test_{}".format(uuid.uuid4()))
+            lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path, create=True, storage_format=storage_format,
+                                                       dtype="float32")
+            lib.insert(input_array, filenames=["item_{}".format(i) for i in range(4)])
+            lib.close()
+
+            # The precision is a property of the library, so is used by default when it is reopened
+            lib = fourgp_speclib.SpectrumLibrarySqlite(path=db_path)
+            ids = [item["specId"] for item in lib.search(order_by="index")]
+            for shared_memory in (False, True):
+                spectra = lib.open(ids=ids, shared_memory=shared_memory)
+                self.assertEqual(spectra.values.dtype, np.float32)
+                self.assertEqual(spectra.value_errors.dtype, np.float32)
+                self.assertTrue(np.array_equal(spectra.wavelengths, input_array.wavelengths))
+                self.assertTrue(np.array_equal(spectra.values, input_array.values.astype(np.float32)))
+
+            spectra = lib.open(ids=ids, dtype="float64")
+            self.assertEqual(spectra.values.dtype, np.float64)
+            self.assertTrue(np.array_equal(spectra.value_errors, input_array.value_errors.astype(np.float32)))
+            self.assertEqual([chunk.values.dtype for chunk in lib.iter_spectra(chunk_size=3)], [np.float32] * 2)
+            lib.purge()
+
 class TestSpectrumLibrarySQLiteBinary(unittest.TestCase, TestSpectrumLibrarySQL):
     def setUp(self):
         """
@@ -101,6 +331,100 @@ class TestSpectrumLibrarySQLiteText(unittest.TestCase, TestSpectrumLibrarySQL):
         self._lib.purge()
 
 
+class TestSpectrumLibrarySQLiteNpy(unittest.TestCase, TestSpectrumLibrarySQL):
+    def setUp(self):
+        """
+        Open connection to a clean SpectrumLibrary based on SQLite.
+        """
+        unique_filename = uuid.uuid4()
+        self._db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        self._lib = fourgp_speclib.SpectrumLibrarySqlite(path=self._db_path, create=True,
+                                                         storage_format="npy")
+
+    def tearDown(self):
+        """
+        Tear down SpectrumLibrary based on SQLite.
+        """
+        self._lib.purge()
+
+
+class TestSpectrumLibrarySQLiteCompressed(unittest.TestCase, TestSpectrumLibrarySQL):
+    def setUp(self):
+        """
+        Open connection to a clean SpectrumLibrary based on SQLite, storing spectra in compressed binary files.
+        """
+        unique_filename = uuid.uuid4()
+        self._db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        self._lib = fourgp_speclib.SpectrumLibrarySqlite(path=self._db_path, create=True,
+                                                         storage_format="bin.zlib")
+
+    def tearDown(self):
+        """
+        Tear down SpectrumLibrary based on SQLite.
+        """
+        self._lib.purge()
+
+
+class TestSpectrumLibrarySQLiteConcurrent(unittest.TestCase, TestSpectrumLibrarySQL):
+    def setUp(self):
+        """
+        Open connection to a clean SpectrumLibrary based on SQLite, using write-ahead logging.
+        """
+        unique_filename = uuid.uuid4()
+        self._db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        self._lib = fourgp_speclib.SpectrumLibrarySqlite(path=self._db_path, create=True,
+                                                         profile="concurrent")
+
+    def tearDown(self):
+        """
+        Tear down SpectrumLibrary based on SQLite.
+        """
+        self._lib.purge()
+
+
+class TestSpectrumLibrarySQLiteSlab(unittest.TestCase, TestSpectrumLibrarySQL):
+    def setUp(self):
+        """
+        Open connection to a clean SpectrumLibrary based on SQLite.
+        """
+        unique_filename = uuid.uuid4()
+        self._db_path = os_path.join("/tmp", "speclib_test_{}".format(unique_filename))
+        self._lib = fourgp_speclib.SpectrumLibrarySqlite(path=self._db_path, create=True,
+                                                         storage_format="slab")
+
+    def tearDown(self):
+        """
+        Tear down SpectrumLibrary based on SQLite.
+        """
+        self._lib.purge()
+
+    def test_slab_packing(self):
+        """
+        Check that spectra inserted in a single transaction are packed into one slab per wavelength raster.
+        """
+        size = 50
+        with self._lib.bulk_insert():
+            for x in range(6):
+                input_spectrum = fourgp_speclib.Spectrum(wavelengths=np.arange(size) * (1 + x % 2),
+                                                         values=np.random.random(size),
+                                                         value_errors=np.random.random(size),
+                                                         metadata={"x_value": x, "raster": x % 2})
+                self._lib.insert(input_spectrum, "x_{}".format(x))
+
+        slab_files = [item for item in os.listdir(self._db_path) if item.endswith(".slab.npy")]
+        raster_files = [item for item in os.listdir(self._db_path) if item.endswith(".raster.npy")]
+        self.assertEqual(len(slab_files), 2)
+        self.assertEqual(len(raster_files), 2)
+
+        # Check that we can open spectra on each raster, but not a mixture of the two
+        for raster in range(2):
+            my_spectra = self._lib.search(raster=raster)
+            my_array = self._lib.open(ids=[item["specId"] for item in my_spectra])
+            self.assertTrue(np.array_equal(my_array.wavelengths, np.arange(size) * (1 + raster)))
+        with self.assertRaises(AssertionError):
+            self._lib.open(ids=[item["specId"] for item in self._lib.search()])
+
+
 # Run tests if we are run from command line
 if __name__ == '__main__':
     unittest.main()
@@ -53,5 +53,8 @@ setup(
         "": ["LICENSE"],
     },
     include_package_data=True,
-    data_files=None
+    data_files=None,
+    entry_points={
+        "console_scripts": ["fourgp_compact_library = fourgp_speclib.compact_library:main"]
+    }
 )
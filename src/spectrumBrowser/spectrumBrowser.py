@@ -119,13 +119,9 @@ def library_search(library):
                     upper_limit = "zzzzzzzzz"
                 constraints[item] = (lower_limit, upper_limit) if lower_limit != upper_limit else lower_limit
 
-    # Search the SpectrumLibrary for matching spectra
-    spectrum_ids = [i['specId'] for i in x.search(**constraints)]
-    result_count = len(spectrum_ids)
-
-    # Show a maximum of 100 results
-    if len(spectrum_ids) > 100:
-        spectrum_ids = spectrum_ids[:100]
+    # Search the SpectrumLibrary for matching spectra, showing a maximum of 100 results
+    result_count = x.search_count(**constraints)
+    spectrum_ids = [i['specId'] for i in x.search(limit=100, **constraints)]
     results = x.get_metadata(ids=spectrum_ids)
 
     # Add spectrum_id into each spectrum's metadata -- the HTML template needs this so we can link to spectrum viewer
@@ -200,15 +196,26 @@ def spectrum_txt(library, spec_id):
 def spectrum_png(library, spec_id, lambda_min, lambda_max):
     path = os_path.join(args.path, library)
     x = SpectrumLibrarySqlite(path=path)
-    spectrum = x.open(ids=int(spec_id)).extract_item(0)
+
+    # Only read the part of the spectrum which is being plotted. If none of the spectrum lies within the requested
+    # wavelength range, plot empty axes.
+    spectra = x.open(ids=int(spec_id), lazy=True)
+    wavelengths = spectra.wavelengths
+    lambda_min = float(lambda_min)
+    lambda_max = float(lambda_max)
+    if np.any((wavelengths >= lambda_min) * (wavelengths <= lambda_max)):
+        spectrum = spectra.window(lambda_min=lambda_min, lambda_max=lambda_max).extract_item(0)
+        plot_wavelengths, plot_values = spectrum.wavelengths, spectrum.values
+    else:
+        plot_wavelengths, plot_values = [], []
 
     fig = Figure(figsize=(16, 6))
     ax = fig.add_subplot(111)
     ax.set_xlabel('Wavelength / A')
     ax.set_ylabel('Value')
-    ax.set_xlim([float(lambda_min), float(lambda_max)])
+    ax.set_xlim([lambda_min, lambda_max])
     ax.grid(True)
-    ax.plot(spectrum.wavelengths, spectrum.values)
+    ax.plot(plot_wavelengths, plot_values)
     canvas = FigureCanvas(fig)
     png_output = io.BytesIO()
     canvas.print_png(png_output)